@@ -0,0 +1,125 @@
+"""Benchmark the combined fetch-and-authorize query at scale.
+
+Seeds a throwaway ``bench_access`` schema (1M projects and 1M access grants
+by default), then times ``ProjectService.get_project_with_access`` and the
+project list query with and without the lookup indexes.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.access_lookup --projects 1000000
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import statistics
+import time
+import uuid
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.database import Base, create_engine_for, DATABASE_URL
+from models.user import User, Project  # noqa: F401  (register tables)
+from models.user_project_access import UserProjectAccess  # noqa: F401
+from services.user_service import ProjectService
+
+SCHEMA = "bench_access"
+INDEXES = {
+    "ix_project_owner_id_updated_at": "CREATE INDEX ix_project_owner_id_updated_at ON project (owner_id, updated_at, id)",
+    "ix_user_project_access_project_id": "CREATE INDEX ix_user_project_access_project_id ON user_project_access (project_id)",
+}
+
+
+def _uuid(prefix: str, i: int) -> uuid.UUID:
+    # Same as md5(prefix || i)::uuid on the SQL side
+    return uuid.UUID(hashlib.md5(f"{prefix}{i}".encode()).hexdigest())
+
+
+async def seed(conn, projects: int, users: int):
+    await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+    await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    await conn.execute(text(f"SET search_path TO {SCHEMA}"))
+    await conn.run_sync(Base.metadata.create_all)
+    await conn.execute(text(
+        'INSERT INTO "user" (id, username, email, password) '
+        "SELECT md5('u' || i)::uuid, 'u' || i, 'u' || i || '@bench', 'x' "
+        "FROM generate_series(0, :users - 1) i"
+    ), {"users": users})
+    await conn.execute(text(
+        "INSERT INTO project (id, name, owner_id, data) "
+        "SELECT md5('p' || i)::uuid, 'project ' || i, md5('u' || (i % :users))::uuid, "
+        "jsonb_build_object('pages', jsonb_build_array()) "
+        "FROM generate_series(0, :projects - 1) i"
+    ), {"users": users, "projects": projects})
+    await conn.execute(text(
+        "INSERT INTO user_project_access (user_id, project_id, granted_at) "
+        "SELECT md5('u' || ((i * 7 + 1) % :users))::uuid, md5('p' || i)::uuid, now() "
+        "FROM generate_series(0, :projects - 1) i"
+    ), {"users": users, "projects": projects})
+    await conn.execute(text("ANALYZE"))
+
+
+async def measure(conn, projects: int, users: int, samples: int):
+    session = AsyncSession(bind=conn)
+    lookups, listings = [], []
+    for _ in range(samples):
+        i = random.randrange(projects)
+        # Alternate owner, collaborator and stranger lookups
+        user_index = random.choice([i % users, (i * 7 + 1) % users, random.randrange(users)])
+        start = time.perf_counter()
+        await ProjectService.get_project_with_access(
+            session, _uuid("p", i), _uuid("u", user_index), include_data=False
+        )
+        lookups.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await ProjectService.get_accessible_projects(session, _uuid("u", user_index), limit=20, summary=True)
+        listings.append((time.perf_counter() - start) * 1000)
+    return lookups, listings
+
+
+def report(label: str, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<40} p50={statistics.median(timings):7.3f}ms  p95={p95:7.3f}ms  max={timings[-1]:7.3f}ms")
+
+
+async def main(projects: int, users: int, samples: int, keep: bool):
+    engine = create_engine_for(DATABASE_URL)
+    try:
+        async with engine.connect() as conn:
+            print(f"Seeding {projects} projects / {users} users into schema {SCHEMA}...")
+            start = time.perf_counter()
+            await seed(conn, projects, users)
+            await conn.commit()
+            print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+            await conn.execute(text(f"SET search_path TO {SCHEMA}"))
+            lookups, listings = await measure(conn, projects, users, samples)
+            report("fetch+authorize (indexed)", lookups)
+            report("list page of 20 (indexed)", listings)
+
+            for name in INDEXES:
+                await conn.execute(text(f"DROP INDEX {name}"))
+            await conn.execute(text("ANALYZE"))
+            lookups, listings = await measure(conn, projects, users, max(samples // 10, 10))
+            report("fetch+authorize (no lookup indexes)", lookups)
+            report("list page of 20 (no lookup indexes)", listings)
+
+            if keep:
+                for statement in INDEXES.values():
+                    await conn.execute(text(statement))
+            else:
+                await conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+            await conn.commit()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--projects", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--keep", action="store_true", help="keep the bench schema afterwards")
+    args = parser.parse_args()
+    asyncio.run(main(args.projects, args.users, args.samples, args.keep))
@@ -0,0 +1,274 @@
+"""Load-test the collaboration websocket rooms.
+
+Opens ``--clients`` simulated collaborators spread evenly over ``--rooms``
+projects. Once all are connected each one sends ``--rate`` messages per
+second of about ``--size`` bytes for ``--duration`` seconds. Reports
+fan-out latency percentiles (send to receipt by every other peer),
+throughput, delivery ratio and the server's memory per connection.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.collab_load --clients 200 --rooms 20
+    python -m benchmarks.collab_load --url http://127.0.0.1:8000 --clients 500 --rooms 50
+
+By default a uvicorn worker is started on a free port, and its RSS gives
+the memory per connection. ``--url`` targets a running server instead;
+memory is then only reported with ``--pid``. ``--in-process`` serves the
+app from this process, so its RSS includes the clients. All clients run in
+one event loop, so at high rates check that this process is not the
+bottleneck: its CPU is printed next to the results.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import websockets
+
+# Not coalesced by the server (see COLLAB_COALESCE_TYPES), so every
+# message is relayed and the numbers measure the plain fan-out path
+MESSAGE_TYPE = "load"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _request(base: str, method: str, path: str, body=None, token=None):
+    request = urllib.request.Request(
+        base + path,
+        method=method,
+        data=json.dumps(body).encode() if body is not None else None,
+        headers={"Content-Type": "application/json", **({"Authorization": f"Bearer {token}"} if token else {})},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+async def http(base: str, method: str, path: str, body=None, token=None):
+    return await asyncio.to_thread(_request, base, method, path, body, token)
+
+
+async def wait_live(base: str, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            await http(base, "GET", "/health/live")
+            return
+        except (urllib.error.URLError, ConnectionError):
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"server not live after {timeout}s")
+            await asyncio.sleep(0.05)
+
+
+async def setup(base: str, rooms: int):
+    """A throwaway user and one project per room"""
+    email = f"load-{uuid.uuid4().hex[:12]}@example.com"
+    await http(base, "POST", "/auth/register", {"username": "load", "email": email, "password": "load"})
+    token = (await http(base, "POST", "/auth/login", {"email": email, "password": "load"}))["access_token"]
+    projects = await asyncio.gather(*(
+        http(base, "POST", "/projects/", {"name": f"load {i}", "data": {"pages": []}}, token) for i in range(rooms)
+    ))
+    return token, [project["id"] for project in projects]
+
+
+class Stats:
+    def __init__(self):
+        self.connect_times = []
+        self.latencies = []
+        self.sent = 0
+        self.delivered = 0
+        self.frames = 0
+        self.errors = 0
+        self.closed_by_server = 0
+
+
+def _decoder(options):
+    """Turns a received frame into a list of messages"""
+    loads = json.loads
+    if "collab.msgpack" in options:
+        import msgpack
+        loads = msgpack.unpackb
+    elif "collab.cbor" in options:
+        import cbor2
+        loads = cbor2.loads
+
+    def decode(frame):
+        message = loads(frame) if isinstance(frame, bytes) else json.loads(frame)
+        if isinstance(message, dict) and message.get("type") == "batch":
+            return message["messages"]
+        return [message]
+    return decode
+
+
+async def run_client(url: str, token: str, args, index: int, stats: Stats, connecting: asyncio.Semaphore,
+                     start: asyncio.Event, done: asyncio.Event):
+    decode = _decoder(args.options)
+    padding = "x" * max(args.size - 80, 0)
+    async with connecting:
+        began = time.perf_counter()
+        try:
+            ws = await websockets.connect(
+                url, subprotocols=[f"jwt.{token}", *args.options], max_size=None, open_timeout=60,
+                compression=None if args.no_deflate else "deflate",
+            )
+        except Exception:
+            stats.errors += 1
+            return
+        stats.connect_times.append(time.perf_counter() - began)
+
+    async def receive():
+        async for frame in ws:
+            stats.frames += 1
+            for message in decode(frame):
+                if isinstance(message, dict) and message.get("type") == MESSAGE_TYPE:
+                    stats.delivered += 1
+                    stats.latencies.append(time.perf_counter() - message["sent"])
+
+    async def send():
+        await start.wait()
+        interval = 1.0 / args.rate
+        next_at = time.perf_counter() + interval * (index % 100) / 100  # spread the clients
+        n = 0
+        while not done.is_set():
+            await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+            await ws.send(json.dumps({"type": MESSAGE_TYPE, "cid": index, "n": n, "sent": time.perf_counter(), "pad": padding}))
+            stats.sent += 1
+            n += 1
+            next_at += interval
+
+    receiver = asyncio.create_task(receive())
+    try:
+        await send()
+        await asyncio.sleep(args.drain)  # let in-flight messages arrive
+    except websockets.ConnectionClosed:
+        stats.closed_by_server += 1
+    finally:
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        await ws.close()
+
+
+def percentile(ordered, p: float) -> float:
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def report(args, stats: Stats, rss_before, rss_connected, cpu_seconds, server_metrics):
+    per_room = args.clients // args.rooms
+    expected = stats.sent * (per_room - 1) if per_room > 1 else 0
+    latencies = sorted(stats.latencies)
+    connects = sorted(stats.connect_times)
+    print(f"clients {args.clients} in {args.rooms} rooms ({per_room} per room), "
+          f"{args.rate:g} msg/s each, {args.size} B, {args.duration:g}s, options: {' '.join(args.options) or '-'}"
+          f"{', no deflate' if args.no_deflate else ''}")
+    print(f"connect       p50 {percentile(connects, .5) * 1000:8.1f} ms   p95 {percentile(connects, .95) * 1000:8.1f} ms   "
+          f"failed {stats.errors}")
+    print(f"sent          {stats.sent:>10}   {stats.sent / args.duration:10.0f} msg/s")
+    print(f"delivered     {stats.delivered:>10}   {stats.delivered / args.duration:10.0f} msg/s   "
+          f"{stats.frames} frames   {stats.delivered / expected * 100 if expected else 0:.1f}% of expected")
+    print(f"fan-out       p50 {percentile(latencies, .5) * 1000:8.2f} ms   p95 {percentile(latencies, .95) * 1000:8.2f} ms   "
+          f"p99 {percentile(latencies, .99) * 1000:8.2f} ms   max {(latencies[-1] if latencies else 0) * 1000:8.2f} ms")
+    if rss_before is not None:
+        print(f"server RSS    {rss_before / 1024:8.1f} MiB idle   {rss_connected / 1024:8.1f} MiB connected   "
+              f"{(rss_connected - rss_before) / max(args.clients, 1):8.1f} KiB per connection")
+    print(f"load client   {cpu_seconds:8.1f} s CPU ({cpu_seconds / args.duration * 100:.0f}% of one core)"
+          f"{'   closed by server: %d' % stats.closed_by_server if stats.closed_by_server else ''}")
+    if server_metrics:
+        counters, gauges = server_metrics["counters"], server_metrics["gauges"]
+        interesting = ("collab_send_dropped", "collab_slow_peer_disconnects", "collab_send_failures", "collab_messages_coalesced")
+        print("server        " + "   ".join(f"{name[7:]}={counters.get(name, 0):g}" for name in interesting))
+        latency = server_metrics["histograms"].get("collab_send_latency_seconds")
+        if latency:
+            print(f"server queue  p50 {latency['p50'] * 1000:8.2f} ms   p99 {latency['p99'] * 1000:8.2f} ms   "
+                  f"peak depth {gauges.get('collab_send_queue_depth_max', 0):g}")
+
+
+async def main(args):
+    server, pid = None, args.pid
+    if args.url:
+        base = args.url.rstrip("/")
+    else:
+        port = _free_port()
+        base = f"http://127.0.0.1:{port}"
+        if args.in_process:
+            import uvicorn
+            server = uvicorn.Server(uvicorn.Config("main:app", host="127.0.0.1", port=port, log_level="warning"))
+            serving = asyncio.create_task(server.serve())
+            pid = os.getpid()
+        else:
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            pid = server.pid
+    try:
+        await wait_live(base, 60)
+        token, projects = await setup(base, args.rooms)
+        ws_base = base.replace("http", "ws", 1)
+        stats = Stats()
+        start, done = asyncio.Event(), asyncio.Event()
+        rss_before = _rss_kb(pid) if pid else None
+
+        connecting = asyncio.Semaphore(args.connect_concurrency)
+        clients = [
+            asyncio.create_task(run_client(
+                f"{ws_base}/collaboration/{projects[i % args.rooms]}/ws", token, args, i, stats, connecting, start, done
+            ))
+            for i in range(args.clients)
+        ]
+        while len(stats.connect_times) + stats.errors < args.clients:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.5)  # snapshots delivered, queues idle
+        rss_connected = _rss_kb(pid) if pid else None
+
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        start.set()
+        await asyncio.sleep(args.duration)
+        done.set()
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        server_metrics = await http(base, "GET", "/metrics")
+        await asyncio.gather(*clients, return_exceptions=True)
+
+        cpu_seconds = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+        report(args, stats, rss_before, rss_connected, cpu_seconds, server_metrics)
+    finally:
+        if isinstance(server, subprocess.Popen):
+            server.terminate()
+            server.wait()
+        elif server is not None:
+            server.should_exit = True
+            await serving
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=5.0, help="messages per second per client")
+    parser.add_argument("--size", type=int, default=200, help="approximate message size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to wait for in-flight messages")
+    parser.add_argument("--options", nargs="*", default=[], help="subprotocol options, e.g. collab.batch collab.msgpack")
+    parser.add_argument("--no-deflate", action="store_true", help="do not offer permessage-deflate (browsers do)")
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument("--url", help="base URL of a running server (default: start one)")
+    parser.add_argument("--pid", type=int, help="pid of the --url server, to report its memory")
+    parser.add_argument("--in-process", action="store_true", help="serve the app from this process")
+    args = parser.parse_args()
+    asyncio.run(main(args))
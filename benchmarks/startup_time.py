@@ -0,0 +1,80 @@
+"""Measure how long a worker takes to boot.
+
+Times ``import main`` in fresh interpreters, then starts uvicorn and polls
+``/health/ready`` until the worker reports ready (warmup done, database
+reachable, no pending migrations).
+
+    DATABASE_URL=postgresql://... python -m benchmarks.startup_time --runs 5
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def time_import(runs: int):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET],
+            capture_output=True, text=True, check=True, env=os.environ.copy()
+        ).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return samples
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_ready(runs: int, timeout: float):
+    samples = []
+    for _ in range(runs):
+        port = _free_port()
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            while True:
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError(f"worker not ready after {timeout}s")
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/health/ready", timeout=1) as response:
+                        if response.status == 200:
+                            break
+                except (urllib.error.URLError, ConnectionError):
+                    pass
+                time.sleep(0.02)
+            samples.append(time.perf_counter() - start)
+        finally:
+            server.terminate()
+            server.wait()
+    return samples
+
+
+def report(label: str, samples):
+    print(f"{label:<16} median {statistics.median(samples) * 1000:8.1f} ms   "
+          f"min {min(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--skip-ready", action="store_true", help="only time the import")
+    args = parser.parse_args()
+
+    report("import main", time_import(args.runs))
+    if not args.skip_ready:
+        report("ready", time_ready(args.runs, args.timeout))
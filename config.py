@@ -0,0 +1,4 @@
+"""Loads .env once; every module that reads the environment imports this first"""
+from dotenv import load_dotenv
+
+load_dotenv()
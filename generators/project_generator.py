@@ -2,9 +2,11 @@ from jinja2 import Environment, FileSystemLoader
 from models.project import FlutterProject, Page
 from generators.widget_generator import WidgetGenerator
 from utils.converters import hex_to_dart_color
+from services.workspaces import workspaces, safe_name
+from services.archives import ArchiveFormat, ZIP
+from services.exports import Manifest, ProjectExport, write_export
+from typing import Optional, Tuple
 import os
-import zipfile
-import tempfile
 import shutil
 
 class ProjectGenerator:
@@ -12,14 +14,24 @@ class ProjectGenerator:
         self.env = Environment(loader=FileSystemLoader(template_dir))
         self.widget_generator = WidgetGenerator(template_dir)
     
-    def generate_flutter_project(self, project: FlutterProject) -> str:
-        """Generate complete Flutter project and return ZIP file path"""
-        # Create temporary directory for the project
-        temp_dir = tempfile.mkdtemp()
-        project_name = project.name.lower().replace(' ', '_')
-        project_dir = os.path.join(temp_dir, project_name)
-        
-        try:
+    def warmup(self):
+        """Load and compile every template up front (Jinja caches them per environment)"""
+        for env in (self.env, self.widget_generator.env):
+            for name in env.list_templates():
+                env.get_template(name)
+    
+    def generate_flutter_project(self, project: FlutterProject, archive_format: ArchiveFormat = ZIP,
+                                 base: Optional[Tuple[str, Manifest]] = None) -> ProjectExport:
+        """Generate complete Flutter project and archive it (ZIP by default), or
+        only what changed since ``base`` (id and manifest of an earlier export).
+
+        Everything is written to a private workspace (see services/workspaces.py),
+        removed on error or by cleanup_temp_files once the archive has been sent.
+        The same project always gives the same archive.
+        """
+        with workspaces.create() as workspace:
+            project_dir = workspace.join(safe_name(project.name.lower().replace(' ', '_')))
+
             # Copy base template instead of using flutter create
             self._copy_base_template(project_dir)
             
@@ -28,16 +40,10 @@ class ProjectGenerator:
             self._generate_pages(project, project_dir)
             self._update_pubspec(project, project_dir)
             
-            # Create ZIP file
-            zip_path = self._create_zip(project_dir, project.name)
-            
-            return zip_path
-            
-        except Exception as e:
-            # Clean up on error
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-            raise e
+            # Create ZIP (or tar.zst) file
+            export = self._create_archive(project_dir, project.name, archive_format, base)
+            workspace.measure()
+            return export
     
     def _copy_base_template(self, project_dir: str):
         """Copy the base Flutter template to project directory"""
@@ -180,28 +186,12 @@ class ProjectGenerator:
         with open(page_path, 'w', encoding='utf-8') as f:
             f.write(content)
     
-    def _create_zip(self, project_dir: str, project_name: str) -> str:
-        """Create ZIP file from project directory"""
-        zip_path = os.path.join(tempfile.gettempdir(), f"{project_name}.zip")
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(project_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Calculate relative path for the zip
-                    relative_path = os.path.relpath(file_path, project_dir)
-                    zipf.write(file_path, relative_path)
-        
-        return zip_path
+    def _create_archive(self, project_dir: str, project_name: str, archive_format: ArchiveFormat = ZIP,
+                        base: Optional[Tuple[str, Manifest]] = None) -> ProjectExport:
+        """Create the archive of the project directory, next to it (in its workspace)"""
+        archive_path = os.path.join(os.path.dirname(project_dir), f"{safe_name(project_name)}{archive_format.extension}")
+        return write_export(project_dir, archive_path, archive_format, base)
     
-    def cleanup_temp_files(self, zip_path: str):
-        """Clean up temporary files after sending ZIP"""
-        try:
-            if os.path.exists(zip_path):
-                os.remove(zip_path)
-            # Also clean up the temp directory if it still exists
-            temp_dir = os.path.dirname(os.path.dirname(zip_path))
-            if os.path.exists(temp_dir) and 'tmp' in temp_dir:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-        except Exception as e:
-            print(f"Warning: Could not clean up temporary files: {e}")
+    def cleanup_temp_files(self, archive_path: str):
+        """Remove the workspace of an archive once it has been sent"""
+        workspaces.release_path(archive_path)
@@ -0,0 +1,107 @@
+from models.project import Position, Size
+from utils.converters import convert_position_to_fractions
+from xml.sax.saxutils import quoteattr
+from typing import Any, Dict, Optional
+import math
+import re
+
+_HEX_COLOR = re.compile(r"^#?([0-9a-fA-F]{6}|[0-9a-fA-F]{3})$")
+
+# Fallback fills when a widget has no usable colour property
+TYPE_COLORS = {
+    'text': '#9E9E9E',
+    'button': '#2196F3',
+    'textfield': '#E0E0E0',
+    'image': '#B0BEC5',
+    'container': '#ECEFF1',
+    'icon': '#607D8B',
+    'table': '#CFD8DC',
+    'appbar': '#2196F3',
+    'bottomnavbar': '#FAFAFA',
+}
+DEFAULT_COLOR = '#BDBDBD'
+
+# Bars docked by the generated Scaffold rather than positioned
+APPBAR_HEIGHT = 56.0
+BOTTOMNAV_HEIGHT = 56.0
+
+
+def _dimension(value: Any, default: float) -> float:
+    """A stored screen size as a positive number, ``default`` for anything else ("390px", -1, None...)"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    return number if math.isfinite(number) and number > 0 else default
+
+
+def _color(value: Any) -> Optional[str]:
+    if isinstance(value, str) and _HEX_COLOR.match(value):
+        return quoteattr(value if value.startswith('#') else f"#{value}")
+    return None
+
+
+class ThumbnailGenerator:
+    """Renders a page as a small SVG wireframe: one box per top-level widget"""
+
+    def __init__(self, width: int = 180):
+        self.width = width
+
+    def render_page(self, page: Dict[str, Any]) -> str:
+        screen_width = _dimension(page.get('screen_width'), 390.0)
+        screen_height = _dimension(page.get('screen_height'), 844.0)
+        height = max(round(self.width * screen_height / screen_width), 1)
+        background = _color(page.get('background_color')) or '"#FFFFFF"'
+
+        shapes = []
+        for widget in page.get('widgets') or []:
+            if isinstance(widget, dict):
+                shape = self._render_widget(widget, screen_width, screen_height, height)
+                if shape:
+                    shapes.append(shape)
+
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{height}" '
+            f'viewBox="0 0 {self.width} {height}">'
+            f'<rect width="100%" height="100%" fill={background}/>'
+            + "".join(shapes)
+            + '</svg>'
+        )
+
+    def _render_widget(self, widget: dict, screen_width: float, screen_height: float, height: int) -> Optional[str]:
+        widget_type = widget.get('type')
+        props = widget.get('properties') if isinstance(widget.get('properties'), dict) else {}
+        fill = (
+            _color(props.get('backgroundColor'))
+            or _color(props.get('color'))
+            or quoteattr(TYPE_COLORS.get(widget_type, DEFAULT_COLOR))
+        )
+
+        if widget_type == 'appbar':
+            box = {'left': 0.0, 'top': 0.0, 'width': 1.0, 'height': APPBAR_HEIGHT / screen_height}
+        elif widget_type == 'bottomnavbar':
+            bar = BOTTOMNAV_HEIGHT / screen_height
+            box = {'left': 0.0, 'top': 1.0 - bar, 'width': 1.0, 'height': bar}
+        else:
+            try:
+                box = convert_position_to_fractions(
+                    Position(**(widget.get('position') or {})),
+                    Size(**widget['size']),
+                    screen_width, screen_height
+                )
+            except Exception:
+                return None  # Widgets without a usable position/size are skipped
+
+        x = max(0.0, min(box['left'], 1.0)) * self.width
+        y = max(0.0, min(box['top'], 1.0)) * height
+        w = max(0.0, min(box['width'], 1.0 - x / self.width)) * self.width
+        h = max(0.0, min(box['height'], 1.0 - y / height)) * height
+        if w < 0.5 or h < 0.5:
+            return None
+
+        if widget_type == 'text':
+            # A text line is drawn as a thin bar in its colour
+            fill = _color(props.get('color')) or _color(props.get('textColor')) or quoteattr(TYPE_COLORS['text'])
+            h = min(h, max(2.0, height * 0.012))
+        radius = ' rx="3"' if widget_type in ('button', 'textfield', 'chip') else ''
+        return f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}"{radius} fill={fill}/>'
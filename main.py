@@ -1,23 +1,51 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, File, UploadFile, Form, status
+from fastapi import FastAPI, HTTPException, BackgroundTasks, File, UploadFile, Form, Header, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel
 from typing import Dict, Any, Optional
+from sqlalchemy import text
 from models.project import FlutterProject
-from generators.project_generator import ProjectGenerator
-from services.ai_generator import AIProjectGenerator
-from services.image_service import ImageService
-from models.database import engine, Base
-from models.user_project_access import UserProjectAccess  # Import para crear tabla
+from models.database import engine
+from models.migrations import migrate, pending_migrations
 from routers import auth, projects, collaboration
+from services.metrics import metrics
+from services.providers import get_project_generator, get_ai_generator, get_image_service, warmup
+from services.collab_rooms import hub as collab_hub
+from services.workspaces import workspaces, safe_name, WorkspaceQuotaExceeded
+from services.archives import ArchiveFormat, negotiate as negotiate_archive
+from services.exports import ProjectExport, load_base, save_manifest
+import asyncio
+import logging
 import os
 import base64
 import io
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Migrations normally run as a separate release step (python migrate.py);
+# set this for local development to apply them when the app starts
+RUN_MIGRATIONS_ON_STARTUP = os.getenv("RUN_MIGRATIONS_ON_STARTUP", "").lower() in ("1", "true", "yes")
+READINESS_DB_TIMEOUT = float(os.getenv("READINESS_DB_TIMEOUT", "2"))
+# Level of the app's own loggers (collaboration handshakes, backplane...);
+# lines are "<time> <level> <logger> <event> key=value ..."
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
 app = FastAPI(title="Flutter Code Generator", description="Generate Flutter apps from JSON configuration")
 
+@app.on_event("startup")
+async def startup():
+    """Optionally migrate, then warm caches in the background (see /health/ready)"""
+    if RUN_MIGRATIONS_ON_STARTUP:
+        await migrate(engine)
+    app.state.warmup = asyncio.create_task(asyncio.to_thread(warmup))
+    app.state.janitor = asyncio.create_task(workspaces.run_janitor())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop listening for other nodes' collaboration messages"""
+    app.state.janitor.cancel()
+    await collab_hub.close()
+
 # Include routers
 app.include_router(auth.router)
 app.include_router(projects.router)
@@ -30,13 +58,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Export-Manifest", "X-Export-Base"],
 )
 
-# Initialize project generator
-project_generator = ProjectGenerator()
-ai_generator = AIProjectGenerator()
-image_service = ImageService()
-
 # Modelo para el prompt
 class AIPromptRequest(BaseModel):
     prompt: str
@@ -51,22 +75,79 @@ class EnhanceProjectRequest(BaseModel):
     project: Dict[str, Any]
     description: str
 
+def archive_response(export: ProjectExport, name: str, archive_format: ArchiveFormat) -> FileResponse:
+    """Download of a generated project; the format depends on the request's Accept header.
+
+    X-Export-Manifest identifies this export: sent back as ``?since=`` it
+    gets a delta archive, marked with X-Export-Base.
+    """
+    filename = f"{name}_delta{archive_format.extension}" if export.is_delta else f"{name}{archive_format.extension}"
+    headers = {"Content-Disposition": f"attachment; filename={filename}", "Vary": "Accept", "X-Export-Manifest": export.manifest_id}
+    if export.is_delta:
+        headers["X-Export-Base"] = export.base_id
+    return FileResponse(
+        path=export.path,
+        filename=filename,
+        media_type=archive_format.media_type,
+        headers=headers
+    )
+
+@app.get("/metrics")
+async def get_metrics():
+    """Expose in-process metrics (pool waits, caches, queues)"""
+    return metrics.snapshot()
+
+@app.get("/health/live")
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Ready once warmup has finished, the database answers and no migration is pending"""
+    checks = {}
+    task = getattr(app.state, "warmup", None)
+    if task is None or not task.done():
+        checks["warmup"] = "running"
+    elif task.exception() is not None:
+        checks["warmup"] = f"failed: {task.exception()}"
+    else:
+        checks["warmup"] = "ok"
+
+    async def check_database():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            return await pending_migrations(conn)
+
+    try:
+        pending = await asyncio.wait_for(check_database(), READINESS_DB_TIMEOUT)
+        checks["database"] = "ok"
+        checks["migrations"] = "ok" if not pending else f"pending: {', '.join(pending)}"
+    except Exception as e:
+        checks["database"] = f"unavailable: {e.__class__.__name__}"
+
+    ready = all(value == "ok" for value in checks.values()) and "migrations" in checks
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "ready" if ready else "not_ready", "checks": checks}
+    )
+
 @app.post("/generate-flutter-app")
-async def generate_flutter_app(project: FlutterProject, background_tasks: BackgroundTasks):
+async def generate_flutter_app(project: FlutterProject, background_tasks: BackgroundTasks, accept: Optional[str] = Header(None), since: Optional[str] = None):
     """Generate Flutter app from JSON configuration"""
     try:
-        zip_path = project_generator.generate_flutter_project(project)
+        project_generator = get_project_generator()
+        archive_format = negotiate_archive(accept)
+        export = await asyncio.to_thread(project_generator.generate_flutter_project, project, archive_format, await load_base(since))
+        await save_manifest(export)
         
         # Add cleanup task to background tasks
-        background_tasks.add_task(project_generator.cleanup_temp_files, zip_path)
+        background_tasks.add_task(project_generator.cleanup_temp_files, export.path)
         
-        return FileResponse(
-            path=zip_path,
-            filename=f"{project.name.lower().replace(' ', '_')}_flutter_app.zip",
-            media_type='application/zip',
-            headers={"Content-Disposition": f"attachment; filename={project.name.lower().replace(' ', '_')}_flutter_app.zip"}
-        )
+        return archive_response(export, f"{project.name.lower().replace(' ', '_')}_flutter_app", archive_format)
     
+    except WorkspaceQuotaExceeded as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating Flutter app: {str(e)}")
 
@@ -74,6 +155,7 @@ async def generate_flutter_app(project: FlutterProject, background_tasks: Backgr
 async def generate_json_from_prompt(request: AIPromptRequest):
     """Generate JSON configuration from AI prompt for preview"""
     try:
+        ai_generator = get_ai_generator()
         # Generar proyecto usando AI
         project_data = ai_generator.generate_project_from_prompt(request.prompt)
         
@@ -91,6 +173,7 @@ async def generate_json_from_prompt(request: AIPromptRequest):
 async def generate_image(request: ImageGenerationRequest):
     """Generate and upload image to S3 using DALL-E"""
     try:
+        image_service = get_image_service()
         image_url = image_service.generate_and_upload_image(request.prompt, request.image_type)
         return {
             "success": True,
@@ -104,6 +187,7 @@ async def generate_image(request: ImageGenerationRequest):
 async def generate_json_from_image(image: UploadFile = File(...)):
     """Generate JSON configuration from UI image"""
     try:
+        ai_generator = get_ai_generator()
         # Leer y convertir la imagen a base64
         image_content = await image.read()
         image_base64 = base64.b64encode(image_content).decode("utf-8")
@@ -122,9 +206,11 @@ async def generate_json_from_image(image: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error generating JSON from image: {str(e)}")
 
 @app.post("/generate-from-image")
-async def generate_from_image(background_tasks: BackgroundTasks, image: UploadFile = File(...)):
+async def generate_from_image(background_tasks: BackgroundTasks, image: UploadFile = File(...), accept: Optional[str] = Header(None), since: Optional[str] = None):
     """Generate complete Flutter app from UI image"""
     try:
+        project_generator = get_project_generator()
+        ai_generator = get_ai_generator()
         # Leer y convertir la imagen a base64
         image_content = await image.read()
         image_base64 = base64.b64encode(image_content).decode("utf-8")
@@ -138,18 +224,17 @@ async def generate_from_image(background_tasks: BackgroundTasks, image: UploadFi
         
         # Crear un proyecto Flutter a partir del JSON
         project = FlutterProject(**project_data)
-        zip_path = project_generator.generate_flutter_project(project)
+        archive_format = negotiate_archive(accept)
+        export = await asyncio.to_thread(project_generator.generate_flutter_project, project, archive_format, await load_base(since))
+        await save_manifest(export)
         
         # Add cleanup task to background tasks
-        background_tasks.add_task(project_generator.cleanup_temp_files, zip_path)
+        background_tasks.add_task(project_generator.cleanup_temp_files, export.path)
         
-        return FileResponse(
-            path=zip_path,
-            filename=f"{project.name.lower().replace(' ', '_')}_flutter_app.zip",
-            media_type='application/zip',
-            headers={"Content-Disposition": f"attachment; filename={project.name.lower().replace(' ', '_')}_flutter_app.zip"}
-        )
+        return archive_response(export, f"{project.name.lower().replace(' ', '_')}_flutter_app", archive_format)
     
+    except WorkspaceQuotaExceeded as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating Flutter app from image: {str(e)}")
 
@@ -157,6 +242,7 @@ async def generate_from_image(background_tasks: BackgroundTasks, image: UploadFi
 async def generate_json_from_audio(audio: UploadFile = File(...)):
     """Generate JSON configuration from audio description"""
     try:
+        ai_generator = get_ai_generator()
         # Validar que sea un archivo de audio
         allowed_audio_types = ["audio/mpeg", "audio/mp3", "audio/wav", "audio/m4a", "audio/ogg", "audio/flac"]
         if audio.content_type not in allowed_audio_types and not audio.filename.lower().endswith(('.mp3', '.wav', '.m4a', '.ogg', '.flac')):
@@ -182,9 +268,11 @@ async def generate_json_from_audio(audio: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error generating JSON from audio: {str(e)}")
 
 @app.post("/generate-from-audio")
-async def generate_from_audio(background_tasks: BackgroundTasks, audio: UploadFile = File(...)):
+async def generate_from_audio(background_tasks: BackgroundTasks, audio: UploadFile = File(...), accept: Optional[str] = Header(None), since: Optional[str] = None):
     """Generate complete Flutter app from audio description"""
     try:
+        project_generator = get_project_generator()
+        ai_generator = get_ai_generator()
         # Validar que sea un archivo de audio
         allowed_audio_types = ["audio/mpeg", "audio/mp3", "audio/wav", "audio/m4a", "audio/ogg", "audio/flac"]
         if audio.content_type not in allowed_audio_types and not audio.filename.lower().endswith(('.mp3', '.wav', '.m4a', '.ogg', '.flac')):
@@ -205,61 +293,61 @@ async def generate_from_audio(background_tasks: BackgroundTasks, audio: UploadFi
         
         # Crear un proyecto Flutter a partir del JSON
         project = FlutterProject(**project_data)
-        zip_path = project_generator.generate_flutter_project(project)
+        archive_format = negotiate_archive(accept)
+        export = await asyncio.to_thread(project_generator.generate_flutter_project, project, archive_format, await load_base(since))
+        await save_manifest(export)
         
         # Add cleanup task to background tasks
-        background_tasks.add_task(project_generator.cleanup_temp_files, zip_path)
+        background_tasks.add_task(project_generator.cleanup_temp_files, export.path)
         
-        return FileResponse(
-            path=zip_path,
-            filename=f"{project.name.lower().replace(' ', '_')}_flutter_app.zip",
-            media_type='application/zip',
-            headers={"Content-Disposition": f"attachment; filename={project.name.lower().replace(' ', '_')}_flutter_app.zip"}
-        )
+        return archive_response(export, f"{project.name.lower().replace(' ', '_')}_flutter_app", archive_format)
     
+    except WorkspaceQuotaExceeded as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating Flutter app from audio: {str(e)}")
 
 @app.post("/generate-functional-app-from-json")
-async def generate_functional_app_from_json(request: EnhanceProjectRequest, background_tasks: BackgroundTasks):
+async def generate_functional_app_from_json(request: EnhanceProjectRequest, background_tasks: BackgroundTasks, accept: Optional[str] = Header(None), since: Optional[str] = None):
     """Generate completely functional Flutter app from JSON project + AI description"""
     try:
+        project_generator = get_project_generator()
+        ai_generator = get_ai_generator()
         # Generar código Dart funcional usando AI
         dart_code = ai_generator.generate_dart_code_from_project(request.project, request.description)
         
-        # Crear directorio temporal para el proyecto
-        import tempfile
-        temp_dir = tempfile.mkdtemp()
-        
         # Obtener nombre del proyecto
         project_name = request.project.get('name', 'flutter_app').lower().replace(' ', '_')
-        project_dir = os.path.join(temp_dir, project_name)
-        
-        # Crear estructura base del proyecto Flutter
-        project_generator._copy_base_template(project_dir)
-        
-        # Asegurar que el directorio lib existe
-        lib_dir = os.path.join(project_dir, "lib")
-        os.makedirs(lib_dir, exist_ok=True)
-        
-        # Escribir el código Dart funcional generado por AI
-        main_dart_path = os.path.join(lib_dir, "main.dart")
-        with open(main_dart_path, 'w', encoding='utf-8') as f:
-            f.write(dart_code)
         
-        # Crear archivo ZIP
-        zip_path = project_generator._create_zip(project_dir, project_name)
+        # Workspace propio para el proyecto (se borra si algo falla)
+        with workspaces.create() as workspace:
+            project_dir = workspace.join(safe_name(project_name))
+            
+            # Crear estructura base del proyecto Flutter
+            await asyncio.to_thread(project_generator._copy_base_template, project_dir)
+            
+            # Asegurar que el directorio lib existe
+            lib_dir = os.path.join(project_dir, "lib")
+            os.makedirs(lib_dir, exist_ok=True)
+            
+            # Escribir el código Dart funcional generado por AI
+            main_dart_path = os.path.join(lib_dir, "main.dart")
+            with open(main_dart_path, 'w', encoding='utf-8') as f:
+                f.write(dart_code)
+            
+            # Crear archivo ZIP (o tar.zst según Accept)
+            archive_format = negotiate_archive(accept)
+            export = await asyncio.to_thread(project_generator._create_archive, project_dir, project_name, archive_format, await load_base(since))
+            await asyncio.to_thread(workspace.measure)
+        await save_manifest(export)
         
         # Add cleanup task to background tasks
-        background_tasks.add_task(project_generator.cleanup_temp_files, zip_path)
+        background_tasks.add_task(project_generator.cleanup_temp_files, export.path)
         
-        return FileResponse(
-            path=zip_path,
-            filename=f"{project_name}_ai_functional_flutter_app.zip",
-            media_type='application/zip',
-            headers={"Content-Disposition": f"attachment; filename={project_name}_ai_functional_flutter_app.zip"}
-        )
+        return archive_response(export, f"{project_name}_ai_functional_flutter_app", archive_format)
     
+    except WorkspaceQuotaExceeded as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating functional Flutter app from JSON: {str(e)}")
 
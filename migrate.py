@@ -0,0 +1,17 @@
+"""Create tables and apply pending migrations (run once per deploy, before the web workers).
+
+    python migrate.py
+"""
+import asyncio
+from models.database import engine
+from models.migrations import migrate
+
+
+async def main():
+    applied = await migrate(engine)
+    await engine.dispose()
+    print(f"Applied migrations: {', '.join(applied)}" if applied else "Database is up to date")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, BigInteger, Text, DateTime, Index
+from sqlalchemy.sql import func
+from models.database import Base
+
+
+class CollabMessage(Base):
+    """Collaboration messages too large for a NOTIFY payload (payload is a
+    JSON array of the published messages).
+
+    The backplane notifies only the row id; rows are deleted once every
+    node has had time to read them (see services/collab_backplane.py).
+    """
+    __tablename__ = "collab_message"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    room = Column(Text, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_collab_message_created_at", "created_at"),
+    )
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, ForeignKey, Integer, Text, DateTime
+from sqlalchemy.dialects.postgresql import UUID
+from models.database import Base
+
+
+class CollabRoomLease(Base):
+    """Which node holds the authoritative document of a collaboration room.
+
+    The lease is renewed while the room is active; another node may take
+    it over once it expires, which bumps ``epoch``.
+    """
+    __tablename__ = "collab_room_lease"
+
+    project_id = Column(UUID(as_uuid=True), ForeignKey("project.id", ondelete="CASCADE"), primary_key=True)
+    node_id = Column(Text, nullable=False)
+    epoch = Column(Integer, nullable=False, default=1)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -1,23 +1,110 @@
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
-from dotenv import load_dotenv
+import time
+import config  # noqa: F401  (loads .env)
+from services.metrics import metrics
 
-load_dotenv()
 
 # Database URL from environment
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional streaming replica for read-only endpoints (see services/db_routing.py)
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# Fail fast on an unreachable replica so reads fall back to the primary
+DB_REPLICA_CONNECT_TIMEOUT = float(os.getenv("DB_REPLICA_CONNECT_TIMEOUT", "2"))
+
+# Connection pool configuration
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def to_async_url(url: str) -> str:
+    """Rewrite a postgres URL so SQLAlchemy uses the asyncpg driver"""
+    if url is None:
+        return url
+    for prefix in ("postgres://", "postgresql://", "postgresql+psycopg2://"):
+        if url.startswith(prefix):
+            url = "postgresql+asyncpg://" + url[len(prefix):]
+            break
+    # asyncpg does not understand libpq's sslmode parameter
+    return url.replace("sslmode=", "ssl=")
+
+
+def to_dsn(url: str) -> str:
+    """Plain postgresql:// URL for opening asyncpg connections directly"""
+    if url is None:
+        return url
+    for prefix in ("postgres://", "postgresql+asyncpg://", "postgresql+psycopg2://"):
+        if url.startswith(prefix):
+            url = "postgresql://" + url[len(prefix):]
+            break
+    return url
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waits for a connection"""
+
+    metrics_prefix = "db_pool"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe(f"{self.metrics_prefix}_checkout_wait_seconds", time.perf_counter() - start)
+            self._record_usage()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._record_usage()
+
+    def _record_usage(self):
+        metrics.set_gauge(f"{self.metrics_prefix}_checked_out", self.checkedout())
+        metrics.set_gauge(f"{self.metrics_prefix}_overflow", max(self.overflow(), 0))
+
+
+class ReplicaPool(InstrumentedPool):
+    metrics_prefix = "db_replica_pool"
+
+
+def create_engine_for(url: str, poolclass=InstrumentedPool, **kwargs):
+    """Build an async engine with the configured pool settings"""
+    return create_async_engine(
+        to_async_url(url),
+        echo=False,
+        poolclass=poolclass,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        **kwargs,
+    )
+
 
 # SQLAlchemy
-engine = create_engine(DATABASE_URL,echo=False,future=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine_for(DATABASE_URL)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+replica_engine = None
+ReplicaSessionLocal = None
+if DATABASE_REPLICA_URL:
+    replica_engine = create_engine_for(
+        DATABASE_REPLICA_URL,
+        poolclass=ReplicaPool,
+        connect_args={"timeout": DB_REPLICA_CONNECT_TIMEOUT},
+    )
+    ReplicaSessionLocal = async_sessionmaker(
+        replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+
+# Dependency (primary only; routers use services.db_routing, which adds
+# read-your-writes tracking and the replica-aware get_read_db)
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Text, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import func
+from models.database import Base
+
+
+class ExportManifest(Base):
+    """Content hashes of the files of a generated project export
+    (``files`` maps each path to its sha256).
+
+    ``id`` is the hash of ``files`` itself, so identical exports share a
+    row. Clients send it back to get a delta against that export; rows
+    unused for EXPORT_MANIFEST_TTL are deleted (see services/exports.py).
+    """
+    __tablename__ = "export_manifest"
+
+    id = Column(Text, primary_key=True)
+    files = Column(JSONB, nullable=False)
+    used_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_export_manifest_used_at", "used_at"),
+    )
@@ -0,0 +1,73 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from typing import List, Tuple
+from models.database import Base
+from models.user import WIDGET_TYPES_SQL, WIDGET_TEXT_SQL
+# Every model module must be imported for create_all to see its table
+from models import user, user_project_access, project_version, collab_message, collab_room_lease, export_manifest  # noqa: F401
+
+# Ordered, append-only list of schema changes for databases created before
+# the corresponding model change. Every statement must be idempotent so a
+# fresh database (already built by create_all) can run them safely.
+MIGRATIONS: List[Tuple[str, List[str]]] = [
+    ("0001_access_lookup_indexes", [
+        'CREATE INDEX IF NOT EXISTS ix_project_owner_id_updated_at ON project (owner_id, updated_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_user_project_access_project_id ON user_project_access (project_id)',
+    ]),
+    ("0002_project_version", [
+        'ALTER TABLE project ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1',
+    ]),
+    ("0003_project_search_indexes", [
+        f'CREATE INDEX IF NOT EXISTS ix_project_widget_types ON project USING gin (({WIDGET_TYPES_SQL}))',
+        f'CREATE INDEX IF NOT EXISTS ix_project_widget_text ON project USING gin (({WIDGET_TEXT_SQL}))',
+        # pg_trgm is optional: without it name search still works, unindexed
+        "DO $$ BEGIN "
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+        "CREATE INDEX IF NOT EXISTS ix_project_name_trgm ON project USING gin (name gin_trgm_ops); "
+        "EXCEPTION WHEN OTHERS THEN RAISE NOTICE 'pg_trgm unavailable, skipping ix_project_name_trgm'; "
+        "END $$",
+    ]),
+]
+
+
+async def run_migrations(conn: AsyncConnection) -> List[str]:
+    """Apply pending migrations inside the caller's transaction and return their ids"""
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " id TEXT PRIMARY KEY,"
+        " applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    ))
+    # Serialize concurrent workers running migrations at the same time
+    await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))"))
+
+    result = await conn.execute(text("SELECT id FROM schema_migrations"))
+    applied = {row.id for row in result}
+
+    newly_applied = []
+    for migration_id, statements in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        for statement in statements:
+            await conn.execute(text(statement))
+        await conn.execute(
+            text("INSERT INTO schema_migrations (id) VALUES (:id)"),
+            {"id": migration_id}
+        )
+        newly_applied.append(migration_id)
+    return newly_applied
+
+
+async def pending_migrations(conn: AsyncConnection) -> List[str]:
+    """Ids of migrations not applied yet (all of them on a fresh database)"""
+    exists = (await conn.execute(text("SELECT to_regclass('schema_migrations') IS NOT NULL"))).scalar()
+    applied = set()
+    if exists:
+        applied = {row.id for row in await conn.execute(text("SELECT id FROM schema_migrations"))}
+    return [migration_id for migration_id, _ in MIGRATIONS if migration_id not in applied]
+
+
+async def migrate(engine: AsyncEngine) -> List[str]:
+    """Create missing tables and apply pending migrations in one transaction"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        return await run_migrations(conn)
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, ForeignKey, Integer, Text, DateTime
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.sql import func
+from models.database import Base
+
+
+class ProjectVersion(Base):
+    __tablename__ = "project_version"
+
+    project_id = Column(UUID(as_uuid=True), ForeignKey("project.id", ondelete="CASCADE"), primary_key=True)
+    version = Column(Integer, primary_key=True)
+    # 'snapshot': payload is the full data document
+    # 'delta': payload is the RFC 6902 patch from version - 1
+    kind = Column(Text, nullable=False)
+    payload = Column(JSONB, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import Any, List, Optional
 from datetime import datetime
 import uuid
 
@@ -50,6 +50,71 @@ class Project(ProjectBase):
     owner_id: uuid.UUID
     created_at: datetime
     updated_at: datetime
+    version: int
     
     class Config:
         from_attributes = True
+
+
+class ProjectSummary(BaseModel):
+    id: uuid.UUID
+    name: str
+    owner_id: uuid.UUID
+    created_at: datetime
+    updated_at: datetime
+    version: int
+
+    class Config:
+        from_attributes = True
+
+
+class PageIndexEntry(BaseModel):
+    id: Optional[str] = None
+    name: Optional[str] = None
+    route: Optional[str] = None
+    widget_count: int = 0
+
+
+class ProjectPageIndex(ProjectSummary):
+    document: Optional[dict] = None  # project data without the pages array
+    pages: List[PageIndexEntry]
+
+
+class JsonPatchOperation(BaseModel):
+    """One RFC 6902 operation"""
+    op: str
+    path: str
+    value: Any = None
+    from_: Optional[str] = Field(None, alias="from")
+
+
+class ProjectVersionInfo(BaseModel):
+    version: int
+    kind: str
+    created_at: datetime
+    size: int
+
+    class Config:
+        from_attributes = True
+
+
+class ProjectVersionData(BaseModel):
+    version: int
+    data: Optional[Any] = None
+
+
+# Upper bound on projects written by one bulk request
+MAX_BULK_PROJECTS = 1000
+# Upper bound on copies of each source in one duplicate request
+MAX_DUPLICATE_COPIES = 100
+
+
+class ProjectBulkCreate(BaseModel):
+    projects: List[ProjectCreate] = Field(..., min_length=1, max_length=MAX_BULK_PROJECTS)
+
+
+class ProjectDuplicate(BaseModel):
+    """Copy every source project ``copies`` times into the caller's account"""
+    project_ids: List[uuid.UUID] = Field(..., min_length=1)
+    copies: int = Field(1, ge=1, le=MAX_DUPLICATE_COPIES)
+    name: Optional[str] = None
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Text, UUID
+from sqlalchemy import Column, String, DateTime, Text, UUID, Index, Integer
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from .database import Base
@@ -16,6 +16,26 @@ class User(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
 
+# Search index expressions over project.data (created by migration
+# 0003_project_search_indexes). Queries must repeat them verbatim as SQL
+# literals, not bind parameters, or the planner cannot match the indexes.
+_WIDGETS_PATH = 'strict $.pages[*].widgets.** ? (@.type() == "object" && exists(@.id) && exists(@.type))'
+_TEXT_PROPERTIES = ("text", "label", "title", "placeholder", "columns", "rows", "items")
+_TEXT_OF_WIDGET = (
+    ".properties.keyvalue() ? ("
+    + " || ".join(f'@.key == "{key}"' for key in _TEXT_PROPERTIES)
+    + ').value.** ? (@.type() == "string")'
+)
+_TEXT_PATH = _WIDGETS_PATH + _TEXT_OF_WIDGET
+# Every widget type, nested children included, e.g. ["table", "text"]
+WIDGET_TYPES_SQL = f"jsonb_path_query_array(data, '{_WIDGETS_PATH}.type', '{{}}', true)"
+# Full-text vector of the user-visible widget strings
+WIDGET_TEXT_SQL = f"to_tsvector('simple', jsonb_path_query_array(data, '{_TEXT_PATH}', '{{}}', true))"
+# Visible strings of the widgets whose type is in the $types variable. Not
+# indexed: it only rechecks rows the two indexes above already matched
+WIDGET_TEXT_OF_TYPES_PATH = _WIDGETS_PATH + " ? (@.type == $types[*])" + _TEXT_OF_WIDGET
+
+
 class Project(Base):
     __tablename__ = "project"
     
@@ -25,3 +45,10 @@ class Project(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
     data = Column(JSONB, nullable=True)
+    # Bumped on every write; drives ETags and If-Match preconditions
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __table_args__ = (
+        # Owner lookups and the keyset ordering used by the project list
+        Index("ix_project_owner_id_updated_at", "owner_id", "updated_at", "id"),
+    )
@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, ForeignKey, TIMESTAMP
+from sqlalchemy import Column, ForeignKey, TIMESTAMP, Index
 from sqlalchemy.dialects.postgresql import UUID
 from models.database import Base
 
@@ -9,3 +9,9 @@ class UserProjectAccess(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
     project_id = Column(UUID(as_uuid=True), ForeignKey("project.id", ondelete="CASCADE"), primary_key=True)
     granted_at = Column(TIMESTAMP, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # The primary key leads with user_id; per-project lookups and the
+        # ON DELETE CASCADE from project need their own index
+        Index("ix_user_project_access_project_id", "project_id"),
+    )
@@ -1,22 +1,31 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
-from models.database import get_db
+from services.db_routing import get_db
 from models.schemas import UserCreate, UserLogin, User, Token
 from services.user_service import UserService
-from services.auth_service import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
+from services.auth_service import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, PasswordHasherBusy
 from services.dependencies import get_current_user
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 security = HTTPBearer()
 
 
+def _hasher_busy(exc: PasswordHasherBusy) -> HTTPException:
+    """429 response telling the client when to retry a login or registration"""
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many authentication requests, please retry later",
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 @router.post("/register", response_model=User, status_code=status.HTTP_201_CREATED)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """Register a new user"""
     # Check if user already exists
-    existing_user = UserService.get_user_by_email(db, user.email)
+    existing_user = await UserService.get_user_by_email(db, user.email)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -24,7 +33,10 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Create new user
-    db_user = UserService.create_user(db, user)
+    try:
+        db_user = await UserService.create_user(db, user)
+    except PasswordHasherBusy as exc:
+        raise _hasher_busy(exc)
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -35,10 +47,13 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
 
 
 @router.post("/login", response_model=Token)
-async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     """Login user and return JWT token"""
     # Authenticate user
-    user = UserService.authenticate_user(db, user_credentials.email, user_credentials.password)
+    try:
+        user = await UserService.authenticate_user(db, user_credentials.email, user_credentials.password)
+    except PasswordHasherBusy as exc:
+        raise _hasher_busy(exc)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,107 +1,105 @@
+import json
+import logging
+import time
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
 from uuid import UUID
-from sqlalchemy.exc import IntegrityError
-from datetime import datetime
-from starlette.websockets import WebSocketState
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
-from models.database import SessionLocal
-from models.user_project_access import UserProjectAccess
-from models.user import User
-from services.auth_service import decode_token
+from services.auth_cache import get_token_subject
+from services.collab_batching import BATCH_SUBPROTOCOL
+from services.collab_codecs import negotiate
+from services.collab_documents import parse_position
+from services.collab_rooms import hub
+from services.dependencies import load_user
+from services.metrics import metrics
+from services.project_access import ensure_access
 
 router = APIRouter(prefix="/collaboration", tags=["Realtime"])
-_rooms = {}
+logger = logging.getLogger(__name__)
+
+
+async def _reject(ws: WebSocket, project_id: UUID, reason: str, started: float):
+    metrics.inc("collab_handshakes_rejected")
+    metrics.observe("collab_handshake_seconds", time.perf_counter() - started)
+    logger.info("collab handshake rejected project=%s reason=%s", project_id, reason)
+    await ws.close(code=status.WS_1008_POLICY_VIOLATION)
 
-def db():
-    d = SessionLocal()
-    try:
-        yield d
-    finally:
-        d.close()
 
 @router.websocket("/{project_id}/ws")
 async def project_ws(ws: WebSocket, project_id: UUID):
-    print(f"WebSocket connection attempt for project: {project_id}")
-    print(f"Headers: {dict(ws.headers)}")
-    
-    proto_hdr = ws.headers.get("sec-websocket-protocol", "")
-    print(f"Protocol header: {proto_hdr}")
-    
-    client_proto = proto_hdr.split(",")[0].strip()  # ej. "jwt.eyJhbGciOiJI..."
-    print(f"Client protocol: {client_proto}")
-
+    started = time.perf_counter()
+    offered = [p.strip() for p in ws.headers.get("sec-websocket-protocol", "").split(",")]
+    client_proto = offered[0]  # ej. "jwt.eyJhbGciOiJI..."
     if not client_proto.startswith("jwt."):
-        print("Protocol validation failed: doesn't start with jwt.")
-        await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+        await _reject(ws, project_id, "no_jwt_protocol", started)
         return
 
-    token = client_proto[4:]                        # quita "jwt."
-    print(f"Extracted token: {token[:20]}...")  # Only show first 20 chars for security
-    
-    payload = decode_token(token)
-    print(f"Token payload: {payload}")
-    
-    if payload is None:
-        print("Token validation failed: payload is None")
-        await ws.close(code=status.WS_1008_POLICY_VIOLATION)
-        return
-    
-    # Extraer email del token y buscar el user_id en la base de datos
-    try:
-        user_email = payload["sub"]  # Asumiendo que "sub" contiene el email
-        print(f"User email: {user_email}")
-    except (KeyError, TypeError) as e:
-        print(f"Email extraction failed: {e}")
-        await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+    # Verified once per token and cached, like the REST endpoints
+    user_email = get_token_subject(client_proto[4:])   # quita "jwt."
+    if user_email is None:
+        await _reject(ws, project_id, "invalid_token", started)
         return
 
-    session = SessionLocal()
     try:
-        # Buscar el usuario por email para obtener su ID
-        user = session.query(User).filter(User.email == user_email).first()
-        if not user:
-            print(f"User not found with email: {user_email}")
-            await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+        user = await load_user(user_email)
+        if user is None:
+            await _reject(ws, project_id, "unknown_user", started)
             return
-        
-        user_id = user.id
-        print(f"User ID: {user_id}")
-        
+        auth_done = time.perf_counter()
+        metrics.observe("collab_handshake_auth_seconds", auth_done - started)
+
         # Verificar acceso al proyecto y otorgarlo si no existe
-        exists = (
-            session.query(UserProjectAccess)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .first()
-        )
-        if not exists:
-            print(f"User {user_email} doesn't have access to project {project_id}, granting access...")
-            session.add(UserProjectAccess(
-                user_id=user_id,
-                project_id=project_id,
-                granted_at=datetime.utcnow(),
-            ))
-            session.commit()
-            print("Access granted successfully!")
-        else:
-            print(f"User {user_email} already has access to project {project_id}")
-    except IntegrityError as e:
-        print(f"Error granting access: {e}")
-        session.rollback()
-    finally:
-        session.close()
+        if await ensure_access(project_id, user.id):
+            logger.info("collab access granted project=%s user=%s", project_id, user.id)
+        metrics.observe("collab_handshake_grant_seconds", time.perf_counter() - auth_done)
+    except IntegrityError:
+        await _reject(ws, project_id, "unknown_project", started)
+        return
+    except SQLAlchemyError as e:
+        metrics.inc("collab_handshakes_failed")
+        logger.warning("collab handshake failed project=%s error=%s", project_id, e)
+        await ws.close(code=status.WS_1011_INTERNAL_ERROR)
+        return
 
-    print("Accepting WebSocket connection...")
     await ws.accept(subprotocol=client_proto)
-    print("WebSocket connection accepted!")
+    metrics.inc("collab_handshakes")
+    metrics.observe("collab_handshake_seconds", time.perf_counter() - started)
+    logger.debug("collab connection accepted project=%s user=%s", project_id, user.id)
 
-    _rooms.setdefault(project_id, []).append(ws)
+    room = str(project_id)
+    # The jwt.* protocol is the one echoed back; extra tokens are options,
+    # and the ones taken are listed in a first text message
+    options = offered[1:]
+    batch = BATCH_SUBPROTOCOL in options
+    wire = negotiate(options)
+    if options:
+        accepted = ([BATCH_SUBPROTOCOL] if batch else []) + wire.options
+        await ws.send_text(json.dumps({"type": "welcome", "options": accepted}))
+    # ?resume=<epoch>:<seq> replays only what was missed since then
+    peer = await hub.join(
+        room, ws,
+        batch=batch,
+        position=parse_position(ws.query_params.get("resume")),
+        wire=wire,
+    )
     try:
         while True:
-            msg = await ws.receive_text()
-            for peer in _rooms[project_id]:
-                if peer is not ws:
-                    await peer.send_text(msg)
+            frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            msg = frame.get("text")
+            if msg is None:
+                try:
+                    msg = wire.decode(frame["bytes"])
+                except ValueError as e:
+                    metrics.inc("collab_frames_invalid")
+                    logger.info("collab frame rejected project=%s error=%s", project_id, e)
+                    if wire.codec is None:
+                        await ws.close(code=status.WS_1003_UNSUPPORTED_DATA)
+                        break
+                    continue
+            await hub.broadcast(room, msg, sender=peer)
     except WebSocketDisconnect:
-        _rooms[project_id].remove(ws)
-        if not _rooms[project_id]:
-            _rooms.pop(project_id, None)
\ No newline at end of file
+        pass
+    finally:
+        await hub.leave(room, peer)
@@ -1,86 +1,191 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, Dict, List, Optional
 import uuid
-from models.database import get_db
-from models.schemas import ProjectCreate, Project, User
+from services.db_routing import get_db, get_read_db
+from models.schemas import (
+    ProjectCreate, Project, ProjectSummary, ProjectPageIndex, JsonPatchOperation, User,
+    ProjectVersionInfo, ProjectVersionData, ProjectBulkCreate, ProjectDuplicate, MAX_BULK_PROJECTS
+)
 from services.user_service import ProjectService
+from services.project_history import ProjectHistoryService
+from services.project_search import search_conditions
+from services.thumbnails import get_thumbnail, invalidate_project
+from services.json_patch import validate_patch, JsonPatchError
+from services.project_pages import (
+    ProjectPageService, page_index_column, document_column, page_column, widget_column
+)
 from services.dependencies import get_current_user
+from services.project_access import authorize_project, get_access_cache
+from services.etags import make_etag, parse_etag_header, if_match_versions
 
 router = APIRouter(prefix="/projects", tags=["projects"])
 
 
+def _check_if_match(project, expected_versions):
+    """412 when an If-Match precondition does not hold for the stored version"""
+    if expected_versions is not None and project.version not in expected_versions:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Project has been modified since it was loaded",
+            headers={"ETag": make_etag(project.version)},
+        )
+
+
+async def _check_version_unchanged(db, project_id, user_id, expected_versions):
+    """After a conditional write matched nothing, 412 if the version moved on"""
+    if expected_versions is not None:
+        current = await ProjectService.get_project_with_access(db, project_id, user_id, include_data=False)
+        if current is not None:
+            _check_if_match(current, expected_versions)
+
+
+def _not_modified(project, if_none_match: Optional[str]) -> Optional[Response]:
+    """304 response when If-None-Match already names the current version"""
+    wildcard, known_versions = parse_etag_header(if_none_match)
+    if wildcard or project.version in known_versions:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": make_etag(project.version)})
+    return None
+
+
 @router.post("/", response_model=Project, status_code=status.HTTP_201_CREATED)
 async def create_project(
     project: ProjectCreate,
+    response: Response,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new project"""
-    return ProjectService.create_project(db, project, current_user.id)
+    created = await ProjectService.create_project(db, project, current_user.id)
+    response.headers["ETag"] = make_etag(created.version)
+    return created
 
 
-@router.get("/", response_model=List[Project])
-async def get_my_projects(
+@router.post("/bulk", response_model=List[ProjectSummary], status_code=status.HTTP_201_CREATED)
+async def create_projects(
+    body: ProjectBulkCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Get all projects for the current user (owned + collaborative)"""
-    from models.user_project_access import UserProjectAccess
-    from models.user import Project as ProjectModel
-    
-    # Proyectos propios
-    owned_projects = ProjectService.get_user_projects(db, current_user.id)
-    
-    # Proyectos colaborativos
-    collaborative_projects = db.query(ProjectModel).join(
-        UserProjectAccess,
-        ProjectModel.id == UserProjectAccess.project_id
-    ).filter(
-        UserProjectAccess.user_id == current_user.id
-    ).all()
-    
-    # Combinar y eliminar duplicados
-    all_projects = {}
-    
-    for project in owned_projects:
-        all_projects[str(project.id)] = project
-    
-    for project in collaborative_projects:
-        all_projects[str(project.id)] = project
-    
-    return list(all_projects.values())
+    db: AsyncSession = Depends(get_db)
+):
+    """Create many projects in one statement"""
+    return await ProjectService.create_projects(db, body.projects, current_user.id)
 
 
-@router.get("/{project_id}", response_model=Project)
-async def get_project(
-    project_id: uuid.UUID,
+@router.post("/bulk/duplicate", response_model=List[ProjectSummary], status_code=status.HTTP_201_CREATED)
+async def duplicate_projects(
+    body: ProjectDuplicate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get a specific project"""
-    project = ProjectService.get_project_by_id(db, project_id)
-    if not project:
+    """Duplicate projects server-side into the caller's own account"""
+    project_ids = list(dict.fromkeys(body.project_ids))
+    total = len(project_ids) * body.copies
+    if total > MAX_BULK_PROJECTS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"A bulk request may create at most {MAX_BULK_PROJECTS} projects ({total} requested)"
+        )
+
+    accessible = await ProjectService.get_accessible_project_ids(db, current_user.id, project_ids)
+    if len(accessible) != len(project_ids):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Project not found"
+            detail={"message": "Project not found", "project_ids": [str(pid) for pid in project_ids if pid not in accessible]}
         )
-    
-    # Check if user owns the project OR has access through UserProjectAccess
-    from models.user_project_access import UserProjectAccess
-    
-    is_owner = project.owner_id == current_user.id
-    has_access = db.query(UserProjectAccess).filter(
-        UserProjectAccess.user_id == current_user.id,
-        UserProjectAccess.project_id == project_id
-    ).first() is not None
-    
-    if not is_owner and not has_access:
+
+    return await ProjectService.duplicate_projects(
+        db, project_ids, current_user.id, copies=body.copies, name=body.name
+    )
+
+
+@router.get("/", response_model=List[Project], response_model_exclude_unset=True)
+async def get_my_projects(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    summary: bool = False,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Get projects for the current user (owned + collaborative), newest first.
+
+    Pass ``limit`` to paginate; the next page's cursor comes back in the
+    ``X-Next-Cursor`` header. ``summary=true`` leaves ``data`` out.
+    """
+    try:
+        projects, next_cursor = await ProjectService.get_accessible_projects(
+            db, current_user.id, limit=limit, cursor=cursor, summary=summary
+        )
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not authorized to access this project"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
         )
-    
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return projects
+
+
+@router.get("/search", response_model=List[ProjectSummary])
+async def search_projects(
+    response: Response,
+    q: Optional[str] = Query(None, max_length=200),
+    widget_type: Optional[List[str]] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Search owned and shared projects by name, widget text and widget types.
+
+    ``q`` matches part of the project name or words in the widgets' text;
+    ``widget_type`` (repeatable) keeps projects containing those widgets.
+    Paginated like ``GET /projects/`` through ``X-Next-Cursor``.
+    """
+    conditions = search_conditions(q, widget_type)
+    if not conditions:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Provide q or widget_type"
+        )
+    try:
+        projects, next_cursor = await ProjectService.get_accessible_projects(
+            db, current_user.id, limit=limit, cursor=cursor, summary=True, conditions=conditions
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return projects
+
+
+@router.get("/{project_id}", response_model=Project)
+async def get_project(
+    project_id: uuid.UUID,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Get a specific project (304 when If-None-Match holds the current ETag)"""
+    wildcard, known_versions = parse_etag_header(if_none_match)
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=not wildcard,
+        unless_versions=known_versions
+    )
+
+    etag = make_etag(project.version)
+    if wildcard or project.version in known_versions:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
     return project
 
 
@@ -88,57 +193,328 @@ async def get_project(
 async def update_project(
     project_id: uuid.UUID,
     project_update: ProjectCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    access_cache: dict = Depends(get_access_cache)
 ):
-    """Update a project"""
-    project = ProjectService.get_project_by_id(db, project_id)
-    if not project:
+    """Update a project (If-Match makes the write conditional on the ETag)"""
+    expected_versions = if_match_versions(if_match)
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        forbidden_detail="Not authorized to modify this project"
+    )
+    _check_if_match(project, expected_versions)
+
+    updated_project = await ProjectService.update_project(
+        db, project_id, project_update.name, project_update.data,
+        expected_versions=expected_versions
+    )
+    if updated_project is None:
+        # Lost a race with another writer between the check and the update
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Project not found"
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Project has been modified since it was loaded"
         )
-    
-    # Check if user owns the project OR has access through UserProjectAccess
-    from models.user_project_access import UserProjectAccess
-    
-    is_owner = project.owner_id == current_user.id
-    has_access = db.query(UserProjectAccess).filter(
-        UserProjectAccess.user_id == current_user.id,
-        UserProjectAccess.project_id == project_id
-    ).first() is not None
-    
-    if not is_owner and not has_access:
+
+    response.headers["ETag"] = make_etag(updated_project.version)
+    return updated_project
+
+
+@router.patch("/{project_id}", response_model=ProjectSummary)
+async def patch_project(
+    project_id: uuid.UUID,
+    operations: List[JsonPatchOperation],
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Apply an RFC 6902 JSON Patch to the project data server-side"""
+    try:
+        parsed = validate_patch([
+            operation.model_dump(by_alias=True, exclude_unset=True) for operation in operations
+        ])
+    except JsonPatchError as e:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not authorized to modify this project"
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
         )
-    
-    updated_project = ProjectService.update_project(
-        db, project_id, project_update.name, project_update.data
+
+    expected_versions = if_match_versions(if_match)
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        forbidden_detail="Not authorized to modify this project"
     )
-    return updated_project
+    _check_if_match(project, expected_versions)
+    if not parsed:
+        response.headers["ETag"] = make_etag(project.version)
+        return project
 
+    patched = await ProjectService.patch_project(db, project_id, parsed, expected_versions)
+    if patched is None:
+        await _check_version_unchanged(db, project_id, current_user.id, expected_versions)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Patch could not be applied: a test failed or a path does not exist"
+        )
 
-@router.delete("/{project_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_project(
+    response.headers["ETag"] = make_etag(patched.version)
+    return patched
+
+
+@router.get("/{project_id}/pages", response_model=ProjectPageIndex)
+async def get_page_index(
     project_id: uuid.UUID,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
 ):
-    """Delete a project"""
-    project = ProjectService.get_project_by_id(db, project_id)
-    if not project:
+    """Project metadata plus an index of its pages (ids, names, routes, widget counts)"""
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        extra_columns=[document_column(), page_index_column()]
+    )
+    not_modified = _not_modified(project, if_none_match)
+    if not_modified:
+        return not_modified
+    response.headers["ETag"] = make_etag(project.version)
+    return project
+
+
+@router.get("/{project_id}/pages/{page_id}", response_model=Dict[str, Any])
+async def get_page(
+    project_id: uuid.UUID,
+    page_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """A single page of the project data, extracted in Postgres"""
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        extra_columns=[page_column(page_id)]
+    )
+    if project.page is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Page not found")
+    not_modified = _not_modified(project, if_none_match)
+    if not_modified:
+        return not_modified
+    response.headers["ETag"] = make_etag(project.version)
+    return project.page
+
+
+@router.put("/{project_id}/pages/{page_id}", response_model=ProjectSummary)
+async def update_page(
+    project_id: uuid.UUID,
+    page_id: str,
+    page: Dict[str, Any],
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Replace a single page in place"""
+    if page.setdefault("id", page_id) != page_id:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Project not found"
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Page id in the body does not match the URL"
+        )
+
+    expected_versions = if_match_versions(if_match)
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        forbidden_detail="Not authorized to modify this project"
+    )
+    _check_if_match(project, expected_versions)
+
+    updated = await ProjectPageService.replace_page(db, project_id, page_id, page, expected_versions)
+    if updated is None:
+        await _check_version_unchanged(db, project_id, current_user.id, expected_versions)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Page not found")
+
+    response.headers["ETag"] = make_etag(updated.version)
+    return updated
+
+
+@router.get("/{project_id}/pages/{page_id}/widgets/{widget_id}", response_model=Dict[str, Any])
+async def get_widget(
+    project_id: uuid.UUID,
+    page_id: str,
+    widget_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """A single top-level widget of a page"""
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        extra_columns=[widget_column(page_id, widget_id)]
+    )
+    if project.widget is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Widget not found")
+    not_modified = _not_modified(project, if_none_match)
+    if not_modified:
+        return not_modified
+    response.headers["ETag"] = make_etag(project.version)
+    return project.widget
+
+
+@router.put("/{project_id}/pages/{page_id}/widgets/{widget_id}", response_model=ProjectSummary)
+async def update_widget(
+    project_id: uuid.UUID,
+    page_id: str,
+    widget_id: str,
+    widget: Dict[str, Any],
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Replace a single top-level widget of a page in place"""
+    if widget.setdefault("id", widget_id) != widget_id:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Widget id in the body does not match the URL"
         )
-    
-    # Check if user owns the project
-    if project.owner_id != current_user.id:
+
+    expected_versions = if_match_versions(if_match)
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        forbidden_detail="Not authorized to modify this project"
+    )
+    _check_if_match(project, expected_versions)
+
+    updated = await ProjectPageService.replace_widget(db, project_id, page_id, widget_id, widget, expected_versions)
+    if updated is None:
+        await _check_version_unchanged(db, project_id, current_user.id, expected_versions)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Widget not found")
+
+    response.headers["ETag"] = make_etag(updated.version)
+    return updated
+
+
+@router.get("/{project_id}/thumbnail", response_class=Response)
+async def get_project_thumbnail(
+    project_id: uuid.UUID,
+    page_id: Optional[str] = None,
+    width: int = Query(180, ge=32, le=1024),
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """SVG wireframe of a page (the first one by default), cached per project version"""
+    project = await authorize_project(db, access_cache, project_id, current_user.id, include_data=False)
+    not_modified = _not_modified(project, if_none_match)
+    if not_modified:
+        return not_modified
+
+    thumbnail = await get_thumbnail(db, project_id, project.version, page_id, width)
+    if thumbnail is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Page not found")
+    svg, version = thumbnail
+    return Response(content=svg, media_type="image/svg+xml", headers={"ETag": make_etag(version)})
+
+
+@router.get("/{project_id}/versions", response_model=List[ProjectVersionInfo])
+async def list_versions(
+    project_id: uuid.UUID,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Stored versions of the project, newest first"""
+    await authorize_project(db, access_cache, project_id, current_user.id, include_data=False)
+    return await ProjectHistoryService.list_versions(db, project_id)
+
+
+@router.get("/{project_id}/versions/{version}", response_model=ProjectVersionData)
+async def get_version(
+    project_id: uuid.UUID,
+    version: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """The project data as it was at ``version``"""
+    await authorize_project(db, access_cache, project_id, current_user.id, include_data=False)
+    try:
+        data = await ProjectHistoryService.get_version_data(db, project_id, version)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    return {"version": version, "data": data}
+
+
+@router.post("/{project_id}/versions/{version}/restore", response_model=ProjectSummary)
+async def restore_version(
+    project_id: uuid.UUID,
+    version: int,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Write the data of an older version back as a new version"""
+    expected_versions = if_match_versions(if_match)
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        include_data=False,
+        forbidden_detail="Not authorized to modify this project"
+    )
+    _check_if_match(project, expected_versions)
+    try:
+        data = await ProjectHistoryService.get_version_data(db, project_id, version)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+    restored = await ProjectService.update_project(
+        db, project_id, data={} if data is None else data, expected_versions=expected_versions
+    )
+    if restored is None:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not authorized to delete this project"
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Project has been modified since it was loaded"
         )
-    
-    ProjectService.delete_project(db, project_id)
+
+    response.headers["ETag"] = make_etag(restored.version)
+    return restored
+
+
+@router.delete("/{project_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_project(
+    project_id: uuid.UUID,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    access_cache: dict = Depends(get_access_cache)
+):
+    """Delete a project"""
+    project = await authorize_project(
+        db, access_cache, project_id, current_user.id,
+        owner_only=True,
+        include_data=False,
+        forbidden_detail="Not authorized to delete this project"
+    )
+    _check_if_match(project, if_match_versions(if_match))
+
+    await ProjectService.delete_project(db, project_id)
+    invalidate_project(project_id)
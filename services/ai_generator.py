@@ -2,10 +2,8 @@ import openai
 import json
 from typing import Dict, Any
 import os
-from dotenv import load_dotenv
-from .image_service import ImageService
+import config  # noqa: F401  (loads .env)
 
-load_dotenv()
 
 class AIProjectGenerator:
     def __init__(self):
@@ -15,9 +13,12 @@ class AIProjectGenerator:
         )
         if not os.getenv("OPENAI_API_KEY"):
             raise ValueError("OPENAI_API_KEY no está configurada en las variables de entorno")
-        
-        # Inicializar servicio de imágenes
-        self.image_service = ImageService()
+
+    @property
+    def image_service(self):
+        # Servicio de imágenes compartido, creado solo cuando se necesita
+        from services.providers import get_image_service
+        return get_image_service()
     
     def generate_project_from_prompt(self, prompt: str) -> Dict[str, Any]:
         """
@@ -0,0 +1,220 @@
+import os
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Collection, List, Optional, Tuple
+from services.metrics import metrics
+
+try:
+    import zstandard  # optional: pip install zstandard
+except ImportError:
+    zstandard = None
+
+# Entries with these extensions are usually compressed already (images,
+# fonts, archives...) and are stored in ZIPs as is, unless deflating the
+# first ARCHIVE_PROBE_BYTES at level 1 saves at least ARCHIVE_PROBE_MIN_SAVING
+# (badly optimized icons still shrink)
+ARCHIVE_STORED_EXTENSIONS = frozenset(
+    e.strip().lower().lstrip(".") for e in os.getenv(
+        "ARCHIVE_STORED_EXTENSIONS", "png,jpg,jpeg,gif,webp,zip,jar,aar,gz,bz2,xz,zst,mp3,mp4,ogg,woff,woff2"
+    ).split(",") if e.strip()
+)
+ARCHIVE_PROBE_BYTES = int(os.getenv("ARCHIVE_PROBE_BYTES", str(16 * 1024)))
+ARCHIVE_PROBE_MIN_SAVING = float(os.getenv("ARCHIVE_PROBE_MIN_SAVING", "0.1"))
+ARCHIVE_DEFLATE_LEVEL = int(os.getenv("ARCHIVE_DEFLATE_LEVEL", "6"))
+# Entries at least this large are deflated by ARCHIVE_WORKERS threads
+# (zlib releases the GIL); smaller ones are not worth the hand-off
+ARCHIVE_PARALLEL_MIN_BYTES = int(os.getenv("ARCHIVE_PARALLEL_MIN_BYTES", str(64 * 1024)))
+ARCHIVE_WORKERS = int(os.getenv("ARCHIVE_WORKERS", str(min(4, os.cpu_count() or 1))))
+ARCHIVE_ZSTD_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", "3"))
+# zstd worker threads for tar.zst (0: compress in the calling thread, -1: one per core)
+ARCHIVE_ZSTD_THREADS = int(os.getenv("ARCHIVE_ZSTD_THREADS", "0"))
+# Modification time of every entry (the reproducible-builds convention;
+# 1980-01-01 by default, the earliest a ZIP can hold). With sorted entries
+# and plain 0644/0755 modes the same files always give the same archive
+SOURCE_DATE_EPOCH = max(int(os.getenv("SOURCE_DATE_EPOCH", "315532800")), 315532800)
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _executor() -> Optional[ThreadPoolExecutor]:
+    global _pool
+    if ARCHIVE_WORKERS <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS, thread_name_prefix="archive")
+        return _pool
+
+
+def list_files(source_dir: str, only: Optional[Collection[str]] = None) -> List[Tuple[str, str]]:
+    """(path, name in the archive) of every file under ``source_dir`` (or
+    those named in ``only``), sorted by name"""
+    entries = []
+    for root, dirs, files in os.walk(source_dir):
+        for file in files:
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, source_dir).replace(os.sep, "/")
+            if only is None or name in only:
+                entries.append((path, name))
+    return sorted(entries, key=lambda entry: entry[1])
+
+
+def _mode(path: str) -> int:
+    return 0o755 if os.stat(path).st_mode & 0o111 else 0o644
+
+
+def _zip_info(path: str, name: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=time.gmtime(SOURCE_DATE_EPOCH)[:6])
+    info.create_system = 3  # unix, so the mode below is honoured
+    info.external_attr = (stat.S_IFREG | _mode(path)) << 16
+    return info
+
+
+def _compressible(name: str) -> bool:
+    return name.rsplit(".", 1)[-1].lower() not in ARCHIVE_STORED_EXTENSIONS
+
+
+def _worth_deflating(data: bytes) -> bool:
+    sample = data[:ARCHIVE_PROBE_BYTES]
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - ARCHIVE_PROBE_MIN_SAVING)
+
+
+def _encode(path: str, compress: bool, level: int) -> Tuple[bytes, int, int, int]:
+    """(data, crc, size, method) of a ZIP entry; ``compress`` False only deflates if a probe says it pays"""
+    with open(path, "rb") as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    if data and (compress or _worth_deflating(data)):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)  # raw deflate, as ZIP expects
+        packed = compressor.compress(data) + compressor.flush()
+        if len(packed) < len(data):
+            return packed, crc, len(data), zipfile.ZIP_DEFLATED
+    return data, crc, len(data), zipfile.ZIP_STORED
+
+
+def _write_entry(zipf: zipfile.ZipFile, info: zipfile.ZipInfo, data: bytes, crc: int, size: int, method: int):
+    # zipfile cannot add data compressed elsewhere: write the local header
+    # and data ourselves and register the entry for the central directory
+    info.compress_type = method
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(data)
+    info.header_offset = zipf.fp.tell()
+    zipf.fp.write(info.FileHeader())
+    zipf.fp.write(data)
+    zipf.filelist.append(info)
+    zipf.NameToInfo[info.filename] = info
+    zipf.start_dir = zipf.fp.tell()
+
+
+def write_zip(source_dir: str, path: str, only: Optional[Collection[str]] = None, level: int = ARCHIVE_DEFLATE_LEVEL):
+    """ZIP of ``source_dir``: compressed assets stored, the rest deflated, large entries in parallel"""
+    entries = list_files(source_dir, only)
+    pool = _executor()
+    pending = {}
+    if pool is not None:
+        for file_path, name in entries:
+            if _compressible(name) and os.path.getsize(file_path) >= ARCHIVE_PARALLEL_MIN_BYTES:
+                pending[name] = pool.submit(_encode, file_path, True, level)
+    try:
+        with zipfile.ZipFile(path, "w") as zipf:
+            for file_path, name in entries:
+                future = pending.pop(name, None)
+                data, crc, size, method = future.result() if future else _encode(file_path, _compressible(name), level)
+                _write_entry(zipf, _zip_info(file_path, name), data, crc, size, method)
+                metrics.inc("archive_entries_deflated" if method == zipfile.ZIP_DEFLATED else "archive_entries_stored")
+    finally:
+        for future in pending.values():
+            future.cancel()
+
+
+def write_tar_zst(source_dir: str, path: str, only: Optional[Collection[str]] = None, level: int = ARCHIVE_ZSTD_LEVEL):
+    """tar of ``source_dir`` compressed as a single zstd stream"""
+    compressor = zstandard.ZstdCompressor(level=level, threads=ARCHIVE_ZSTD_THREADS)
+    with open(path, "wb") as f:
+        with compressor.stream_writer(f, closefd=False) as stream:
+            with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for file_path, name in list_files(source_dir, only):
+                    info = tarfile.TarInfo(name)  # owner root, no user names
+                    info.size = os.path.getsize(file_path)
+                    info.mtime = SOURCE_DATE_EPOCH
+                    info.mode = _mode(file_path)
+                    with open(file_path, "rb") as data:
+                        tar.addfile(info, data)
+
+
+class ArchiveFormat:
+    """An archive generated projects can be downloaded as"""
+
+    def __init__(self, name: str, media_types: Tuple[str, ...], extension: str,
+                 writer: Callable[[str, str, Optional[Collection[str]]], None], available: bool = True):
+        self.name = name
+        self.media_types = media_types  # the first one is sent as Content-Type
+        self.extension = extension
+        self.writer = writer
+        self.available = available
+
+    @property
+    def media_type(self) -> str:
+        return self.media_types[0]
+
+    def write(self, source_dir: str, path: str, only: Optional[Collection[str]] = None):
+        """Archive ``source_dir`` (only the files named in ``only``, if given) to ``path``"""
+        start = time.perf_counter()
+        self.writer(source_dir, path, only)
+        metrics.observe(f"archive_{self.name}_seconds", time.perf_counter() - start)
+        metrics.observe(f"archive_{self.name}_bytes", os.path.getsize(path))
+
+
+ZIP = ArchiveFormat("zip", ("application/zip",), ".zip", write_zip)
+TAR_ZST = ArchiveFormat(
+    "tar_zst", ("application/zstd", "application/x-zstd-compressed-tar"), ".tar.zst", write_tar_zst,
+    available=zstandard is not None,
+)
+FORMATS = (ZIP, TAR_ZST)
+
+
+def _accept_ranges(accept: str) -> dict:
+    """{media range: q} of an Accept header"""
+    ranges = {}
+    for part in accept.split(","):
+        media_range, *params = [p.strip() for p in part.split(";")]
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges[media_range.lower()] = max(q, ranges.get(media_range.lower(), 0.0))
+    return ranges
+
+
+def negotiate(accept: Optional[str]) -> ArchiveFormat:
+    """Archive format for a request's Accept header.
+
+    Wildcards, a missing header or anything unknown select ZIP, so existing
+    clients are unaffected; another available format is used when it is
+    named with a q at least as high as ZIP's.
+    """
+    if not accept:
+        return ZIP
+    ranges = _accept_ranges(accept)
+    wildcard = max(ranges.get("*/*", 0.0), ranges.get("application/*", 0.0))
+    best, best_q = ZIP, max((ranges[t] for t in ZIP.media_types if t in ranges), default=wildcard)
+    for archive_format in FORMATS:
+        if archive_format is ZIP or not archive_format.available:
+            continue
+        q = max((ranges[t] for t in archive_format.media_types if t in ranges), default=0.0)
+        if q > 0 and q >= best_q:
+            best, best_q = archive_format, q
+    return best
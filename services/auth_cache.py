@@ -0,0 +1,63 @@
+import os
+import time
+import uuid
+from typing import Optional, Tuple
+from sqlalchemy import event
+from models.user import User as UserModel
+from models.schemas import User
+from services.auth_service import decode_token
+from services.cache import TTLCache
+
+# Short TTL: a cached user can be at most this stale on other workers
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+# token -> (subject, exp)
+_tokens = TTLCache("auth_token", max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+# subject (email) -> User schema snapshot
+_users = TTLCache("auth_user", max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
+def get_token_subject(token: str) -> Optional[str]:
+    """Verify a JWT once and return its subject, caching the result until it expires"""
+    cached: Optional[Tuple[str, float]] = _tokens.get(token)
+    now = time.time()
+    if cached is not None:
+        subject, expires_at = cached
+        if expires_at > now:
+            return subject
+        _tokens.pop(token)
+        return None
+
+    payload = decode_token(token)
+    if payload is None or payload.get("sub") is None:
+        return None
+    subject = payload["sub"]
+    expires_at = float(payload.get("exp", now + AUTH_CACHE_TTL))
+    _tokens.set(token, (subject, expires_at), ttl=expires_at - now)
+    return subject
+
+
+def get_cached_user(subject: str) -> Optional[User]:
+    return _users.get(subject)
+
+
+def cache_user(user: UserModel) -> User:
+    """Store a detached snapshot of the user (no password hash) and return it"""
+    snapshot = User.model_validate(user)
+    _users.set(snapshot.email, snapshot)
+    return snapshot
+
+
+def invalidate_user(email: Optional[str] = None, user_id: Optional[uuid.UUID] = None):
+    """Forget cached records for a user; call after writes that bypass the ORM"""
+    if email is not None:
+        _users.pop(email)
+    if user_id is not None:
+        _users.remove_where(lambda _, cached: cached.id == user_id)
+
+
+@event.listens_for(UserModel, "after_update")
+@event.listens_for(UserModel, "after_delete")
+def _invalidate_on_change(mapper, connection, target):
+    invalidate_user(email=target.email, user_id=target.id)
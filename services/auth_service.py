@@ -2,10 +2,14 @@ from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import math
 import os
-from dotenv import load_dotenv
+import time
+import config  # noqa: F401  (loads .env)
+from services.metrics import metrics
 
-load_dotenv()
 
 # Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")  # Change this in production
@@ -15,6 +19,21 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt runs on its own bounded pool so it never blocks the event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_pending = 0
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashing jobs are already queued"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Password hashing queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a plain password against its hash"""
@@ -26,6 +45,48 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+def _estimate_retry_after() -> int:
+    """Seconds until the current backlog should have drained"""
+    hash_time = metrics.get_histogram("password_hash_seconds")["avg"] or 0.25
+    return max(1, math.ceil(_hash_pending * hash_time / PASSWORD_HASH_WORKERS))
+
+
+async def _run_hash_job(func, *args):
+    """Run a bcrypt call on the hashing pool, rejecting work when the queue is full"""
+    global _hash_pending
+    if _hash_pending >= PASSWORD_HASH_MAX_PENDING:
+        metrics.inc("password_hash_rejected")
+        raise PasswordHasherBusy(_estimate_retry_after())
+
+    submitted_at = time.perf_counter()
+
+    def job():
+        started_at = time.perf_counter()
+        metrics.observe("password_hash_queue_seconds", started_at - submitted_at)
+        try:
+            return func(*args)
+        finally:
+            metrics.observe("password_hash_seconds", time.perf_counter() - started_at)
+
+    _hash_pending += 1
+    metrics.set_gauge("password_hash_pending", _hash_pending)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, job)
+    finally:
+        _hash_pending -= 1
+        metrics.set_gauge("password_hash_pending", _hash_pending)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password on the hashing pool"""
+    return await _run_hash_job(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """Hash a password on the hashing pool"""
+    return await _run_hash_job(get_password_hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
     to_encode = data.copy()
@@ -0,0 +1,280 @@
+import abc
+import asyncio
+import asyncpg
+import json
+import logging
+import os
+import uuid
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from sqlalchemy import select, insert, delete, func, literal, Text
+from sqlalchemy.exc import SQLAlchemyError
+from models.collab_message import CollabMessage
+from models.database import InstrumentedPool, create_engine_for, engine, to_dsn, DATABASE_URL
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# memory: rooms only span this process; postgres: LISTEN/NOTIFY between all
+# workers and nodes sharing the database
+COLLAB_BACKPLANE = os.getenv("COLLAB_BACKPLANE", "memory").lower()
+# Database the postgres backplane LISTENs, publishes and spills through;
+# DATABASE_URL when unset. Must not be behind a transaction-mode pooler
+COLLAB_BACKPLANE_URL = os.getenv("COLLAB_BACKPLANE_URL")
+# NOTIFY payloads must stay under 8000 bytes; bigger messages go through
+# the collab_message table and only their id is notified
+COLLAB_NOTIFY_MAX_BYTES = int(os.getenv("COLLAB_NOTIFY_MAX_BYTES", "7900"))
+# How long spilled messages are kept for slower nodes to fetch them
+COLLAB_SPILL_TTL = float(os.getenv("COLLAB_SPILL_TTL", "60"))
+# The listener connection is pinged this often so a dead socket is noticed
+COLLAB_LISTEN_KEEPALIVE = float(os.getenv("COLLAB_LISTEN_KEEPALIVE", "30"))
+
+# Identifies this process in every published message so it can skip its
+# own messages when they come back from the broker
+NODE_ID = uuid.uuid4().hex
+
+# Called with (room, messages) for messages published by other nodes
+MessageHandler = Callable[[str, List[str]], Awaitable[None]]
+
+
+class Backplane(abc.ABC):
+    """Pub/sub between the processes serving collaboration rooms.
+
+    Local peers are served directly by the caller; the backplane only
+    carries messages to (and from) the other nodes subscribed to a room.
+    Implementations call the base ``subscribe`` / ``unsubscribe`` /
+    ``close``, which keep track of ``rooms``.
+    """
+
+    # Whether other processes take part (room documents then need a lease)
+    distributed = False
+
+    def __init__(self, on_message: MessageHandler, node_id: str = NODE_ID):
+        self.on_message = on_message
+        self.node_id = node_id
+        self.rooms: Set[str] = set()
+
+    @abc.abstractmethod
+    async def subscribe(self, room: str):
+        """Start receiving the other nodes' messages for ``room``"""
+        self.rooms.add(room)
+
+    @abc.abstractmethod
+    async def unsubscribe(self, room: str):
+        self.rooms.discard(room)
+
+    @abc.abstractmethod
+    async def publish(self, room: str, messages: List[str]):
+        """Deliver ``messages`` (in order, as one unit) to the other nodes in ``room``"""
+
+    @abc.abstractmethod
+    async def close(self):
+        self.rooms.clear()
+
+
+class MemoryBackplane(Backplane):
+    """In-process backplane. Instances sharing a ``hub`` behave like
+    separate nodes, which is enough for a single worker and for tests."""
+
+    _default_hub: Dict[str, Set["MemoryBackplane"]] = {}
+
+    def __init__(self, on_message: MessageHandler, node_id: str = NODE_ID, hub=None):
+        super().__init__(on_message, node_id)
+        self.hub = hub if hub is not None else self._default_hub
+
+    async def subscribe(self, room: str):
+        await super().subscribe(room)
+        self.hub.setdefault(room, set()).add(self)
+
+    async def unsubscribe(self, room: str):
+        await super().unsubscribe(room)
+        members = self.hub.get(room)
+        if members is not None:
+            members.discard(self)
+            if not members:
+                self.hub.pop(room, None)
+
+    async def publish(self, room: str, messages: List[str]):
+        metrics.inc("collab_backplane_published")
+        for member in list(self.hub.get(room, ())):
+            if member is not self and member.node_id != self.node_id:
+                metrics.inc("collab_backplane_received")
+                await member.on_message(room, messages)
+
+    async def close(self):
+        for room in list(self.rooms):
+            await self.unsubscribe(room)
+
+
+class BackplanePool(InstrumentedPool):
+    metrics_prefix = "collab_backplane_pool"
+
+
+def _channel(room: str) -> str:
+    return "collab_" + room.replace("-", "")
+
+
+class PostgresBackplane(Backplane):
+    """LISTEN/NOTIFY backplane: one channel per room.
+
+    A dedicated connection LISTENs to the rooms with local peers and is
+    re-established (re-LISTENing every room) when it drops; messages sent
+    while it is down are lost. Publishing goes through the engine's pool
+    in autocommit mode, so a NOTIFY is a single round trip. With
+    ``owns_engine`` the engine is disposed on close.
+    """
+
+    distributed = True
+
+    def __init__(self, on_message: MessageHandler, bind, dsn: str, node_id: str = NODE_ID, owns_engine: bool = False):
+        super().__init__(on_message, node_id)
+        self.bind = bind
+        self.owns_engine = owns_engine
+        self.engine = bind.execution_options(isolation_level="AUTOCOMMIT")
+        self.dsn = dsn
+        self._conn = None
+        self._lock = asyncio.Lock()  # one operation at a time on the listener connection
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._tasks = []
+        self._last_cleanup = 0.0
+
+    def _start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._listen()), loop.create_task(self._dispatch())]
+
+    async def _listen(self):
+        delay = 1.0
+        while True:
+            lost = asyncio.Event()
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                conn.add_termination_listener(lambda _: lost.set())
+                async with self._lock:
+                    for room in list(self.rooms):
+                        await conn.add_listener(_channel(room), self._notified)
+                    self._conn = conn
+                delay = 1.0
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), COLLAB_LISTEN_KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        async with self._lock:
+                            await asyncio.wait_for(conn.execute("SELECT 1"), COLLAB_LISTEN_KEEPALIVE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("collab backplane connection failed error=%s", e)
+            finally:
+                self._conn = None
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            metrics.inc("collab_backplane_reconnects")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    def _notified(self, conn, pid, channel, payload):
+        # asyncpg callback; ordering is kept by handling everything in _dispatch
+        self._inbox.put_nowait(payload)
+
+    async def _dispatch(self):
+        while True:
+            payload = await self._inbox.get()
+            try:
+                envelope = json.loads(payload)
+                if envelope["n"] == self.node_id:
+                    continue
+                room, messages = envelope["room"], envelope.get("m")
+                if messages is None:
+                    messages = await self._fetch_spilled(envelope["r"])
+                    if messages is None:
+                        metrics.inc("collab_backplane_spill_missed")
+                        continue
+                metrics.inc("collab_backplane_received")
+                await self.on_message(room, messages)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("collab backplane dropped a message error=%s", e)
+
+    async def _fetch_spilled(self, message_id: int) -> Optional[List[str]]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(select(CollabMessage.payload).where(CollabMessage.id == message_id))
+            payload = result.scalar()
+        return json.loads(payload) if payload is not None else None
+
+    async def subscribe(self, room: str):
+        self._start()
+        if room in self.rooms:
+            return
+        await super().subscribe(room)
+        async with self._lock:
+            if self._conn is not None:
+                await self._conn.add_listener(_channel(room), self._notified)
+
+    async def unsubscribe(self, room: str):
+        if room not in self.rooms:
+            return
+        await super().unsubscribe(room)
+        async with self._lock:
+            if self._conn is not None:
+                await self._conn.remove_listener(_channel(room), self._notified)
+
+    async def publish(self, room: str, messages: List[str]):
+        payload = json.dumps({"n": self.node_id, "room": room, "m": messages})
+        spill = len(payload.encode()) > COLLAB_NOTIFY_MAX_BYTES
+        if not spill:
+            statement = select(func.pg_notify(_channel(room), payload))
+        else:
+            # Store the message and notify its id in the same statement
+            spilled = insert(CollabMessage).values(room=room, payload=json.dumps(messages)).returning(CollabMessage.id).cte("spilled")
+            envelope = func.json_build_object("n", literal(self.node_id), "room", literal(room), "r", spilled.c.id)
+            statement = select(func.pg_notify(_channel(room), envelope.cast(Text))).select_from(spilled)
+            metrics.inc("collab_backplane_spilled")
+
+        async with self.engine.connect() as conn:
+            await conn.execute(statement)
+            if spill:
+                await self._cleanup(conn)
+        metrics.inc("collab_backplane_published")
+
+    async def _cleanup(self, conn):
+        """Delete spilled messages older than COLLAB_SPILL_TTL (at most once per TTL)"""
+        now = asyncio.get_running_loop().time()
+        if now - self._last_cleanup < COLLAB_SPILL_TTL:
+            return
+        self._last_cleanup = now
+        try:
+            await conn.execute(
+                delete(CollabMessage).where(
+                    CollabMessage.created_at < func.now() - timedelta(seconds=COLLAB_SPILL_TTL)
+                )
+            )
+        except SQLAlchemyError as e:
+            logger.warning("collab backplane cleanup failed error=%s", e)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+        if self.owns_engine:
+            await self.bind.dispose()
+        await super().close()
+
+
+def create_backplane(on_message: MessageHandler) -> Backplane:
+    """Backplane selected by COLLAB_BACKPLANE"""
+    if COLLAB_BACKPLANE == "memory":
+        return MemoryBackplane(on_message)
+    if COLLAB_BACKPLANE == "postgres":
+        if not COLLAB_BACKPLANE_URL:
+            return PostgresBackplane(on_message, engine, to_dsn(DATABASE_URL))
+        # Publishing and spill fetches go to the same database as LISTEN
+        bind = create_engine_for(COLLAB_BACKPLANE_URL, poolclass=BackplanePool)
+        return PostgresBackplane(on_message, bind, to_dsn(COLLAB_BACKPLANE_URL), owns_engine=True)
+    raise ValueError(f"Unknown COLLAB_BACKPLANE: {COLLAB_BACKPLANE}")
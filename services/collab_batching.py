@@ -0,0 +1,65 @@
+import json
+import os
+from typing import Hashable, List, Optional, Tuple, Union
+
+# Messages of COLLAB_COALESCE_TYPES are held for up to this many seconds and
+# only the latest one per key is sent (0 relays every message immediately)
+COLLAB_COALESCE_TICK = float(os.getenv("COLLAB_COALESCE_TICK", "0.05"))
+COLLAB_COALESCE_TYPES = frozenset(
+    t.strip() for t in os.getenv("COLLAB_COALESCE_TYPES", "cursor,drag,resize,selection").split(",") if t.strip()
+)
+# Offered next to the jwt.* subprotocol by clients that accept batched frames:
+#   {"type": "batch", "messages": [<message>, ...]}
+BATCH_SUBPROTOCOL = "collab.batch"
+
+_WIDGET_FIELDS = ("widgetId", "widget_id")
+
+
+def parse_message(message: str) -> Optional[dict]:
+    """The message as a JSON object, or None for anything else"""
+    if not message.startswith("{"):
+        return None
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def widget_ref(data: dict) -> Optional[Tuple[str, Union[str, int]]]:
+    """(field, id) of the widget a message is about, or None"""
+    for field in _WIDGET_FIELDS:
+        widget_id = data.get(field)
+        if isinstance(widget_id, (str, int)):
+            return field, widget_id
+    return None
+
+
+def coalesce_key(data: Optional[dict], sender: Hashable) -> Optional[Hashable]:
+    """Key under which later messages replace this one (``data``, parsed) within a tick.
+
+    State updates ({"type": "drag", "widgetId": ...}) are keyed by type and
+    widget, so the latest position wins whoever sent it; those without a
+    widget (cursors, selections) by type and sender. None for everything
+    else, which is relayed in order and never dropped.
+    """
+    if COLLAB_COALESCE_TICK <= 0 or data is None or data.get("type") not in COLLAB_COALESCE_TYPES:
+        return None
+    ref = widget_ref(data)
+    if ref is not None:
+        return data["type"], "widget", ref[1]
+    return data["type"], "sender", sender
+
+
+def batch_item(message: str) -> str:
+    """``message`` as an element of a batch: JSON is embedded as is, anything else as a string"""
+    try:
+        json.loads(message)
+        return message
+    except ValueError:
+        return json.dumps(message)
+
+
+def batch_frame(items: List[str]) -> str:
+    """One frame holding several messages (already passed through batch_item)"""
+    return '{"type":"batch","messages":[' + ",".join(items) + "]}"
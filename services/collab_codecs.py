@@ -0,0 +1,138 @@
+import json
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+from services.collab_batching import widget_ref
+from services.json_patch import make_patch
+
+try:
+    import msgpack  # optional: pip install msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2  # optional: pip install cbor2
+except ImportError:
+    cbor2 = None
+
+# Offered next to the jwt.* subprotocol, like collab.batch:
+#   collab.msgpack / collab.cbor - binary frames both ways (when the library
+#                                  is installed; the first one offered wins)
+#   collab.delta                 - repeated updates of a widget are sent as a
+#                                  JSON Patch against the previous one
+DELTA_SUBPROTOCOL = "collab.delta"
+# Widgets whose last update is remembered per delta peer
+COLLAB_DELTA_WIDGETS = int(os.getenv("COLLAB_DELTA_WIDGETS", "1024"))
+
+
+@lru_cache(maxsize=1024)
+def _load(message: str) -> Any:
+    # The same message object is fanned out to every peer: parse it once.
+    # Callers must not modify the result.
+    try:
+        return json.loads(message)
+    except ValueError:
+        return message
+
+
+class Codec:
+    """Binary serialization of the JSON messages relayed in rooms"""
+
+    def __init__(self, subprotocol: str, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]):
+        self.subprotocol = subprotocol
+        self.dumps = dumps
+        self.loads = loads
+        self.encode = lru_cache(maxsize=1024)(self._encode)  # one encoding per fanned out message
+
+    def _encode(self, message: str) -> bytes:
+        return self.dumps(_load(message))
+
+
+CODECS: Dict[str, Codec] = {}
+if msgpack is not None:
+    CODECS["collab.msgpack"] = Codec("collab.msgpack", msgpack.packb, msgpack.unpackb)
+if cbor2 is not None:
+    CODECS["collab.cbor"] = Codec("collab.cbor", cbor2.dumps, cbor2.loads)
+
+
+class WireFormat:
+    """How one peer's frames are written: text (default) or a binary codec,
+    optionally with delta-encoded widget updates.
+
+    A delta carries the JSON Patch (RFC 6902) turning the previous update
+    of the same type and widget into this one:
+    {"type": "drag", "widgetId": "w1", "delta": [<operations>]}. Deltas are
+    computed when a frame is actually written, so they are always relative
+    to what the peer received, whatever its queue dropped.
+    """
+
+    def __init__(self, codec: Optional[Codec] = None, delta: bool = False):
+        self.codec = codec
+        self.delta = delta
+        self._last: "OrderedDict[Hashable, str]" = OrderedDict()
+
+    @property
+    def options(self) -> List[str]:
+        options = [self.codec.subprotocol] if self.codec is not None else []
+        return options + ([DELTA_SUBPROTOCOL] if self.delta else [])
+
+    def encode(self, message: str) -> Union[str, bytes]:
+        if self.delta:
+            data = _load(message)
+            if isinstance(data, dict) and data.get("type") == "batch" and isinstance(data.get("messages"), list):
+                items = [self._delta(json.dumps(item, separators=(",", ":"))) for item in data["messages"]]
+                if any(item is not None for item in items):
+                    encoded = {"type": "batch", "messages": [
+                        delta if delta is not None else item for delta, item in zip(items, data["messages"])
+                    ]}
+                    return self._dumps(encoded)
+            else:
+                delta = self._delta(message)
+                if delta is not None:
+                    return self._dumps(delta)
+        return self.codec.encode(message) if self.codec is not None else message
+
+    def _dumps(self, data: Any) -> Union[str, bytes]:
+        return self.codec.dumps(data) if self.codec is not None else json.dumps(data, separators=(",", ":"))
+
+    def _delta(self, message: str) -> Optional[dict]:
+        """The delta replacing ``message`` for this peer, or None to send it whole"""
+        data = _load(message)
+        ref = widget_ref(data) if isinstance(data, dict) else None
+        if ref is None:
+            return None
+        key = (data.get("type"), ref[1])
+        previous = self._last.pop(key, None)
+        self._last[key] = message
+        if len(self._last) > COLLAB_DELTA_WIDGETS:
+            self._last.popitem(last=False)
+        if previous is None:
+            return None
+        operations = _diff(previous, message)
+        if operations is None:
+            return None
+        return {"type": data.get("type"), ref[0]: ref[1], "delta": operations}
+
+    def decode(self, frame: bytes) -> str:
+        """A binary frame from the client as the JSON text rooms relay (ValueError if invalid)"""
+        if self.codec is None:
+            raise ValueError("Binary frames were not negotiated")
+        try:
+            return json.dumps(self.codec.loads(frame), separators=(",", ":"))
+        except Exception as e:
+            raise ValueError(f"Invalid {self.codec.subprotocol} frame: {e}") from e
+
+
+@lru_cache(maxsize=1024)
+def _diff(previous: str, message: str) -> Optional[List[Dict[str, Any]]]:
+    # Shared by every peer that got the same previous update
+    operations = make_patch(_load(previous), _load(message))
+    if len(json.dumps(operations, separators=(",", ":"))) >= len(message):
+        return None  # Not worth it
+    return operations
+
+
+def negotiate(options: List[str]) -> WireFormat:
+    """The wire format for the options a client offered after its jwt.* subprotocol"""
+    codec = next((CODECS[option] for option in options if option in CODECS), None)
+    return WireFormat(codec, DELTA_SUBPROTOCOL in options)
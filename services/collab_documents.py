@@ -0,0 +1,663 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import deque
+from datetime import timedelta
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from sqlalchemy import case, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from models.collab_room_lease import CollabRoomLease
+from models.database import SessionLocal
+from models.user import Project
+from services.collab_backplane import NODE_ID
+from services.collab_batching import batch_frame
+from services.collab_peers import Peer
+from services.json_patch import (
+    Effect, JsonPatchError, apply_patch, array_effects, has_positions, rebase_patch, validate_patch,
+)
+from services.metrics import metrics
+from services.user_service import ProjectService
+
+logger = logging.getLogger(__name__)
+
+# Edits are written to Project.data this long after the last one, and at
+# most COLLAB_PERSIST_MAX_DELAY after the first unsaved one
+COLLAB_PERSIST_DELAY = float(os.getenv("COLLAB_PERSIST_DELAY", "2"))
+COLLAB_PERSIST_MAX_DELAY = float(os.getenv("COLLAB_PERSIST_MAX_DELAY", "10"))
+# Ownership of a room's document; renewed every third of it while active
+COLLAB_LEASE_TTL = float(os.getenv("COLLAB_LEASE_TTL", "15"))
+# A patch forwarded to the owning node is rejected if not sequenced in time
+COLLAB_FORWARD_TIMEOUT = float(os.getenv("COLLAB_FORWARD_TIMEOUT", "5"))
+# Recent patches kept per room so reconnecting clients only get what they
+# missed; older positions (or a bigger gap) get a snapshot instead
+COLLAB_REPLAY_BUFFER = int(os.getenv("COLLAB_REPLAY_BUFFER", "200"))
+COLLAB_REPLAY_MAX_BYTES = int(os.getenv("COLLAB_REPLAY_MAX_BYTES", str(1024 * 1024)))
+
+# Backplane room carrying the document protocol between nodes
+DOC_ROOM_PREFIX = "doc:"
+
+DOCUMENT_MESSAGE_TYPES = ("patch", "sync")
+
+
+def parse_position(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """A resume token ("<epoch>:<seq>", from the last snapshot, patch or ack seen), or None"""
+    if not value:
+        return None
+    epoch, _, seq = value.partition(":")
+    try:
+        return int(epoch), int(seq)
+    except ValueError:
+        return None
+
+
+def parse_base(data: Dict[str, Any]) -> Tuple[int, int]:
+    """(epoch, seq) a patch message was made against: the last snapshot,
+    patch or ack its sender had seen (JsonPatchError if missing)"""
+    epoch, seq = data.get("epoch"), data.get("base")
+    if type(epoch) is not int or type(seq) is not int:
+        raise JsonPatchError("A patch needs the 'epoch' and 'base' (seq) of the last state its sender saw")
+    return epoch, seq
+
+
+def _message(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, separators=(",", ":"))
+
+
+class RoomDocument:
+    """A room's copy of its project's data.
+
+    On the owning node it is the authority: patches are applied in arrival
+    order and numbered with ``seq`` within the owner's ``epoch``. A patch
+    made against an older ``seq`` has its array positions rebased over the
+    elements other writers inserted, removed or moved since (from the
+    replay buffer), so it still edits the elements its author saw; values
+    themselves are last writer wins. Other nodes keep a replica from the
+    owner's stream.
+    """
+
+    def __init__(self, project_id: uuid.UUID, data: Any, version: int, epoch: int, seq: int = 0, saved_seq: Optional[int] = None):
+        self.project_id = project_id
+        self.data = data if data is not None else {}
+        self.version = version  # last persisted Project.version
+        self.epoch = epoch
+        self.seq = seq
+        self.saved_seq = seq if saved_seq is None else saved_seq  # seq that version holds
+        self.unsaved: List[List[Dict[str, Any]]] = []  # patches applied since the last persist
+        self.saved_json: Optional[str] = None  # data of ``version``, when known, to rebase unsaved patches onto
+        self.first_unsaved: Optional[float] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.persisting: Optional[asyncio.Task] = None
+        # (seq, patch message, array effects, author) after self.replay_base;
+        # effects are None in replicas, which never rebase
+        self.replay: Deque[Tuple[int, str, Optional[List[Effect]], Optional[str]]] = deque()
+        self.replay_base = seq
+        self._replay_bytes = 0
+        self._snapshot = None
+
+    def apply(self, operations: List[Dict[str, Any]], base: Optional[Tuple[int, int]] = None,
+              author: Optional[str] = None) -> Tuple[str, List[Dict[str, Any]]]:
+        """Apply a patch atomically (raises JsonPatchError and changes nothing on failure).
+
+        ``base`` is the (epoch, seq) the patch was made against; the
+        patches applied since, except ``author``'s own, are rebased over.
+        When they are no longer in the replay buffer only patches without
+        array positions can be applied. Returns the patch message for the
+        room, kept for replay, and the operations as applied.
+        """
+        effects: List[Effect] = []
+        concurrent = self.changes_since(base, author) if base is not None else []
+        if concurrent:
+            self.data, operations = rebase_patch(self.data, operations, concurrent, in_place=True, effects=effects)
+            metrics.inc("collab_patches_rebased")
+        else:
+            if concurrent is None and has_positions(operations):
+                raise JsonPatchError(
+                    f"Patch based on {base[0]}:{base[1]} can no longer be rebased: sync and send it again"
+                )
+            self.data = apply_patch(self.data, operations, in_place=True, effects=effects)
+        self.seq += 1
+        self._snapshot = None
+        message = _message({"type": "patch", "epoch": self.epoch, "seq": self.seq, "ops": operations})
+        self.replay.append((self.seq, message, effects, author))
+        self._replay_bytes += len(message)
+        while len(self.replay) > COLLAB_REPLAY_BUFFER or (self._replay_bytes > COLLAB_REPLAY_MAX_BYTES and self.replay):
+            self.replay_base, dropped, _, _ = self.replay.popleft()
+            self._replay_bytes -= len(dropped)
+        return message, operations
+
+    def changes_since(self, base: Tuple[int, int], author: Optional[str] = None) -> Optional[List[Effect]]:
+        """Array effects of the patches after ``base`` not sent by ``author``
+        (whose later patches already build on its earlier ones), or None if
+        they are no longer all here"""
+        epoch, seq = base
+        if epoch != self.epoch or not self.replay_base <= seq <= self.seq:
+            return None
+        effects = []
+        for message_seq, _, patch_effects, patch_author in self.replay:
+            if message_seq <= seq or (author is not None and patch_author == author):
+                continue
+            if patch_effects is None:
+                return None
+            effects.extend(patch_effects)
+        return effects
+
+    def reset(self, data: Any, version: int, epoch: int, seq: int, saved_seq: int):
+        self.data = data if data is not None else {}
+        self.version, self.epoch, self.seq, self.saved_seq = version, epoch, seq, saved_seq
+        self._snapshot = None
+        # Positions before a reset can only be caught up with a snapshot
+        self.replay.clear()
+        self.replay_base = seq
+        self._replay_bytes = 0
+
+    def load_replay(self, messages: List[str]):
+        """Take over the replay buffer of another node's copy (the patches up to self.seq)"""
+        self.replay = deque(
+            (seq, message, None, None) for seq, message in zip(range(self.seq - len(messages) + 1, self.seq + 1), messages)
+        )
+        self.replay_base = self.seq - len(messages)
+        self._replay_bytes = sum(len(message) for message in messages)
+
+    def missed_since(self, epoch: int, seq: int) -> Optional[List[str]]:
+        """Patch messages after ``seq``, or None if they are no longer all here"""
+        if epoch != self.epoch or not self.replay_base <= seq <= self.seq:
+            return None
+        return [entry[1] for entry in self.replay if entry[0] > seq]
+
+    def rebase_onto(self, data: Any, version: int, saving: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+        """Take ``data``, written as ``version`` outside the room, and replay
+        on top of it the patches not persisted yet: ``saving`` (being
+        written) and ``unsaved``. Their array positions are rebased over the
+        elements that write inserted, removed or moved (compared with
+        ``saved_json``); patches that no longer apply are dropped.
+        Returns ``saving`` as rebased; ``unsaved`` is rebased in place.
+        """
+        merged = data if data is not None else {}
+        saved_json = json.dumps(merged)
+        concurrent = array_effects(json.loads(self.saved_json), merged) if self.saved_json is not None else []
+
+        def rebase(patches):
+            nonlocal merged
+            rebased = []
+            for operations in patches:
+                try:
+                    merged, operations = rebase_patch(merged, operations, concurrent, in_place=True)
+                except JsonPatchError:
+                    metrics.inc("collab_patches_dropped_on_merge")
+                    continue
+                rebased.append(operations)
+            return rebased
+
+        saving, self.unsaved = rebase(saving), rebase(self.unsaved)
+        self.reset(merged, version, self.epoch, self.seq + 1, self.saved_seq)
+        self.saved_json = saved_json
+        return saving
+
+    def data_json(self) -> str:
+        if self._snapshot is None:
+            self._snapshot = json.dumps(self.data)
+        return self._snapshot
+
+    def snapshot_message(self) -> str:
+        return (
+            f'{{"type":"snapshot","epoch":{self.epoch},"seq":{self.seq},'
+            f'"version":{self.version},"data":{self.data_json()}}}'
+        )
+
+
+class _Room:
+    def __init__(self, room: str):
+        self.room = room
+        self.document: Optional[RoomDocument] = None
+        self.owner = False
+        # Joined before the replica arrived, with the position they resume from
+        self.waiting: Dict[Peer, Optional[Tuple[int, int]]] = {}
+        self.lock = asyncio.Lock()
+        self.lease_task: Optional[asyncio.Task] = None
+        self.sync_requested_at = float("-inf")
+        self.broken = False  # local peers followed a stream with a gap
+
+
+# Replicas ask the owner for a snapshot at most this often
+_SYNC_INTERVAL = 1.0
+
+
+class DocumentManager:
+    """Authoritative document state for the collaboration rooms of this node.
+
+    One node per room holds a lease (collab_room_lease) and sequences every
+    patch; the others forward their peers' patches to it over the backplane
+    and apply its stream to a replica, so joiners anywhere get a snapshot.
+    The owner writes the document back through ProjectService, debounced,
+    which also records the project history.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.rooms: Dict[str, _Room] = {}
+        self._forwarded: Dict[tuple, tuple] = {}  # (peer id, patch id) -> (peer, timer)
+
+    @property
+    def distributed(self) -> bool:
+        return self.hub.backplane.distributed
+
+    def _publish(self, room: str, messages: List[str]):
+        if self.distributed:
+            self.hub.publish(DOC_ROOM_PREFIX + room, messages)
+
+    # Local peers
+
+    async def join(self, room: str, peer: Peer, position: Optional[Tuple[int, int]] = None):
+        state = self.rooms.get(room)
+        if state is None:
+            state = self.rooms[room] = _Room(room)
+            await self.hub.backplane.subscribe(DOC_ROOM_PREFIX + room)
+            if self.distributed:
+                state.lease_task = asyncio.get_running_loop().create_task(self._keep_lease(room))
+
+        async with state.lock:
+            if state.document is None:
+                # Gets the snapshot once this node owns the room or has a replica
+                state.waiting[peer] = position
+                await self._acquire(room, state)
+            else:
+                self._catch_up(peer, state.document, position)
+
+    def forget(self, room: str, peer: Peer):
+        """``peer`` left ``room``; it no longer waits for a snapshot"""
+        state = self.rooms.get(room)
+        if state is not None:
+            state.waiting.pop(peer, None)
+
+    async def leave(self, room: str):
+        """The last local peer left ``room``"""
+        state = self.rooms.pop(room, None)
+        if state is None:
+            return
+        if state.lease_task is not None:
+            state.lease_task.cancel()
+        if state.owner and state.document is not None:
+            await self._persist_now(room, state.document)
+            if self.distributed:
+                await self._release(room)
+            self._publish(room, [_message({"k": "released"})])
+        await self.hub.backplane.unsubscribe(DOC_ROOM_PREFIX + room)
+
+    async def handle(self, room: str, peer: Peer, data: Dict[str, Any]):
+        """A document message from a local peer"""
+        state = self.rooms.get(room)
+        if state is None:
+            return
+        if data["type"] == "sync":
+            if state.document is not None:
+                epoch, seq = data.get("epoch"), data.get("seq")
+                position = (epoch, seq) if isinstance(epoch, int) and isinstance(seq, int) else None
+                self._catch_up(peer, state.document, position)
+            elif peer not in state.waiting:
+                state.waiting[peer] = None
+            return
+
+        patch_id = data.get("id")
+        try:
+            operations = data.get("ops")
+            if not isinstance(operations, list):
+                raise JsonPatchError("'ops' must be a list of operations")
+            base = parse_base(data)
+            validate_patch(operations)
+        except JsonPatchError as e:
+            peer.send(_message({"type": "reject", "id": patch_id, "error": str(e)}))
+            return
+
+        if state.owner:
+            self._apply(room, state, operations, base, peer, patch_id)
+            return
+        # Sequenced by the owner; the ack (or reject) comes back through the backplane
+        key = (peer.id, patch_id)
+        timer = asyncio.get_running_loop().call_later(COLLAB_FORWARD_TIMEOUT, self._forward_timed_out, key)
+        previous = self._forwarded.pop(key, None)
+        if previous is not None:
+            previous[1].cancel()
+        self._forwarded[key] = (peer, timer)
+        self._publish(room, [_message({
+            "k": "forward", "node": NODE_ID, "peer": peer.id, "id": patch_id, "base": base, "ops": operations,
+        })])
+
+    def _catch_up(self, peer: Peer, document: RoomDocument, position: Optional[Tuple[int, int]]):
+        """Bring ``peer`` from ``position`` to the document's current state"""
+        missed = document.missed_since(*position) if position is not None else None
+        if missed is not None and not peer.batch and len(missed) >= peer.free_slots():
+            missed = None  # Would overflow its queue
+        if missed is None:
+            if position is not None:
+                metrics.inc("collab_resume_snapshots")
+            peer.send(document.snapshot_message())
+            return
+        metrics.inc("collab_resumes")
+        metrics.inc("collab_resume_replayed", len(missed))
+        peer.send(_message({"type": "resumed", "epoch": document.epoch, "from": position[1], "seq": document.seq}))
+        if peer.batch and len(missed) > 1:
+            peer.send(batch_frame(missed))
+        else:
+            for message in missed:
+                peer.send(message)
+
+    def _forward_timed_out(self, key):
+        entry = self._forwarded.pop(key, None)
+        if entry is not None:
+            metrics.inc("collab_forward_timeouts")
+            entry[0].send(_message({"type": "reject", "id": key[1], "error": "No response from the room owner, retry"}))
+
+    def _apply(self, room: str, state: _Room, operations, base: Tuple[int, int], peer: Optional[Peer], patch_id,
+               origin_node: str = NODE_ID, origin_peer: Optional[str] = None):
+        document = state.document
+        author = f"{origin_node}:{origin_peer if peer is None else peer.id}"
+        try:
+            patch, operations = document.apply(operations, base, author)
+        except JsonPatchError as e:
+            metrics.inc("collab_patches_rejected")
+            reject = {"type": "reject", "id": patch_id, "error": str(e), "epoch": document.epoch, "seq": document.seq}
+            if peer is not None:
+                peer.send(_message(reject))
+            else:
+                self._publish(room, [_message({
+                    "k": "reject", "node": origin_node, "peer": origin_peer, "id": patch_id, "error": str(e),
+                })])
+            return
+
+        metrics.inc("collab_patches_applied")
+        document.unsaved.append(operations)
+        if peer is not None:
+            peer.send(_message({"type": "ack", "id": patch_id, "epoch": document.epoch, "seq": document.seq}))
+        self.hub.send_local(room, patch, exclude=peer)
+        self._publish(room, [_message({
+            "k": "op", "epoch": document.epoch, "seq": document.seq, "ops": operations,
+            "node": origin_node, "peer": origin_peer if peer is None else peer.id, "id": patch_id,
+        })])
+        self._schedule_persist(room, document)
+
+    # Other nodes
+
+    async def on_backplane(self, room: str, messages: List[str]):
+        state = self.rooms.get(room)
+        if state is None:
+            return
+        for raw in messages:
+            message = json.loads(raw)
+            kind = message["k"]
+            if kind == "forward" and state.owner:
+                self._apply(
+                    room, state, message["ops"], tuple(message["base"]), None, message["id"], message["node"], message["peer"]
+                )
+            elif kind == "op" and not state.owner:
+                self._replicate(room, state, message)
+            elif kind == "reject" and message["node"] == NODE_ID:
+                entry = self._forwarded.pop((message["peer"], message["id"]), None)
+                if entry is not None:
+                    entry[1].cancel()
+                    entry[0].send(_message({"type": "reject", "id": message["id"], "error": message["error"]}))
+            elif kind == "sync" and state.owner and state.document is not None:
+                self._publish_snapshot(room, state.document)
+            elif kind == "snapshot" and not state.owner:
+                self._adopt_snapshot(room, state, message)
+            elif kind == "persisted" and state.document is not None and not state.owner:
+                if message["epoch"] == state.document.epoch:
+                    state.document.saved_seq = message["seq"]
+                state.document.version = message["version"]
+                self.hub.send_local(room, _message({"type": "saved", "version": message["version"]}))
+            elif kind == "released" and not state.owner:
+                async with state.lock:
+                    await self._acquire(room, state)
+
+    def _replicate(self, room: str, state: _Room, message: Dict[str, Any]):
+        document = state.document
+        origin = None
+        if message["node"] == NODE_ID:
+            entry = self._forwarded.pop((message["peer"], message["id"]), None)
+            if entry is not None:
+                entry[1].cancel()
+                origin = entry[0]
+
+        patch = None
+        if document is not None and message["epoch"] == document.epoch and message["seq"] == document.seq + 1:
+            try:
+                patch, _ = document.apply(message["ops"])
+            except JsonPatchError:
+                document = None
+        else:
+            document = None
+        if document is None:
+            # Missed part of the stream: ask the owner for a fresh snapshot
+            state.document = None
+            state.broken = True
+            self._request_sync(room, state)
+
+        if origin is not None:
+            origin.send(_message({"type": "ack", "id": message["id"], "epoch": message["epoch"], "seq": message["seq"]}))
+        if patch is None:
+            patch = _message({"type": "patch", "epoch": message["epoch"], "seq": message["seq"], "ops": message["ops"]})
+        self.hub.send_local(room, patch, exclude=origin)
+
+    def _request_sync(self, room: str, state: _Room):
+        now = asyncio.get_running_loop().time()
+        if now - state.sync_requested_at >= _SYNC_INTERVAL:
+            state.sync_requested_at = now
+            metrics.inc("collab_replica_syncs")
+            self._publish(room, [_message({"k": "sync"})])
+
+    def _adopt_snapshot(self, room: str, state: _Room, message: Dict[str, Any]):
+        document = state.document
+        if document is not None and (message["epoch"], message["seq"]) <= (document.epoch, document.seq):
+            return
+        snapshot = RoomDocument(
+            uuid.UUID(room), message["data"], message["version"], message["epoch"], message["seq"], message["saved_seq"]
+        )
+        snapshot.load_replay(message["replay"])
+        state.document = snapshot
+        # Joiners waiting for it catch up; everyone else gets the snapshot only
+        # if the stream they followed was broken (a gap, a new owner or a merge)
+        self._release_waiting(state, snapshot, state.broken or message["reset"] or document is not None)
+
+    def _publish_snapshot(self, room: str, document: RoomDocument, reset: bool = False):
+        if not self.distributed:
+            return
+        # The replay buffer goes along so joiners on other nodes can resume too
+        replay = json.dumps([entry[1] for entry in document.replay])
+        self._publish(room, [
+            f'{{"k":"snapshot","epoch":{document.epoch},"seq":{document.seq},"version":{document.version},'
+            f'"saved_seq":{document.saved_seq},"reset":{"true" if reset else "false"},"replay":{replay},'
+            f'"data":{document.data_json()}}}'
+        ])
+
+    def _release_waiting(self, state: _Room, document: RoomDocument, everyone: bool):
+        if everyone:
+            for peer in self.hub.rooms.get(state.room, ()):
+                if peer not in state.waiting:
+                    peer.send(document.snapshot_message())
+        for peer, position in state.waiting.items():
+            self._catch_up(peer, document, position)
+        state.waiting = {}
+        state.broken = False
+
+    # Ownership
+
+    async def _acquire(self, room: str, state: _Room):
+        """Become the room's owner if nobody else is, otherwise ask for a snapshot"""
+        epoch = await self._claim(room) if self.distributed else 1
+        if epoch is None:
+            if state.document is None:
+                self._request_sync(room, state)
+            return
+
+        document = state.document
+        takeover = document is not None or state.broken
+        if document is None:
+            async with SessionLocal() as db:
+                row = (await db.execute(
+                    select(Project.data, Project.version).where(Project.id == uuid.UUID(room))
+                )).first()
+            if row is None:
+                return
+            document = RoomDocument(uuid.UUID(room), row.data, row.version, epoch)
+            document.saved_json = document.data_json()
+        else:
+            # Taking over from a replica, which may hold edits the previous
+            # owner never saved: write those back right away
+            unsaved = document.seq > document.saved_seq
+            document.reset(document.data, document.version, epoch, 0, 0 if not unsaved else -1)
+            if unsaved:
+                document.saved_json = None  # Unknown: a REST write in between is merged without rebasing
+            else:
+                document.saved_json = document.data_json()
+            if unsaved:
+                document.unsaved.append([])
+                self._start_persist(room, document)
+        state.document = document
+        state.owner = True
+        metrics.inc("collab_room_ownerships")
+        self._publish_snapshot(room, document, reset=True)
+        # Local peers that followed the previous owner restart from the new epoch
+        self._release_waiting(state, document, takeover)
+
+    async def _claim(self, room: str) -> Optional[int]:
+        """Take or renew the room's lease; its epoch, or None if another node holds it"""
+        statement = insert(CollabRoomLease).values(
+            project_id=uuid.UUID(room),
+            node_id=NODE_ID,
+            epoch=1,
+            expires_at=func.now() + timedelta(seconds=COLLAB_LEASE_TTL),
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[CollabRoomLease.project_id],
+            set_={
+                "node_id": statement.excluded.node_id,
+                "epoch": CollabRoomLease.epoch + case((CollabRoomLease.node_id == statement.excluded.node_id, 0), else_=1),
+                "expires_at": statement.excluded.expires_at,
+            },
+            where=(CollabRoomLease.node_id == statement.excluded.node_id) | (CollabRoomLease.expires_at < func.now()),
+        ).returning(CollabRoomLease.epoch)
+        async with SessionLocal() as db:
+            epoch = (await db.execute(statement)).scalar()
+            await db.commit()
+        return epoch
+
+    async def _release(self, room: str):
+        # Expired rather than deleted so the next owner still bumps the epoch
+        try:
+            async with SessionLocal() as db:
+                await db.execute(
+                    update(CollabRoomLease)
+                    .where(CollabRoomLease.project_id == uuid.UUID(room), CollabRoomLease.node_id == NODE_ID)
+                    .values(expires_at=func.now() - timedelta(seconds=1))
+                )
+                await db.commit()
+        except SQLAlchemyError as e:
+            logger.warning("collab lease release failed room=%s error=%s", room, e)
+
+    async def _keep_lease(self, room: str):
+        while True:
+            await asyncio.sleep(COLLAB_LEASE_TTL / 3)
+            state = self.rooms.get(room)
+            if state is None:
+                return
+            try:
+                async with state.lock:
+                    if state.owner:
+                        if await self._claim(room) is None:
+                            # Paused past the lease and someone else took over
+                            metrics.inc("collab_room_ownerships_lost")
+                            state.owner = False
+                            state.document = None
+                            state.broken = True
+                            self._request_sync(room, state)
+                    else:
+                        await self._acquire(room, state)
+            except SQLAlchemyError as e:
+                logger.warning("collab lease renewal failed room=%s error=%s", room, e)
+
+    # Persistence
+
+    def _schedule_persist(self, room: str, document: RoomDocument):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if document.first_unsaved is None:
+            document.first_unsaved = now
+        delay = min(COLLAB_PERSIST_DELAY, document.first_unsaved + COLLAB_PERSIST_MAX_DELAY - now)
+        if document.timer is not None:
+            document.timer.cancel()
+        document.timer = loop.call_later(max(delay, 0), self._start_persist, room, document)
+
+    def _start_persist(self, room: str, document: RoomDocument):
+        document.timer = None
+        if document.persisting is None or document.persisting.done():
+            document.persisting = asyncio.get_running_loop().create_task(self._persist(room, document))
+
+    async def _persist_now(self, room: str, document: RoomDocument):
+        if document.timer is not None:
+            document.timer.cancel()
+            document.timer = None
+        if document.persisting is not None:
+            await asyncio.gather(document.persisting, return_exceptions=True)
+        if document.unsaved:
+            await self._persist(room, document)
+
+    async def _persist(self, room: str, document: RoomDocument):
+        """Write the document back as one new project version"""
+        if not document.unsaved:
+            return
+        # Every patch not written yet: kept across conflict retries until a write succeeds
+        saving = []
+        while True:
+            saved_json = document.data_json()
+            data = json.loads(saved_json)  # the state as of now, unaffected by later patches
+            seq = document.seq
+            saving = saving + document.unsaved
+            document.unsaved, document.first_unsaved = [], None
+            try:
+                async with SessionLocal() as db:
+                    project = await ProjectService.update_project(
+                        db, document.project_id, data=data, expected_versions={document.version}
+                    )
+                    if project is not None:
+                        break
+                    # Written outside the room (REST) since we loaded it:
+                    # replay our patches on top of that version and retry
+                    row = (await db.execute(
+                        select(Project.data, Project.version).where(Project.id == document.project_id)
+                    )).first()
+            except SQLAlchemyError as e:
+                metrics.inc("collab_persist_failures")
+                logger.warning("collab room save failed room=%s error=%s", room, e)
+                document.unsaved = saving + document.unsaved
+                self._schedule_persist(room, document)
+                return
+            if row is None:
+                return  # Project deleted
+
+            saving = document.rebase_onto(row.data, row.version, saving)
+            metrics.inc("collab_persist_conflicts")
+            self.hub.send_local(room, document.snapshot_message())
+            self._publish_snapshot(room, document, reset=True)
+
+        document.version, document.saved_seq, document.saved_json = project.version, seq, saved_json
+        metrics.inc("collab_persists")
+        self.hub.send_local(room, _message({"type": "saved", "version": project.version}))
+        self._publish(room, [_message({
+            "k": "persisted", "version": project.version, "epoch": document.epoch, "seq": seq,
+        })])
+        if document.unsaved and document.timer is None:
+            # Patches that arrived while writing wait for their own debounce
+            self._schedule_persist(room, document)
+
+    async def close(self):
+        """Save and release every owned room (shutdown)"""
+        for room, state in list(self.rooms.items()):
+            if state.lease_task is not None:
+                state.lease_task.cancel()
+            if state.owner and state.document is not None:
+                await self._persist_now(room, state.document)
+                if self.distributed:
+                    await self._release(room)
+        self.rooms.clear()
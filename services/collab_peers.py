@@ -0,0 +1,118 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Optional
+from fastapi import WebSocket, status
+from services.collab_codecs import WireFormat
+from services.metrics import metrics
+
+# Messages waiting to be written to one websocket
+COLLAB_SEND_QUEUE_SIZE = max(1, int(os.getenv("COLLAB_SEND_QUEUE_SIZE", "256")))
+# What happens when a peer's queue is full:
+#   drop_oldest - discard the oldest queued message (default)
+#   drop_newest - discard the message being sent
+#   disconnect  - close the peer (1013) so it reconnects and resyncs
+COLLAB_SLOW_PEER_POLICY = os.getenv("COLLAB_SLOW_PEER_POLICY", "drop_oldest").lower()
+# A single write taking longer than this means the peer is stalled; it is closed
+COLLAB_SEND_TIMEOUT = float(os.getenv("COLLAB_SEND_TIMEOUT", "10"))
+
+SLOW_PEER_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+if COLLAB_SLOW_PEER_POLICY not in SLOW_PEER_POLICIES:
+    raise ValueError(f"COLLAB_SLOW_PEER_POLICY must be one of {', '.join(SLOW_PEER_POLICIES)}")
+
+
+class Peer:
+    """A websocket with a bounded outbound queue drained by its own task.
+
+    ``send`` never waits, so a slow or stalled client only delays itself:
+    broadcasts, the backplane and the sender's receive loop keep going.
+    """
+
+    def __init__(self, ws: WebSocket, batch: bool = False, wire: Optional[WireFormat] = None,
+                 max_queue: int = COLLAB_SEND_QUEUE_SIZE, policy: str = COLLAB_SLOW_PEER_POLICY,
+                 send_timeout: float = COLLAB_SEND_TIMEOUT):
+        self.ws = ws
+        self.id = uuid.uuid4().hex
+        self.batch = batch  # accepts batched frames (see services/collab_batching.py)
+        self.wire = wire if wire is not None else WireFormat()  # see services/collab_codecs.py
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._writer = asyncio.create_task(self._drain())
+
+    def send(self, message: str) -> bool:
+        """Queue ``message``; False if it (or the peer) was dropped"""
+        if self.closed:
+            return False
+        if self._queue.full():
+            if self.policy == "disconnect":
+                metrics.inc("collab_slow_peer_disconnects")
+                self.abort()
+                return False
+            metrics.inc("collab_send_dropped")
+            if self.policy == "drop_newest":
+                return False
+            self._queue.get_nowait()
+        self._queue.put_nowait((time.perf_counter(), message))
+        return True
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def free_slots(self) -> int:
+        """Messages that can still be queued without dropping any"""
+        return self._queue.maxsize - self._queue.qsize()
+
+    async def _drain(self):
+        # Not ``while True``: before Python 3.12, wait_for swallows a cancel
+        # that races with a finished write and close() would wait forever
+        while not self.closed:
+            queued_at, message = await self._queue.get()
+            try:
+                frame = self.wire.encode(message)
+            except (TypeError, ValueError, OverflowError):
+                frame = message  # Not representable in the codec (e.g. huge integers)
+                metrics.inc("collab_encode_fallbacks")
+            try:
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(self.ws.send_bytes(frame), self.send_timeout)
+                else:
+                    await asyncio.wait_for(self.ws.send_text(frame), self.send_timeout)
+            except asyncio.TimeoutError:
+                metrics.inc("collab_slow_peer_disconnects")
+                self.abort()
+                return
+            except Exception:
+                # Peer went away; its receive loop will notice and leave the room
+                metrics.inc("collab_send_failures")
+                self.closed = True
+                return
+            metrics.inc("collab_frames_sent")
+            metrics.mark("collab_frames_sent")
+            metrics.observe("collab_send_latency_seconds", time.perf_counter() - queued_at)
+
+    def abort(self, code: int = status.WS_1013_TRY_AGAIN_LATER):
+        """Stop writing and close the socket in the background"""
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.cancel()
+        asyncio.get_running_loop().create_task(self._close(code))
+
+    async def _close(self, code: int):
+        try:
+            await asyncio.wait_for(self.ws.close(code=code), self.send_timeout)
+        except Exception:
+            pass  # Already gone or stalled; the server drops the connection
+
+    async def close(self):
+        """Discard queued messages and stop the writer (the socket is closing anyway)"""
+        self.closed = True
+        self._writer.cancel()
+        try:
+            await self._writer
+        except (asyncio.CancelledError, Exception):
+            pass
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+from fastapi import WebSocket
+from sqlalchemy.exc import SQLAlchemyError
+from services.collab_backplane import Backplane, create_backplane
+from services.collab_batching import COLLAB_COALESCE_TICK, parse_message, coalesce_key, batch_item, batch_frame
+from services.collab_codecs import WireFormat
+from services.collab_documents import DocumentManager, DOC_ROOM_PREFIX, DOCUMENT_MESSAGE_TYPES
+from services.collab_peers import Peer
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# (sender, message); the sender is None for messages from other nodes
+Item = Tuple[Optional[Peer], str]
+
+
+class RoomHub:
+    """Websockets connected to this process, per room, linked to the other
+    nodes through the backplane (subscribed while a room has local peers).
+
+    High-frequency updates are coalesced per room for COLLAB_COALESCE_TICK
+    and every flush goes out as one unit: one frame per batching peer and
+    one backplane publish. Any other message flushes what is pending first,
+    so the order senders produced is kept.
+
+    Document messages (patch, sync) are not relayed but handled by the
+    room's DocumentManager, which holds the project data.
+    """
+
+    def __init__(self, backplane: Optional[Backplane] = None):
+        self.rooms: Dict[str, List[Peer]] = {}
+        self._backplane = backplane
+        self._pending: Dict[str, "OrderedDict[Hashable, Item]"] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._outbox: Dict[str, List[str]] = {}
+        self._publishers: Dict[str, asyncio.Task] = {}
+        self.documents = DocumentManager(self)
+        metrics.register_collector(self._collect_metrics)
+
+    @property
+    def backplane(self) -> Backplane:
+        if self._backplane is None:
+            self._backplane = create_backplane(self._deliver)
+        return self._backplane
+
+    async def join(self, room: str, ws: WebSocket, batch: bool = False,
+                   position: Optional[Tuple[int, int]] = None, wire: Optional[WireFormat] = None) -> Peer:
+        """Add ``ws`` to ``room``; it gets a snapshot, or only what it missed
+        since ``position`` (epoch, seq) when resuming"""
+        peer = Peer(ws, batch=batch, wire=wire)
+        peers = self.rooms.setdefault(room, [])
+        peers.append(peer)
+        if len(peers) == 1:
+            await self.backplane.subscribe(room)
+        await self.documents.join(room, peer, position)
+        return peer
+
+    async def leave(self, room: str, peer: Peer):
+        await peer.close()
+        peers = self.rooms.get(room)
+        if peers is None or peer not in peers:
+            return
+        peers.remove(peer)
+        self.documents.forget(room, peer)
+        if not peers:
+            self._flush(room)
+            self.rooms.pop(room, None)
+            await self.backplane.unsubscribe(room)
+            await self.documents.leave(room)
+
+    async def broadcast(self, room: str, message: str, sender: Optional[Peer] = None):
+        """Relay ``message`` to the other local peers and to the other nodes"""
+        metrics.inc("collab_messages_received")
+        metrics.mark("collab_messages_received")
+        data = parse_message(message)
+        if data is not None and data.get("type") in DOCUMENT_MESSAGE_TYPES:
+            self._flush(room)
+            await self.documents.handle(room, sender, data)
+            return
+        key = coalesce_key(data, sender)
+        if key is None:
+            self._flush(room, (sender, message))
+            return
+
+        pending = self._pending.setdefault(room, OrderedDict())
+        if pending.pop(key, None) is not None:
+            metrics.inc("collab_messages_coalesced")
+        pending[key] = (sender, message)
+        if room not in self._timers:
+            self._timers[room] = asyncio.get_running_loop().call_later(COLLAB_COALESCE_TICK, self._flush, room)
+
+    def _flush(self, room: str, extra: Optional[Item] = None):
+        timer = self._timers.pop(room, None)
+        if timer is not None:
+            timer.cancel()
+        items = list(self._pending.pop(room, {}).values())
+        if extra is not None:
+            items.append(extra)
+        if items:
+            self._fan_out(room, items)
+            self.publish(room, [message for _, message in items])
+
+    def _fan_out(self, room: str, items: List[Item]):
+        # Only queues: each peer's own task does the writing
+        start = time.perf_counter()
+        senders = {sender for sender, _ in items}
+        shared_frame = None
+        for peer in self.rooms.get(room, ()):
+            if peer in senders:
+                own = [(sender, message) for sender, message in items if sender is not peer]
+                if own:
+                    self._send(peer, own)
+            elif peer.batch and len(items) > 1:
+                if shared_frame is None:
+                    shared_frame = batch_frame([batch_item(message) for _, message in items])
+                peer.send(shared_frame)
+            else:
+                self._send(peer, items)
+        metrics.observe("collab_fanout_seconds", time.perf_counter() - start)
+
+    @staticmethod
+    def _send(peer: Peer, items: List[Item]):
+        if peer.batch and len(items) > 1:
+            peer.send(batch_frame([batch_item(message) for _, message in items]))
+        else:
+            for _, message in items:
+                peer.send(message)
+
+    def send_local(self, room: str, message: str, exclude: Optional[Peer] = None):
+        """Queue a server message for the local peers of ``room``, after anything pending"""
+        self._flush(room)
+        for peer in self.rooms.get(room, ()):
+            if peer is not exclude:
+                peer.send(message)
+
+    def publish(self, room: str, messages: List[str]):
+        # Queued synchronously so publishes keep the order of the flushes;
+        # whatever piles up while one is in flight goes out as one publish
+        self._outbox.setdefault(room, []).extend(messages)
+        if room not in self._publishers:
+            self._publishers[room] = asyncio.get_running_loop().create_task(self._run_publisher(room))
+
+    async def _run_publisher(self, room: str):
+        try:
+            while self._outbox.get(room):
+                messages = self._outbox.pop(room)
+                try:
+                    await self.backplane.publish(room, messages)
+                except (SQLAlchemyError, OSError) as e:
+                    # Local peers already have them; remote ones miss these messages
+                    metrics.inc("collab_backplane_publish_failures")
+                    logger.warning("collab publish failed room=%s error=%s", room, e)
+        finally:
+            self._publishers.pop(room, None)
+
+    async def _deliver(self, room: str, messages: List[str]):
+        """Messages published by another node"""
+        if room.startswith(DOC_ROOM_PREFIX):
+            await self.documents.on_backplane(room[len(DOC_ROOM_PREFIX):], messages)
+        else:
+            self._fan_out(room, [(None, message) for message in messages])
+
+    def _collect_metrics(self):
+        # Computed when /metrics is read rather than on every join or send
+        sizes = [len(peers) for peers in self.rooms.values()]
+        depths = [peer.queued for peers in self.rooms.values() for peer in peers]
+        metrics.set_gauge("collab_rooms", len(sizes))
+        metrics.set_gauge("collab_peers", sum(sizes))
+        metrics.set_gauge("collab_room_peers_max", max(sizes, default=0))
+        metrics.set_gauge("collab_room_peers_avg", sum(sizes) / len(sizes) if sizes else 0)
+        metrics.set_gauge("collab_send_queue_depth", sum(depths))
+        metrics.set_gauge("collab_send_queue_depth_max", max(depths, default=0))
+
+    async def close(self):
+        for room in list(self._timers):
+            self._flush(room)
+        await self.documents.close()
+        if self._publishers:
+            await asyncio.gather(*self._publishers.values(), return_exceptions=True)
+        if self._backplane is not None:
+            await self._backplane.close()
+
+
+hub = RoomHub()
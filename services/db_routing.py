@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from models.database import SessionLocal, ReplicaSessionLocal
+from services.auth_cache import get_token_subject
+from services.cache import TTLCache
+from services.metrics import metrics
+
+# How long a writer's reads may wait for the replica to replay its commit
+# before the guarantee lapses (they go to the primary in the meantime)
+READ_YOUR_WRITES_TTL = float(os.getenv("READ_YOUR_WRITES_TTL", "60"))
+# After a replica error, reads stay on the primary for this long
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+
+_optional_bearer = HTTPBearer(auto_error=False)
+
+# token subject -> primary WAL position of its last commit ("" until known)
+_recent_writes = TTLCache("read_your_writes", max_size=10000, ttl=READ_YOUR_WRITES_TTL)
+_LSN_PENDING = ""
+
+_replica_down_until = 0.0
+
+
+def _subject(credentials: Optional[HTTPAuthorizationCredentials]) -> Optional[str]:
+    return get_token_subject(credentials.credentials) if credentials else None
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_writer(session):
+    # Runs before the response goes out, so the next read already avoids
+    # the replica even though the commit's WAL position is not known yet
+    subject = session.info.get("writer")
+    if subject:
+        _recent_writes.set(subject, _LSN_PENDING)
+        session.info["committed"] = True
+
+
+async def get_db(credentials: Optional[HTTPAuthorizationCredentials] = Depends(_optional_bearer)):
+    """Primary session; commits are remembered per user for read-your-writes"""
+    async with SessionLocal() as db:
+        subject = _subject(credentials) if ReplicaSessionLocal is not None else None
+        if subject:
+            db.info["writer"] = subject
+        yield db
+
+        if db.info.get("committed"):
+            try:
+                lsn = (await db.execute(text("SELECT pg_current_wal_lsn()::text"))).scalar()
+                _recent_writes.set(subject, lsn)
+            except SQLAlchemyError:
+                pass  # Stays pending: the user keeps reading from the primary
+
+
+async def _replica_ready(db, lsn: Optional[str]) -> bool:
+    """Connect to the replica and, for a recent writer, check it has replayed ``lsn``"""
+    if not lsn:
+        await db.connection()
+        return True
+    result = await db.execute(
+        text("SELECT pg_last_wal_replay_lsn() >= CAST(CAST(:lsn AS text) AS pg_lsn)"), {"lsn": lsn}
+    )
+    return bool(result.scalar())
+
+
+@asynccontextmanager
+async def read_session(subject: Optional[str] = None):
+    """Session for reads: the replica when configured, healthy and caught up
+    with ``subject``'s own writes, otherwise the primary"""
+    global _replica_down_until
+
+    db = None
+    if ReplicaSessionLocal is not None and time.monotonic() >= _replica_down_until:
+        lsn = _recent_writes.get(subject) if subject else None
+        if lsn != _LSN_PENDING:
+            db = ReplicaSessionLocal()
+            db.info["replica"] = True
+            try:
+                ready = await _replica_ready(db, lsn)
+            except (SQLAlchemyError, OSError, asyncio.TimeoutError):
+                _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+                metrics.inc("db_replica_failures")
+                ready = False
+            if ready and lsn:
+                _recent_writes.pop(subject)
+            if not ready:
+                await db.close()
+                db = None
+
+    if db is None:
+        db = SessionLocal()
+        metrics.inc("db_reads_primary")
+    else:
+        metrics.inc("db_reads_replica")
+    async with db:
+        yield db
+
+
+async def get_read_db(credentials: Optional[HTTPAuthorizationCredentials] = Depends(_optional_bearer)):
+    """Dependency for read-only endpoints (see read_session)"""
+    async with read_session(_subject(credentials)) as db:
+        yield db
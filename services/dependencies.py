@@ -1,38 +1,55 @@
+from typing import Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from models.database import get_db
-from models.user import User
-from services.auth_service import verify_token
+from models.database import SessionLocal
+from services.db_routing import read_session
+from models.schemas import User
+from services.auth_cache import get_token_subject, get_cached_user, cache_user
 from services.user_service import UserService
 
 security = HTTPBearer()
 
 
-def get_current_user(
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
 ) -> User:
-    """Get current authenticated user"""
+    """Get current authenticated user (served from the auth cache when possible)"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
+
     token = credentials.credentials
-    email = verify_token(token)
-    
+    email = get_token_subject(token)
+
     if email is None:
         raise credentials_exception
-    
-    user = UserService.get_user_by_email(db, email=email)
+
+    user = await load_user(email)
     if user is None:
         raise credentials_exception
-    
     return user
 
 
+async def load_user(email: str) -> Optional[User]:
+    """The user with this email, from the auth cache or the database"""
+    user = get_cached_user(email)
+    if user is not None:
+        return user
+
+    async with read_session(email) as db:
+        db_user = await UserService.get_user_by_email(db, email=email)
+    if db_user is None and db.info.get("replica"):
+        # A user who just registered may not have reached the replica yet
+        async with SessionLocal() as primary:
+            db_user = await UserService.get_user_by_email(primary, email=email)
+    if db_user is None:
+        return None
+
+    return cache_user(db_user)
+
+
 
 def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
     """Get current active user (for future use if you add user status)"""
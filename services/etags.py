@@ -0,0 +1,42 @@
+from typing import Optional, Set, Tuple
+
+
+def make_etag(version: int) -> str:
+    """Strong ETag for a project version"""
+    return f'"v{version}"'
+
+
+def parse_etag_header(header: Optional[str], allow_weak: bool = True) -> Tuple[bool, Set[int]]:
+    """Parse If-Match / If-None-Match into (wildcard, versions).
+
+    Unknown or foreign tags are ignored. If-Match must use strong
+    comparison, so pass ``allow_weak=False`` for it.
+    """
+    if not header:
+        return False, set()
+    if header.strip() == "*":
+        return True, set()
+
+    versions = set()
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not allow_weak:
+                continue
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag.startswith("v") and tag[1:].isdigit():
+            versions.add(int(tag[1:]))
+    return False, versions
+
+
+def if_match_versions(header: Optional[str]) -> Optional[Set[int]]:
+    """Versions a write may apply to, or None when unconditional.
+
+    An If-Match header without any recognisable tag yields an empty set,
+    which can never match (the write fails with 412).
+    """
+    if header is None:
+        return None
+    wildcard, versions = parse_etag_header(header, allow_weak=False)
+    return None if wildcard else versions
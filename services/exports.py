@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
+from models.database import SessionLocal
+from models.export_manifest import ExportManifest
+from services.archives import ArchiveFormat, list_files
+from services.cache import TTLCache
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Manifests no export has produced for this long are deleted; a delta
+# against one of them gets the full archive instead
+EXPORT_MANIFEST_TTL = float(os.getenv("EXPORT_MANIFEST_TTL", str(30 * 24 * 3600)))
+EXPORT_MANIFEST_CACHE_SIZE = int(os.getenv("EXPORT_MANIFEST_CACHE_SIZE", "256"))
+
+# Added to delta archives: {"base": <id>, "manifest": <id>, "deleted": [<path>, ...]}
+DELTA_FILE = ".flutter_builder_delta.json"
+
+Manifest = Dict[str, str]  # path -> sha256 of its content
+
+# A manifest never changes (its id is its hash), so only size bounds this
+_manifests = TTLCache("export_manifest", max_size=EXPORT_MANIFEST_CACHE_SIZE, ttl=EXPORT_MANIFEST_TTL)
+_MANIFEST_ID = re.compile(r"^[0-9a-f]{64}$")
+_last_cleanup = 0.0
+
+
+class ProjectExport:
+    """A generated archive: the whole project, or only what changed since ``base_id``"""
+
+    def __init__(self, path: str, manifest_id: str, files: Manifest,
+                 base_id: Optional[str] = None, changed: Optional[List[str]] = None, deleted: Optional[List[str]] = None):
+        self.path = path
+        self.manifest_id = manifest_id
+        self.files = files
+        self.base_id = base_id
+        self.changed = changed
+        self.deleted = deleted
+
+    @property
+    def is_delta(self) -> bool:
+        return self.base_id is not None
+
+
+def build_manifest(source_dir: str) -> Manifest:
+    files = {}
+    for path, name in list_files(source_dir):
+        with open(path, "rb") as f:
+            files[name] = hashlib.sha256(f.read()).hexdigest()
+    return files
+
+
+def manifest_id(files: Manifest) -> str:
+    return hashlib.sha256(json.dumps(files, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def write_export(source_dir: str, path: str, archive_format: ArchiveFormat,
+                 base: Optional[Tuple[str, Manifest]] = None) -> ProjectExport:
+    """Archive ``source_dir`` to ``path``; with ``base`` (id, manifest) only
+    the files added or changed since, plus DELTA_FILE listing the deleted ones"""
+    files = build_manifest(source_dir)
+    export_id = manifest_id(files)
+    if base is None:
+        archive_format.write(source_dir, path)
+        metrics.inc("export_full")
+        return ProjectExport(path, export_id, files)
+
+    base_id, base_files = base
+    changed = [name for name, digest in files.items() if base_files.get(name) != digest]
+    deleted = sorted(name for name in base_files if name not in files)
+    with open(os.path.join(source_dir, DELTA_FILE), "w", encoding="utf-8") as f:
+        json.dump({"base": base_id, "manifest": export_id, "deleted": deleted}, f, indent=2)
+    archive_format.write(source_dir, path, only={*changed, DELTA_FILE})
+    metrics.inc("export_delta")
+    metrics.observe("export_delta_files", len(changed) + len(deleted))
+    return ProjectExport(path, export_id, files, base_id, changed, deleted)
+
+
+async def load_base(export_id: Optional[str]) -> Optional[Tuple[str, Manifest]]:
+    """(id, manifest) of an earlier export to build a delta against; None
+    (a full export) when there is none or it is unknown, expired or unreadable"""
+    if not export_id:
+        return None
+    if not _MANIFEST_ID.match(export_id):
+        metrics.inc("export_base_missing")
+        return None
+    files = _manifests.get(export_id)
+    if files is not None:
+        return export_id, files
+    try:
+        async with SessionLocal() as db:
+            files = (await db.execute(
+                select(ExportManifest.files).where(ExportManifest.id == export_id)
+            )).scalar_one_or_none()
+    except (SQLAlchemyError, OSError) as e:
+        logger.warning("export manifest load failed id=%s error=%s", export_id, e)
+        return None
+    if files is None:
+        metrics.inc("export_base_missing")
+        return None
+    _manifests.set(export_id, files)
+    return export_id, files
+
+
+async def save_manifest(export: ProjectExport):
+    """Remember the manifest of ``export`` so later exports can be deltas against it.
+
+    Failures are only logged: the export itself is complete, a later delta
+    request against it simply gets the full archive.
+    """
+    global _last_cleanup
+    try:
+        async with SessionLocal() as db:
+            await db.execute(
+                pg_insert(ExportManifest)
+                .values(id=export.manifest_id, files=export.files)
+                .on_conflict_do_update(index_elements=[ExportManifest.id], set_={"used_at": func.now()})
+            )
+            # Expired manifests, at most once per hour per worker
+            if time.monotonic() - _last_cleanup > 3600:
+                _last_cleanup = time.monotonic()
+                await db.execute(delete(ExportManifest).where(
+                    ExportManifest.used_at < func.now() - timedelta(seconds=EXPORT_MANIFEST_TTL)
+                ))
+            await db.commit()
+    except (SQLAlchemyError, OSError) as e:
+        logger.warning("export manifest save failed id=%s error=%s", export.manifest_id, e)
+        return
+    _manifests.set(export.manifest_id, export.files)
@@ -5,9 +5,8 @@ import uuid
 from io import BytesIO
 from typing import Optional
 import os
-from dotenv import load_dotenv
+import config  # noqa: F401  (loads .env)
 
-load_dotenv()
 
 class ImageService:
     def __init__(self):
@@ -0,0 +1,509 @@
+import copy
+import difflib
+import json
+import marshal
+import re
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+# Upper bound on operations per request; each one becomes a CTE step
+MAX_PATCH_OPERATIONS = 500
+
+PATCH_OPERATIONS = {"add", "remove", "replace", "move", "copy", "test"}
+
+# RFC 6901 array indexes: "0" or digits without a leading zero. Postgres
+# also reads "-1" or "01" as positions in arrays, so integer-like tokens
+# that are not canonical are rejected (as object keys too)
+_ARRAY_INDEX = re.compile(r"^(0|[1-9][0-9]*)$")
+_INTEGER_LIKE = re.compile(r"^-?[0-9]+$")
+
+
+class JsonPatchError(ValueError):
+    """Raised for malformed RFC 6902 documents"""
+
+
+def parse_pointer(pointer: str) -> List[str]:
+    """Split an RFC 6901 JSON pointer into its unescaped reference tokens"""
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JsonPatchError(f"Invalid JSON pointer: {pointer!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def _is_index(token: str) -> bool:
+    return bool(_ARRAY_INDEX.match(token))
+
+
+def _check_tokens(tokens: List[str], index: int) -> List[str]:
+    for token in tokens:
+        if _INTEGER_LIKE.match(token) and not _is_index(token):
+            raise JsonPatchError(f"Operation {index}: invalid array index {token!r}")
+    return tokens
+
+
+def format_pointer(tokens: List[str]) -> str:
+    """Inverse of parse_pointer"""
+    return "".join("/" + _escape(token) for token in tokens)
+
+
+def validate_patch(operations: List[Dict[str, Any]], limit: Optional[int] = MAX_PATCH_OPERATIONS) -> List[Dict[str, Any]]:
+    """Check operation names and required members, returning the parsed operations"""
+    if limit is not None and len(operations) > limit:
+        raise JsonPatchError(f"A patch may contain at most {limit} operations")
+
+    parsed = []
+    for index, operation in enumerate(operations):
+        op = operation.get("op")
+        if op not in PATCH_OPERATIONS:
+            raise JsonPatchError(f"Operation {index}: unknown op {op!r}")
+        if "path" not in operation:
+            raise JsonPatchError(f"Operation {index}: missing 'path'")
+        step = {"op": op, "path": _check_tokens(parse_pointer(operation["path"]), index)}
+        if op in ("add", "replace", "test"):
+            if "value" not in operation:
+                raise JsonPatchError(f"Operation {index}: missing 'value'")
+            step["value"] = operation["value"]
+        if op in ("move", "copy"):
+            if "from" not in operation:
+                raise JsonPatchError(f"Operation {index}: missing 'from'")
+            step["from"] = _check_tokens(parse_pointer(operation["from"]), index)
+            if op == "move" and step["path"][:len(step["from"])] == step["from"] and step["path"] != step["from"]:
+                raise JsonPatchError(f"Operation {index}: cannot move a value into one of its children")
+        if op == "remove" and not step["path"]:
+            raise JsonPatchError(f"Operation {index}: cannot remove the document root")
+        parsed.append(step)
+    return parsed
+
+
+def _add_expression(base: str, path: List[str], value: str, params: Dict[str, Any], name: str) -> Tuple[str, str]:
+    """SQL expression inserting ``value`` at ``path`` in ``base`` plus its precondition"""
+    if not path:
+        return value, "true"
+
+    parent = path[:-1]
+    last = path[-1]
+    params[f"{name}_parent"] = parent
+    parent_sql = f"({base} #> CAST(:{name}_parent AS text[]))"
+    parent_exists = f"{parent_sql} IS NOT NULL"
+
+    if last == "-":
+        params[f"{name}_path"] = parent + ["-1"]
+        expression = f"jsonb_insert({base}, CAST(:{name}_path AS text[]), {value}, true)"
+        return expression, f"jsonb_typeof{parent_sql} = 'array'"
+
+    params[f"{name}_path"] = path
+    set_sql = f"jsonb_set({base}, CAST(:{name}_path AS text[]), {value}, true)"
+    if not _is_index(last):
+        return set_sql, f"jsonb_typeof{parent_sql} = 'object'"
+
+    # A numeric token inserts into arrays but is a plain key on objects
+    expression = (
+        f"CASE WHEN jsonb_typeof{parent_sql} = 'array' "
+        f"THEN jsonb_insert({base}, CAST(:{name}_path AS text[]), {value}) "
+        f"ELSE {set_sql} END"
+    )
+    condition = (
+        f"{parent_exists} AND (jsonb_typeof{parent_sql} = 'object' OR "
+        f"(jsonb_typeof{parent_sql} = 'array' AND {int(last)} <= jsonb_array_length{parent_sql}))"
+    )
+    return expression, condition
+
+
+def build_patch_statement(operations: List[Dict[str, Any]], expected_versions: Optional[Set[int]] = None) -> Tuple[str, Dict[str, Any]]:
+    """Translate parsed operations into one UPDATE on ``project.data``.
+
+    Each operation becomes a CTE step that rewrites the document with
+    ``jsonb_set`` / ``jsonb_insert`` / ``#-`` and ANDs its precondition into
+    an ``ok`` flag, so failed ``test`` ops or missing paths leave the row
+    untouched. The statement expects ``:project_id`` and returns the
+    project's metadata columns when the patch was applied. With
+    ``expected_versions`` it only applies to those versions (If-Match).
+    """
+    params: Dict[str, Any] = {}
+    steps = [
+        # data may be SQL NULL or a JSON null; both patch like an empty object
+        "s0 AS (SELECT COALESCE(NULLIF(data, 'null'::jsonb), '{}'::jsonb) AS d, true AS ok "
+        "FROM project WHERE id = :project_id FOR UPDATE)"
+    ]
+
+    for index, step in enumerate(operations):
+        name = f"op{index}"
+        op = step["op"]
+        path = step["path"]
+        params[f"{name}_target"] = path
+        target_sql = f"(d #> CAST(:{name}_target AS text[]))"
+
+        if op == "test":
+            params[f"{name}_value"] = json.dumps(step["value"])
+            expression, condition = "d", f"{target_sql} = CAST(:{name}_value AS jsonb)"
+        elif op == "remove":
+            expression, condition = f"d #- CAST(:{name}_target AS text[])", f"{target_sql} IS NOT NULL"
+        elif op == "replace":
+            params[f"{name}_value"] = json.dumps(step["value"])
+            value_sql = f"CAST(:{name}_value AS jsonb)"
+            if path:
+                expression = f"jsonb_set(d, CAST(:{name}_target AS text[]), {value_sql}, false)"
+            else:
+                expression = value_sql
+            condition = f"{target_sql} IS NOT NULL"
+        elif op == "add":
+            params[f"{name}_value"] = json.dumps(step["value"])
+            expression, condition = _add_expression("d", path, f"CAST(:{name}_value AS jsonb)", params, name)
+        else:
+            params[f"{name}_from"] = step["from"]
+            source_sql = f"(d #> CAST(:{name}_from AS text[]))"
+            base = f"(d #- CAST(:{name}_from AS text[]))" if op == "move" else "d"
+            expression, condition = _add_expression(base, path, source_sql, params, name)
+            condition = f"{source_sql} IS NOT NULL AND ({condition})"
+
+        steps.append(
+            f"s{index + 1} AS (SELECT {expression} AS d, "
+            f"ok AND COALESCE({condition}, false) AS ok FROM s{index})"
+        )
+
+    last = f"s{len(operations)}"
+    version_clause = ""
+    if expected_versions is not None:
+        params["expected_versions"] = sorted(expected_versions)
+        version_clause = " AND project.version = ANY(CAST(:expected_versions AS integer[]))"
+    statement = (
+        "WITH " + ",\n".join(steps) + "\n"
+        f"UPDATE project SET data = {last}.d, updated_at = now(), version = project.version + 1 FROM {last} "
+        f"WHERE project.id = :project_id AND {last}.ok{version_clause} "
+        "RETURNING project.id, project.name, project.owner_id, project.created_at, project.updated_at, project.version"
+    )
+    return statement, params
+
+
+def _resolve_parent(document: Any, tokens: List[str]):
+    parent = document
+    for token in tokens[:-1]:
+        if isinstance(parent, list):
+            if not _is_index(token) or int(token) >= len(parent):
+                raise JsonPatchError(f"Path not found: /{'/'.join(tokens)}")
+            parent = parent[int(token)]
+        elif isinstance(parent, dict) and token in parent:
+            parent = parent[token]
+        else:
+            raise JsonPatchError(f"Path not found: /{'/'.join(tokens)}")
+    return parent
+
+
+def _get(document: Any, tokens: List[str]) -> Any:
+    if not tokens:
+        return document
+    parent = _resolve_parent(document, tokens)
+    last = tokens[-1]
+    if isinstance(parent, list) and _is_index(last) and int(last) < len(parent):
+        return parent[int(last)]
+    if isinstance(parent, dict) and last in parent:
+        return parent[last]
+    raise JsonPatchError(f"Path not found: /{'/'.join(tokens)}")
+
+
+def _add(document: Any, tokens: List[str], value: Any, undo: Optional[list] = None,
+         effects: Optional[List["Effect"]] = None) -> Any:
+    if not tokens:
+        if undo is not None:
+            undo.append(("root", document))
+        return value
+    parent = _resolve_parent(document, tokens)
+    last = tokens[-1]
+    if isinstance(parent, list):
+        if last == "-":
+            index = len(parent)
+        elif _is_index(last) and int(last) <= len(parent):
+            index = int(last)
+        else:
+            raise JsonPatchError(f"Invalid array index: {last}")
+        parent.insert(index, value)
+        if undo is not None:
+            undo.append(("delete", parent, index))
+        if effects is not None:
+            effects.append(("add", tuple(tokens[:-1]), index))
+    elif isinstance(parent, dict):
+        if undo is not None:
+            undo.append(("set", parent, last, parent[last]) if last in parent else ("delete", parent, last))
+        parent[last] = value
+    else:
+        raise JsonPatchError(f"Path not found: /{'/'.join(tokens)}")
+    return document
+
+
+def _remove(document: Any, tokens: List[str], undo: Optional[list] = None,
+            effects: Optional[List["Effect"]] = None) -> Any:
+    value = _get(document, tokens)
+    parent = _resolve_parent(document, tokens)
+    if isinstance(parent, list):
+        index = int(tokens[-1])
+        del parent[index]
+        if undo is not None:
+            undo.append(("insert", parent, index, value))
+        if effects is not None:
+            effects.append(("remove", tuple(tokens[:-1]), index))
+    else:
+        del parent[tokens[-1]]
+        if undo is not None:
+            undo.append(("set", parent, tokens[-1], value))
+    return document
+
+
+def _rollback(document: Any, undo: list) -> Any:
+    for entry in reversed(undo):
+        action, target = entry[0], entry[1]
+        if action == "root":
+            document = target
+        elif action == "delete":
+            del target[entry[2]]
+        elif action == "insert":
+            target.insert(entry[2], entry[3])
+        else:
+            target[entry[2]] = entry[3]
+    return document
+
+
+# An element inserted into or removed from an array: ("add" | "remove",
+# tokens of the array, index), or moved: ("move", array, index, target
+# array, target index). Recorded while applying patches so patches made
+# concurrently can have their array positions rebased over them
+Effect = Tuple[Any, ...]
+
+
+def _shift(tokens: List[str], effect: Effect, insert: bool = False) -> Optional[List[str]]:
+    """``tokens`` once ``effect`` has happened, or None if they point into
+    the element it removed. With ``insert`` the last token is an insertion
+    position (add, move or copy target) rather than an existing element;
+    an insertion at the same position as ``effect`` goes after it."""
+    if effect[0] == "move":
+        _, array, index, target, target_index = effect
+        depth = len(array)
+        if (len(tokens) > depth + (1 if insert else 0) and tuple(tokens[:depth]) == array
+                and tokens[depth] == str(index)):
+            return list(target) + [str(target_index)] + tokens[depth + 1:]  # Follows the element
+        return _shift(_shift(tokens, ("remove", array, index), insert), ("add", target, target_index), insert)
+
+    kind, array, index = effect
+    depth = len(array)
+    if len(tokens) <= depth or tuple(tokens[:depth]) != array or not _is_index(tokens[depth]):
+        return tokens
+    position = int(tokens[depth])
+    if kind == "add":
+        if position >= index:
+            position += 1
+    elif position > index:
+        position -= 1
+    elif position == index and not (insert and len(tokens) == depth + 1):
+        return None
+    return tokens[:depth] + [str(position)] + tokens[depth + 1:]
+
+
+def _rebase_pointer(tokens: List[str], concurrent: List[Effect], insert: bool = False) -> List[str]:
+    for effect in concurrent:
+        shifted = _shift(tokens, effect, insert)
+        if shifted is None:
+            raise JsonPatchError(f"/{'/'.join(tokens)} was removed by a concurrent change")
+        tokens = shifted
+    return tokens
+
+
+def _past(concurrent: List[Effect], effects: List[Effect], removed: List[List[str]], written: List[List[str]]) -> List[Effect]:
+    """``concurrent`` as seen after an operation that removed the values at
+    ``removed``, had ``effects`` and wrote the values at ``written``;
+    changes inside removed or overwritten values are dropped"""
+    rebased = []
+    for effect in concurrent:
+        # Each end of the effect is shifted on its own (a move has two)
+        ends = [(list(effect[1]) + [str(effect[2])], effect[0] == "add")]
+        if effect[0] == "move":
+            ends.append((list(effect[3]) + [str(effect[4])], True))
+        shifted = []
+        for tokens, insert in ends:
+            if _inside(tokens, removed):
+                break
+            for own in effects:
+                tokens = _shift(tokens, own, insert)
+                if tokens is None:
+                    break
+            if tokens is None or _inside(tokens, written):
+                break
+            shifted.extend((tuple(tokens[:-1]), int(tokens[-1])))
+        if len(shifted) == 2 * len(ends):
+            rebased.append((effect[0], *shifted))
+    return rebased
+
+
+def _inside(tokens: List[str], paths: List[List[str]]) -> bool:
+    return any(len(tokens) > len(path) and tokens[:len(path)] == path for path in paths)
+
+
+def _apply(document: Any, operations: List[Dict[str, Any]], in_place: bool,
+           effects: Optional[List[Effect]], concurrent: Optional[List[Effect]]):
+    if not in_place:
+        document = copy.deepcopy(document)
+    undo = [] if in_place else None
+    recorded = [] if effects is not None or concurrent is not None else None
+    rebased = []
+    try:
+        for operation, step in zip(operations, validate_patch(operations, limit=None)):
+            op, path = step["op"], step["path"]
+            if concurrent is not None:
+                path = _rebase_pointer(path, concurrent, insert=op in ("add", "move", "copy"))
+                operation = {**operation, "path": format_pointer(path)}
+                if "from" in step:
+                    step["from"] = _rebase_pointer(step["from"], concurrent)
+                    operation["from"] = format_pointer(step["from"])
+                rebased.append(operation)
+            own = [] if recorded is not None else None
+            if op == "add":
+                document = _add(document, path, copy.deepcopy(step["value"]), undo, own)
+            elif op == "remove":
+                document = _remove(document, path, undo, own)
+            elif op == "replace":
+                # The value changes in place: no position moves
+                _get(document, path)
+                if path:
+                    document = _remove(document, path, undo)
+                document = _add(document, path, copy.deepcopy(step["value"]), undo)
+            elif op == "move":
+                value = _get(document, step["from"])
+                moved = [] if own is not None else None
+                document = _add(_remove(document, step["from"], undo, moved), path, value, undo, moved)
+                if moved is not None:
+                    if len(moved) == 2:  # From one array position to another
+                        own.append(("move", *moved[0][1:], *moved[1][1:]))
+                    else:
+                        own.extend(moved)
+            elif op == "copy":
+                document = _add(document, path, copy.deepcopy(_get(document, step["from"])), undo, own)
+            elif _get(document, path) != step["value"]:
+                raise JsonPatchError(f"Test failed at /{'/'.join(path)}")
+            if own is not None:
+                recorded.extend(own)
+                if concurrent:
+                    removed = [path] if op == "remove" else [step["from"]] if op == "move" else []
+                    written = [path] if op in ("add", "replace", "move", "copy") else []
+                    concurrent = _past(concurrent, own, removed, written)
+    except JsonPatchError:
+        if undo:
+            _rollback(document, undo)
+        raise
+    if effects is not None:
+        effects.extend(recorded)
+    return document, rebased, concurrent
+
+
+def apply_patch(document: Any, operations: List[Dict[str, Any]], in_place: bool = False,
+                effects: Optional[List[Effect]] = None) -> Any:
+    """Apply raw RFC 6902 operations in Python and return the new document.
+
+    The input is deep-copied first unless ``in_place``; either way a
+    failing operation raises JsonPatchError and leaves the input untouched
+    (in place, the steps already applied are undone). The array insertions
+    and removals made are appended to ``effects``, if given.
+    """
+    return _apply(document, operations, in_place, effects, None)[0]
+
+
+def rebase_patch(document: Any, operations: List[Dict[str, Any]], concurrent: List[Effect],
+                 in_place: bool = False, effects: Optional[List[Effect]] = None) -> Tuple[Any, List[Dict[str, Any]]]:
+    """Apply operations written against an older state of ``document``.
+
+    ``concurrent`` are the array changes applied since that state (oldest
+    first). Array positions in the operations are moved over them, so an
+    edit of /pages/3 still reaches the same page after another page was
+    inserted before it; an operation on an element removed meanwhile
+    raises JsonPatchError. Returns the new document and the rebased
+    operations, and updates ``concurrent`` to be relative to the result,
+    so the next patch of the same writer can be rebased with it.
+    """
+    document, rebased, remaining = _apply(document, operations, in_place, effects, list(concurrent))
+    concurrent[:] = remaining
+    return document, rebased
+
+
+def has_positions(operations: List[Dict[str, Any]]) -> bool:
+    """Whether any operation addresses an array element by index (``-`` excluded)"""
+    return any(
+        _is_index(token)
+        for operation in operations
+        for key in ("path", "from") if isinstance(operation.get(key), str)
+        for token in parse_pointer(operation[key])
+    )
+
+
+def _element_key(value: Any) -> Hashable:
+    # Pages and widgets are matched by id, anything else by value
+    if isinstance(value, dict) and isinstance(value.get("id"), (str, int)):
+        return "id", value["id"]
+    return "value", json.dumps(value, sort_keys=True)
+
+
+def array_effects(old: Any, new: Any, tokens: Tuple[str, ...] = ()) -> List[Effect]:
+    """Array insertions and removals turning ``old`` into ``new`` (in order),
+    to rebase patches made against ``old`` onto ``new``"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        return [
+            effect for key in old if key in new
+            for effect in array_effects(old[key], new[key], tokens + (key,))
+        ]
+    if not isinstance(old, list) or not isinstance(new, list):
+        return []
+    old_keys = [_element_key(value) for value in old]
+    new_keys = [_element_key(value) for value in new]
+    effects, nested = [], []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False).get_opcodes():
+        if tag == "replace" and i2 - i1 == j2 - j1 and all(key[0] == "value" for key in old_keys[i1:i2] + new_keys[j1:j2]):
+            tag = "equal"  # Plain values edited in place
+        if tag == "equal":
+            for offset in range(i2 - i1):
+                nested.extend(array_effects(old[i1 + offset], new[j1 + offset], tokens + (str(j1 + offset),)))
+            continue
+        # Everything before j1 is already in its new place
+        effects.extend(("remove", tokens, j1) for _ in range(i2 - i1))
+        effects.extend(("add", tokens, index) for index in range(j1, j2))
+    return effects + nested
+
+
+def _escape(token: Any) -> str:
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def _dumps(value: Any) -> bytes:
+    return marshal.dumps(value, 2)  # version 2: no back-references, equal values give equal bytes
+
+
+def make_patch(old: Any, new: Any, pointer: str = "") -> List[Dict[str, Any]]:
+    """RFC 6902 operations turning ``old`` into ``new``.
+
+    Objects are diffed key by key and arrays index by index (with
+    trailing adds/removes), which keeps single-widget edits down to a
+    handful of small operations.
+    """
+    if old == new and type(old) is type(new):
+        # 1 == 1.0 == True in Python but not in JSON: equal containers are
+        # confirmed on their marshal bytes (C code, once per equal subtree)
+        if not isinstance(old, (dict, list)) or _dumps(old) == _dumps(new):
+            return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = []
+        for key in old:
+            if key not in new:
+                operations.append({"op": "remove", "path": f"{pointer}/{_escape(key)}"})
+        for key, value in new.items():
+            child = f"{pointer}/{_escape(key)}"
+            if key not in old:
+                operations.append({"op": "add", "path": child, "value": value})
+            else:
+                operations.extend(make_patch(old[key], value, child))
+        return operations
+    if isinstance(old, list) and isinstance(new, list):
+        operations = []
+        common = min(len(old), len(new))
+        for index in range(common):
+            operations.extend(make_patch(old[index], new[index], f"{pointer}/{index}"))
+        for index in range(len(old) - 1, common - 1, -1):
+            operations.append({"op": "remove", "path": f"{pointer}/{index}"})
+        for index in range(common, len(new)):
+            operations.append({"op": "add", "path": f"{pointer}/{index}", "value": new[index]})
+        return operations
+    return [{"op": "replace", "path": pointer, "value": new}]
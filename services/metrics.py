@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Any, List, Optional
+
+
+class _Histogram:
+    """Keeps count/sum/max plus a bounded sample window for percentiles"""
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.samples.append(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            if not ordered:
+                return 0.0
+            index = min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))
+            return ordered[index]
+
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
+
+
+class _Meter:
+    """Events per second over a sliding window of one-second buckets"""
+
+    def __init__(self, window: int = 10):
+        self.window = window
+        self.buckets = deque(maxlen=window + 1)  # [second, count], oldest first
+
+    def mark(self, value: float, now: float):
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += value
+        else:
+            self.buckets.append([second, value])
+
+    def rate(self, now: float) -> float:
+        # Only complete seconds, so the value does not dip right after a tick
+        current = int(now)
+        total = sum(count for second, count in self.buckets if current - self.window <= second < current)
+        return total / self.window
+
+
+class MetricsRegistry:
+    """In-process counters, gauges and histograms shared by the whole worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._histograms: Dict[str, _Histogram] = {}
+        self._meters: Dict[str, _Meter] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def inc(self, name: str, value: float = 1):
+        """Increment a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """Set a gauge to an absolute value"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def add_gauge(self, name: str, delta: float):
+        """Move a gauge up or down"""
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    def observe(self, name: str, value: float):
+        """Record a sample (usually seconds) in a histogram"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = _Histogram()
+            histogram.observe(value)
+
+    def mark(self, name: str, value: float = 1):
+        """Count events for a per-second rate (reported under "rates")"""
+        now = time.monotonic()
+        with self._lock:
+            meter = self._meters.get(name)
+            if meter is None:
+                meter = self._meters[name] = _Meter()
+            meter.mark(value, now)
+
+    def register_collector(self, collector: Callable[[], None]):
+        """Call ``collector`` before every snapshot, to set gauges that are
+        cheaper to compute on demand than to keep up to date"""
+        self._collectors.append(collector)
+
+    def timer(self, name: str) -> "_Timer":
+        """Context manager that observes the elapsed time in seconds"""
+        return _Timer(self, name)
+
+    def get_counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def get_gauge(self, name: str) -> Optional[float]:
+        with self._lock:
+            return self._gauges.get(name)
+
+    def get_histogram(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return histogram.snapshot() if histogram else _Histogram().snapshot()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return every metric as a JSON serializable dict"""
+        for collector in self._collectors:
+            collector()
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {name: h.snapshot() for name, h in self._histograms.items()},
+                "rates": {name: m.rate(now) for name, m in self._meters.items()},
+            }
+
+
+class _Timer:
+    def __init__(self, registry: MetricsRegistry, name: str):
+        self.registry = registry
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+metrics = MetricsRegistry()
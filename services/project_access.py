@@ -0,0 +1,92 @@
+from fastapi import HTTPException, Request, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.database import SessionLocal
+from services.cache import TTLCache
+from services.user_service import ProjectService
+from typing import Optional, Sequence, Set
+import os
+import uuid
+
+# (user_id, project_id) pairs known to be shared, so reconnecting
+# collaborators skip the database
+ACCESS_GRANT_CACHE_TTL = float(os.getenv("ACCESS_GRANT_CACHE_TTL", "300"))
+ACCESS_GRANT_CACHE_SIZE = int(os.getenv("ACCESS_GRANT_CACHE_SIZE", "10000"))
+
+_grants = TTLCache("access_grant", max_size=ACCESS_GRANT_CACHE_SIZE, ttl=ACCESS_GRANT_CACHE_TTL)
+
+
+def get_access_cache(request: Request) -> dict:
+    """Per-request memo of access decisions, keyed by (user_id, project_id)"""
+    if not hasattr(request.state, "project_access"):
+        request.state.project_access = {}
+    return request.state.project_access
+
+
+async def authorize_project(
+    db: AsyncSession,
+    cache: dict,
+    project_id: uuid.UUID,
+    user_id: uuid.UUID,
+    owner_only: bool = False,
+    include_data: bool = True,
+    unless_versions: Optional[Set[int]] = None,
+    extra_columns: Sequence = (),
+    forbidden_detail: str = "Not authorized to access this project",
+):
+    """Load a project and check the user's access with a single query.
+
+    Raises 404 if the project does not exist and 403 if the user is neither
+    the owner nor (unless ``owner_only``) a collaborator. The row is kept in
+    ``cache`` so repeated checks within the same request are free.
+    ``unless_versions`` skips loading ``data`` when the stored version is
+    one the client already has (If-None-Match). ``extra_columns`` are
+    passed through to the query; such rows bypass the cache.
+    """
+    key = (user_id, project_id)
+    cached = cache.get(key)
+    if cached is not None and not extra_columns and (cached[1] or not include_data):
+        row = cached[0]
+    else:
+        row = await ProjectService.get_project_with_access(
+            db, project_id, user_id,
+            include_data=include_data,
+            unless_versions=unless_versions,
+            extra_columns=extra_columns
+        )
+        if not extra_columns:
+            cache[key] = (row, include_data and not unless_versions)
+
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Project not found"
+        )
+
+    allowed = row.is_owner if owner_only else (row.is_owner or row.has_access)
+    if not allowed:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=forbidden_detail
+        )
+    return row
+
+
+async def ensure_access(project_id: uuid.UUID, user_id: uuid.UUID) -> bool:
+    """Share the project with the user unless that is already known.
+
+    True if the grant was new. Raises IntegrityError if the project does
+    not exist.
+    """
+    key = (user_id, project_id)
+    if _grants.get(key):
+        return False
+    async with SessionLocal() as db:
+        granted = await ProjectService.grant_access(db, project_id, user_id)
+    _grants.set(key, True)
+    return granted
+
+
+def invalidate_grants(project_id: uuid.UUID):
+    """Forget every cached grant on a project; call after deleting it or
+    revoking access, or the next handshakes skip the database"""
+    _grants.remove_where(lambda key, _: key[1] == project_id)
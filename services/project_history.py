@@ -0,0 +1,167 @@
+from sqlalchemy import select, delete, func, literal
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.user import Project
+from models.project_version import ProjectVersion
+from services.json_patch import apply_patch, JsonPatchError
+from typing import Any, Dict, List, Optional
+import json
+import os
+import uuid
+
+# A full snapshot is stored at least every SNAPSHOT_INTERVAL versions, so
+# rebuilding any version replays at most SNAPSHOT_INTERVAL - 1 deltas
+SNAPSHOT_INTERVAL = max(1, int(os.getenv("PROJECT_HISTORY_SNAPSHOT_INTERVAL", "25")))
+# Versions newer than latest - KEEP_VERSIONS stay restorable one by one;
+# older ones are compacted down to their snapshots
+KEEP_VERSIONS = max(1, int(os.getenv("PROJECT_HISTORY_KEEP_VERSIONS", "200")))
+
+SNAPSHOT = "snapshot"
+DELTA = "delta"
+
+
+class ProjectHistoryService:
+
+    @staticmethod
+    async def record_version(
+        db: AsyncSession,
+        project_id: uuid.UUID,
+        version: int,
+        operations: Optional[List[Dict[str, Any]]] = None,
+        document: Any = None,
+    ) -> str:
+        """Record ``version`` in the caller's transaction (before its commit).
+
+        ``operations`` is the RFC 6902 patch from ``version - 1``; it is
+        stored as a delta unless the interval is due, the previous version
+        is not in the history or the patch is not smaller than the new
+        ``document``. Otherwise the current row is copied as a snapshot
+        server-side. Returns the kind that was written.
+        """
+        state = (await db.execute(
+            select(
+                func.max(ProjectVersion.version).filter(ProjectVersion.kind == SNAPSHOT).label("last_snapshot"),
+                func.bool_or(ProjectVersion.version == version - 1).label("has_previous"),
+            ).where(
+                ProjectVersion.project_id == project_id,
+                ProjectVersion.version < version,
+                ProjectVersion.version >= version - SNAPSHOT_INTERVAL,
+            )
+        )).first()
+
+        use_delta = (
+            operations is not None
+            and state.has_previous
+            and state.last_snapshot is not None
+            and version - state.last_snapshot < SNAPSHOT_INTERVAL
+        )
+        if use_delta and document is not None:
+            use_delta = len(json.dumps(operations)) < len(json.dumps(document))
+
+        if use_delta:
+            statement = insert(ProjectVersion).values(
+                project_id=project_id, version=version, kind=DELTA, payload=operations
+            )
+        else:
+            statement = insert(ProjectVersion).from_select(
+                ["project_id", "version", "kind", "payload"],
+                select(Project.id, Project.version, literal(SNAPSHOT), Project.data)
+                .where(Project.id == project_id, Project.version == version)
+            )
+        await db.execute(statement.on_conflict_do_nothing())
+
+        if not use_delta:
+            await ProjectHistoryService.compact(db, project_id, version)
+        return DELTA if use_delta else SNAPSHOT
+
+    @staticmethod
+    async def record_snapshots(db: AsyncSession, project_ids: List[uuid.UUID]):
+        """Snapshot the current version of many projects in one statement (bulk inserts)"""
+        await db.execute(
+            insert(ProjectVersion).from_select(
+                ["project_id", "version", "kind", "payload"],
+                select(Project.id, Project.version, literal(SNAPSHOT), Project.data)
+                .where(Project.id.in_(project_ids))
+            ).on_conflict_do_nothing()
+        )
+
+    @staticmethod
+    async def compact(db: AsyncSession, project_id: uuid.UUID, latest_version: int) -> int:
+        """Drop deltas no longer needed to rebuild the last KEEP_VERSIONS versions.
+
+        Everything before the newest snapshot at or below the cutoff is
+        thinned out to snapshots only. Returns the number of rows removed.
+        """
+        anchor = select(func.max(ProjectVersion.version)).where(
+            ProjectVersion.project_id == project_id,
+            ProjectVersion.kind == SNAPSHOT,
+            ProjectVersion.version <= latest_version - KEEP_VERSIONS,
+        ).scalar_subquery()
+        result = await db.execute(
+            delete(ProjectVersion).where(
+                ProjectVersion.project_id == project_id,
+                ProjectVersion.kind == DELTA,
+                ProjectVersion.version < anchor,
+            )
+        )
+        return result.rowcount
+
+    @staticmethod
+    async def list_versions(db: AsyncSession, project_id: uuid.UUID):
+        """Stored versions, newest first, with their on-disk payload size"""
+        result = await db.execute(
+            select(
+                ProjectVersion.version,
+                ProjectVersion.kind,
+                ProjectVersion.created_at,
+                func.pg_column_size(ProjectVersion.payload).label("size"),
+            )
+            .where(ProjectVersion.project_id == project_id)
+            .order_by(ProjectVersion.version.desc())
+        )
+        return result.all()
+
+    @staticmethod
+    async def get_version_data(db: AsyncSession, project_id: uuid.UUID, version: int):
+        """Rebuild the data document of ``version``.
+
+        Loads the closest snapshot at or below it plus the deltas after it
+        in one query. Raises LookupError when the version was never stored
+        or has been compacted away.
+        """
+        base = select(func.max(ProjectVersion.version)).where(
+            ProjectVersion.project_id == project_id,
+            ProjectVersion.kind == SNAPSHOT,
+            ProjectVersion.version <= version,
+        ).scalar_subquery()
+        result = await db.execute(
+            select(ProjectVersion.version, ProjectVersion.kind, ProjectVersion.payload)
+            .where(
+                ProjectVersion.project_id == project_id,
+                ProjectVersion.version >= base,
+                ProjectVersion.version <= version,
+            )
+            .order_by(ProjectVersion.version)
+        )
+        return rebuild_version(result.all(), version)
+
+
+def rebuild_version(rows, version: int):
+    """Data of ``version`` from its closest snapshot and the deltas after it.
+
+    ``rows`` have ``version``, ``kind`` and ``payload`` and are ordered by
+    version. Raises LookupError when they do not lead to ``version``.
+    """
+    if not rows or rows[-1].version != version or rows[0].kind != SNAPSHOT:
+        raise LookupError(f"Version {version} is not available")
+
+    data = rows[0].payload
+    for expected, row in enumerate(rows[1:], start=rows[0].version + 1):
+        if row.version != expected or row.kind != DELTA:
+            raise LookupError(f"Version {version} is not available")
+        try:
+            # Patches on an empty project apply to {} (see build_patch_statement)
+            data = apply_patch(data if data is not None else {}, row.payload)
+        except JsonPatchError as e:
+            raise LookupError(f"Version {version} could not be rebuilt") from e
+    return data
@@ -0,0 +1,178 @@
+from sqlalchemy import case, cast, column, func, literal, select, text
+from sqlalchemy.dialects.postgresql import JSONB, aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.user import Project
+from services.project_history import ProjectHistoryService
+from typing import Any, Dict, Optional, Set
+import json
+import uuid
+
+# Path extraction runs in Postgres so only the requested slice of the
+# (possibly multi-MB) data document ever leaves the database.
+
+_EMPTY_ARRAY = cast(literal("[]"), JSONB)
+
+
+def _array_or_empty(expression):
+    """Guard jsonb_array_elements against missing or non-array members"""
+    return case((func.jsonb_typeof(expression) == "array", expression), else_=_EMPTY_ARRAY)
+
+
+def _pages():
+    return func.jsonb_array_elements(_array_or_empty(Project.data["pages"])).table_valued(
+        column("value", JSONB), with_ordinality="ord"
+    ).render_derived(name="page_elem")
+
+
+def page_index_column():
+    """jsonb array of {id, name, route, widget_count} in page order"""
+    pages = _pages()
+    widgets = pages.c.value["widgets"]
+    entry = func.jsonb_build_object(
+        "id", pages.c.value["id"].astext,
+        "name", pages.c.value["name"].astext,
+        "route", pages.c.value["route"].astext,
+        "widget_count", case(
+            (func.jsonb_typeof(widgets) == "array", func.jsonb_array_length(widgets)),
+            else_=0
+        ),
+    )
+    return select(
+        func.coalesce(func.jsonb_agg(aggregate_order_by(entry, pages.c.ord)), _EMPTY_ARRAY)
+    ).select_from(pages).scalar_subquery().label("pages")
+
+
+def document_column():
+    """The project data without its pages array (theme, name, currentPageId, ...)"""
+    return case(
+        (func.jsonb_typeof(Project.data) == "object", Project.data.op("-")("pages")),
+        else_=cast(literal("{}"), JSONB)
+    ).label("document")
+
+
+def page_column(page_id: str):
+    """The page object whose id matches, or NULL"""
+    return _page_subquery(page_id).label("page")
+
+
+def _page_subquery(page_id: str):
+    pages = _pages()
+    return (
+        select(pages.c.value)
+        .select_from(pages)
+        .where(pages.c.value["id"].astext == page_id)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def widget_column(page_id: str, widget_id: str):
+    """A top-level widget of the given page, or NULL"""
+    widgets = func.jsonb_array_elements(
+        _array_or_empty(_page_subquery(page_id)["widgets"])
+    ).table_valued(column("value", JSONB)).render_derived(name="widget_elem")
+    return (
+        select(widgets.c.value)
+        .select_from(widgets)
+        .where(widgets.c.value["id"].astext == widget_id)
+        .limit(1)
+        .scalar_subquery()
+        .label("widget")
+    )
+
+
+_RETURNING = "RETURNING project.id, project.name, project.owner_id, project.created_at, project.updated_at, project.version"
+
+_PAGE_TARGET = (
+    "SELECT pg.ord - 1 AS page_idx{widget_idx} "
+    "FROM project p "
+    "CROSS JOIN LATERAL jsonb_array_elements("
+    "  CASE WHEN jsonb_typeof(p.data->'pages') = 'array' THEN p.data->'pages' ELSE '[]'::jsonb END"
+    ") WITH ORDINALITY AS pg(value, ord) "
+    "{widget_join}"
+    "WHERE p.id = :project_id AND pg.value->>'id' = :page_id{widget_filter} "
+    "LIMIT 1 FOR UPDATE OF p"
+)
+
+_WIDGET_JOIN = (
+    "CROSS JOIN LATERAL jsonb_array_elements("
+    "  CASE WHEN jsonb_typeof(pg.value->'widgets') = 'array' THEN pg.value->'widgets' ELSE '[]'::jsonb END"
+    ") WITH ORDINALITY AS w(value, ord) "
+)
+
+
+class ProjectPageService:
+
+    @staticmethod
+    async def replace_page(
+        db: AsyncSession,
+        project_id: uuid.UUID,
+        page_id: str,
+        page: Dict[str, Any],
+        expected_versions: Optional[Set[int]] = None,
+    ):
+        """Overwrite one page in place with jsonb_set; None if the page (or version) is not there"""
+        target = _PAGE_TARGET.format(widget_idx="", widget_join="", widget_filter="")
+        statement = (
+            f"WITH target AS ({target}) "
+            "UPDATE project SET data = jsonb_set(project.data, ARRAY['pages', target.page_idx::text], CAST(:value AS jsonb)), "
+            "updated_at = now(), version = project.version + 1 "
+            "FROM target WHERE project.id = :project_id"
+        )
+        return await ProjectPageService._execute_update(
+            db, statement, {"project_id": project_id, "page_id": page_id, "value": json.dumps(page)},
+            expected_versions, page, "target.page_idx AS page_idx", "/pages/{row.page_idx}"
+        )
+
+    @staticmethod
+    async def replace_widget(
+        db: AsyncSession,
+        project_id: uuid.UUID,
+        page_id: str,
+        widget_id: str,
+        widget: Dict[str, Any],
+        expected_versions: Optional[Set[int]] = None,
+    ):
+        """Overwrite one top-level widget of a page; None if it (or the version) is not there"""
+        target = _PAGE_TARGET.format(
+            widget_idx=", w.ord - 1 AS widget_idx",
+            widget_join=_WIDGET_JOIN,
+            widget_filter=" AND w.value->>'id' = :widget_id",
+        )
+        statement = (
+            f"WITH target AS ({target}) "
+            "UPDATE project SET data = jsonb_set(project.data, "
+            "ARRAY['pages', target.page_idx::text, 'widgets', target.widget_idx::text], CAST(:value AS jsonb)), "
+            "updated_at = now(), version = project.version + 1 "
+            "FROM target WHERE project.id = :project_id"
+        )
+        return await ProjectPageService._execute_update(
+            db, statement,
+            {"project_id": project_id, "page_id": page_id, "widget_id": widget_id, "value": json.dumps(widget)},
+            expected_versions, widget, "target.page_idx AS page_idx, target.widget_idx AS widget_idx",
+            "/pages/{row.page_idx}/widgets/{row.widget_idx}"
+        )
+
+    @staticmethod
+    async def _execute_update(
+        db: AsyncSession,
+        statement: str,
+        params: dict,
+        expected_versions: Optional[Set[int]],
+        value: Dict[str, Any],
+        target_columns: str,
+        history_path: str,
+    ):
+        if expected_versions is not None:
+            statement += " AND project.version = ANY(CAST(:expected_versions AS integer[]))"
+            params["expected_versions"] = sorted(expected_versions)
+        result = await db.execute(text(f"{statement} {_RETURNING}, {target_columns}"), params)
+        row = result.first()
+        if row is not None:
+            # The replaced slice is the whole delta for the history
+            await ProjectHistoryService.record_version(
+                db, row.id, row.version,
+                [{"op": "replace", "path": history_path.format(row=row), "value": value}]
+            )
+        await db.commit()
+        return row
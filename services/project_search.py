@@ -0,0 +1,52 @@
+from sqlalchemy import and_, func, literal, literal_column, or_, true
+from sqlalchemy.dialects.postgresql import JSONB
+from models.user import Project, WIDGET_TYPES_SQL, WIDGET_TEXT_SQL, WIDGET_TEXT_OF_TYPES_PATH
+from typing import List, Optional
+import re
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _prefix_tsquery(q: str) -> Optional[str]:
+    """'precio tot' -> 'precio:* & tot:*' (None when q has no words)"""
+    words = _WORD.findall(q.lower())
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+
+def search_conditions(q: Optional[str] = None, widget_types: Optional[List[str]] = None) -> list:
+    """WHERE clauses for a project search, each one backed by an index.
+
+    ``q`` matches a substring of the name (trigram index) or word prefixes
+    in the widgets' visible text (full-text GIN). ``widget_types`` requires
+    every listed type to appear somewhere in the project; with both, the
+    text has to be in widgets of those types ("precio" in a text widget,
+    not in a button next to an unrelated one).
+    """
+    conditions = []
+    q = (q or "").strip()
+    types = sorted(set(widget_types or []))
+    if q:
+        name_match = Project.name.ilike(f"%{_escape_like(q)}%", escape="\\")
+        tsquery = _prefix_tsquery(q)
+        if tsquery:
+            text_match = literal_column(WIDGET_TEXT_SQL).op("@@")(func.to_tsquery("simple", tsquery))
+            if types:
+                # The indexed match above preselects; this rechecks those rows only
+                text_of_types = func.to_tsvector("simple", func.jsonb_path_query_array(
+                    Project.data, literal_column(f"'{WIDGET_TEXT_OF_TYPES_PATH}'"), literal({"types": types}, JSONB), true()
+                ))
+                text_match = and_(text_match, text_of_types.op("@@")(func.to_tsquery("simple", tsquery)))
+            conditions.append(or_(name_match, text_match))
+        else:
+            conditions.append(name_match)
+    if types:
+        conditions.append(
+            literal_column(WIDGET_TYPES_SQL).op("@>")(literal(types, JSONB))
+        )
+    return conditions
@@ -0,0 +1,28 @@
+from functools import lru_cache
+
+# Shared service instances, built on first use. The AI and image services
+# import openai/boto3 and need credentials, so constructing them at import
+# time made every worker slow to boot and unable to start without keys.
+
+
+@lru_cache(maxsize=None)
+def get_project_generator():
+    from generators.project_generator import ProjectGenerator
+    return ProjectGenerator()
+
+
+@lru_cache(maxsize=None)
+def get_ai_generator():
+    from services.ai_generator import AIProjectGenerator
+    return AIProjectGenerator()
+
+
+@lru_cache(maxsize=None)
+def get_image_service():
+    from services.image_service import ImageService
+    return ImageService()
+
+
+def warmup():
+    """Pre-compile the Jinja templates so the first generation is not the slow one"""
+    get_project_generator().warmup()
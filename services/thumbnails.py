@@ -0,0 +1,58 @@
+import os
+import uuid
+from typing import Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from generators.thumbnail_generator import ThumbnailGenerator
+from models.user import Project
+from services.cache import TTLCache
+from services.project_pages import page_column
+
+THUMBNAIL_CACHE_SIZE = int(os.getenv("THUMBNAIL_CACHE_SIZE", "1024"))
+THUMBNAIL_CACHE_TTL = float(os.getenv("THUMBNAIL_CACHE_TTL", "3600"))
+
+# (project_id, version, page_id, width) -> SVG. The version in the key makes
+# every write a miss; entries for older versions are dropped as new ones land
+_thumbnails = TTLCache("thumbnail", max_size=THUMBNAIL_CACHE_SIZE, ttl=THUMBNAIL_CACHE_TTL)
+
+_generators = {}
+
+
+def _generator(width: int) -> ThumbnailGenerator:
+    if width not in _generators:
+        _generators[width] = ThumbnailGenerator(width)
+    return _generators[width]
+
+
+async def get_thumbnail(
+    db: AsyncSession,
+    project_id: uuid.UUID,
+    version: int,
+    page_id: Optional[str] = None,
+    width: int = 180,
+) -> Optional[Tuple[str, int]]:
+    """SVG thumbnail of a page (the first one by default) and the version it shows.
+
+    ``version`` is the version the caller last saw; only on a cache miss
+    is the page itself read, together with the version it belongs to.
+    None if there is no such page.
+    """
+    svg = _thumbnails.get((project_id, version, page_id, width))
+    if svg is not None:
+        return svg, version
+
+    page = page_column(page_id) if page_id is not None else Project.data["pages"][0].label("page")
+    result = await db.execute(select(page, Project.version).where(Project.id == project_id))
+    row = result.first()
+    if row is None or not isinstance(row.page, dict):
+        return None
+
+    svg = _generator(width).render_page(row.page)
+    invalidate_project(project_id, keep_version=row.version)
+    _thumbnails.set((project_id, row.version, page_id, width), svg)
+    return svg, row.version
+
+
+def invalidate_project(project_id: uuid.UUID, keep_version: Optional[int] = None):
+    """Drop cached thumbnails of a project (except those of ``keep_version``)"""
+    _thumbnails.remove_where(lambda key, _: key[0] == project_id and key[1] != keep_version)
@@ -1,19 +1,55 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, exists, union, tuple_, delete, update, insert, text, case, func, literal, true
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from models.user import User, Project
+from models.user_project_access import UserProjectAccess
 from models.schemas import UserCreate, ProjectCreate
-from services.auth_service import get_password_hash, verify_password
-from typing import Optional
+from services.auth_service import get_password_hash_async, verify_password_async
+from services.json_patch import build_patch_statement, format_pointer, make_patch
+from services.project_history import ProjectHistoryService
+from datetime import datetime
+from typing import List, Optional, Sequence, Set, Tuple
+import base64
 import uuid
 
 
+def encode_cursor(updated_at: datetime, project_id: uuid.UUID) -> str:
+    """Opaque keyset cursor for the (updated_at, id) ordering"""
+    raw = f"{updated_at.isoformat()}|{project_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """Inverse of encode_cursor; raises ValueError on malformed input"""
+    try:
+        updated_at, project_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(updated_at), uuid.UUID(project_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+# Everything but the (potentially multi-MB) JSONB data column
+PROJECT_SUMMARY_COLUMNS = (
+    Project.id, Project.name, Project.owner_id, Project.created_at, Project.updated_at, Project.version
+)
+
+
+def _shared_with(user_id: uuid.UUID):
+    """EXISTS clause: the project has been shared with user_id"""
+    return exists().where(
+        UserProjectAccess.project_id == Project.id,
+        UserProjectAccess.user_id == user_id
+    )
+
+
 class UserService:
-    
+
     @staticmethod
-    def create_user(db: Session, user: UserCreate) -> Optional[User]:
+    async def create_user(db: AsyncSession, user: UserCreate) -> Optional[User]:
         """Create a new user with hashed password"""
         try:
-            hashed_password = get_password_hash(user.password)
+            hashed_password = await get_password_hash_async(user.password)
             db_user = User(
                 username=user.username,
                 email=user.email,
@@ -21,38 +57,39 @@ class UserService:
                 color=user.color
             )
             db.add(db_user)
-            db.commit()
-            db.refresh(db_user)
+            await db.commit()
+            await db.refresh(db_user)
             return db_user
         except IntegrityError:
-            db.rollback()
+            await db.rollback()
             return None  # User already exists
-    
+
     @staticmethod
-    def get_user_by_email(db: Session, email: str) -> Optional[User]:
+    async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
         """Get user by email"""
-        return db.query(User).filter(User.email == email).first()
-    
+        result = await db.execute(select(User).where(User.email == email))
+        return result.scalars().first()
+
     @staticmethod
-    def get_user_by_id(db: Session, user_id: uuid.UUID) -> Optional[User]:
+    async def get_user_by_id(db: AsyncSession, user_id: uuid.UUID) -> Optional[User]:
         """Get user by ID"""
-        return db.query(User).filter(User.id == user_id).first()
-    
+        return await db.get(User, user_id)
+
     @staticmethod
-    def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
+    async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[User]:
         """Authenticate user with email and password"""
-        user = UserService.get_user_by_email(db, email)
+        user = await UserService.get_user_by_email(db, email)
         if not user:
             return None
-        if not verify_password(password, user.password):
+        if not await verify_password_async(password, user.password):
             return None
         return user
 
 
 class ProjectService:
-    
+
     @staticmethod
-    def create_project(db: Session, project: ProjectCreate, owner_id: uuid.UUID) -> Project:
+    async def create_project(db: AsyncSession, project: ProjectCreate, owner_id: uuid.UUID) -> Project:
         """Create a new project"""
         db_project = Project(
             name=project.name,
@@ -60,39 +97,262 @@ class ProjectService:
             data=project.data
         )
         db.add(db_project)
-        db.commit()
-        db.refresh(db_project)
+        await db.flush()
+        await ProjectHistoryService.record_version(db, db_project.id, 1)
+        await db.commit()
+        await db.refresh(db_project)
         return db_project
-    
+
+    @staticmethod
+    async def create_projects(db: AsyncSession, projects: List[ProjectCreate], owner_id: uuid.UUID):
+        """Create many projects with one multi-row INSERT ... RETURNING"""
+        result = await db.execute(
+            insert(Project)
+            .values([
+                {"id": uuid.uuid4(), "name": project.name, "owner_id": owner_id, "data": project.data}
+                for project in projects
+            ])
+            .returning(*PROJECT_SUMMARY_COLUMNS)
+        )
+        rows = result.all()
+        await ProjectHistoryService.record_snapshots(db, [row.id for row in rows])
+        await db.commit()
+        return rows
+
+    @staticmethod
+    async def duplicate_projects(
+        db: AsyncSession,
+        project_ids: List[uuid.UUID],
+        user_id: uuid.UUID,
+        copies: int = 1,
+        name: Optional[str] = None,
+    ):
+        """Copy projects server-side with a single INSERT ... SELECT.
+
+        Every source the user can access is copied ``copies`` times into the
+        user's own account; the JSONB data never leaves Postgres. Returns
+        the new projects' metadata rows.
+        """
+        owned = select(Project.id).where(Project.owner_id == user_id)
+        shared = select(UserProjectAccess.project_id).where(UserProjectAccess.user_id == user_id)
+        copy_numbers = func.generate_series(1, copies).table_valued("n").render_derived(name="copy_number")
+
+        source = (
+            select(
+                func.gen_random_uuid(),
+                func.coalesce(literal(name), Project.name),
+                literal(user_id, UUID(as_uuid=True)),
+                Project.data,
+            )
+            .select_from(Project)
+            .join(copy_numbers, true())
+            .where(Project.id.in_(project_ids), Project.id.in_(union(owned, shared)))
+        )
+        result = await db.execute(
+            insert(Project)
+            .from_select(["id", "name", "owner_id", "data"], source)
+            .returning(*PROJECT_SUMMARY_COLUMNS)
+        )
+        rows = result.all()
+
+        await ProjectHistoryService.record_snapshots(db, [row.id for row in rows])
+        await db.commit()
+        return rows
+
+    @staticmethod
+    async def get_accessible_project_ids(db: AsyncSession, user_id: uuid.UUID, project_ids: List[uuid.UUID]) -> Set[uuid.UUID]:
+        """Which of ``project_ids`` the user owns or has been granted"""
+        owned = select(Project.id).where(Project.owner_id == user_id)
+        shared = select(UserProjectAccess.project_id).where(UserProjectAccess.user_id == user_id)
+        result = await db.execute(
+            select(Project.id).where(Project.id.in_(project_ids), Project.id.in_(union(owned, shared)))
+        )
+        return set(result.scalars().all())
+
+    @staticmethod
+    async def grant_access(db: AsyncSession, project_id: uuid.UUID, user_id: uuid.UUID) -> bool:
+        """Share a project with a user in one statement; False if already shared.
+
+        Raises IntegrityError if the project (or user) does not exist.
+        """
+        result = await db.execute(
+            pg_insert(UserProjectAccess)
+            .values(user_id=user_id, project_id=project_id, granted_at=func.timezone("utc", func.now()))
+            .on_conflict_do_nothing(index_elements=[UserProjectAccess.user_id, UserProjectAccess.project_id])
+        )
+        await db.commit()
+        return result.rowcount > 0
+
     @staticmethod
-    def get_user_projects(db: Session, owner_id: uuid.UUID):
+    async def get_user_projects(db: AsyncSession, owner_id: uuid.UUID):
         """Get all projects for a user"""
-        return db.query(Project).filter(Project.owner_id == owner_id).all()
-    
+        result = await db.execute(select(Project).where(Project.owner_id == owner_id))
+        return result.scalars().all()
+
     @staticmethod
-    def get_project_by_id(db: Session, project_id: uuid.UUID) -> Optional[Project]:
+    async def get_accessible_projects(
+        db: AsyncSession,
+        user_id: uuid.UUID,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        summary: bool = False,
+        conditions: Sequence = (),
+    ):
+        """Owned and shared projects in one statement, newest first.
+
+        Returns ``(rows, next_cursor)``. With ``summary`` the JSONB ``data``
+        column is not selected at all. ``conditions`` narrow the result
+        further (see services.project_search).
+        """
+        # UNION of two index scans (owner index, access primary key); an
+        # OR EXISTS predicate would force a scan of the whole project table
+        owned = select(Project.id).where(Project.owner_id == user_id)
+        shared = select(UserProjectAccess.project_id).where(UserProjectAccess.user_id == user_id)
+        columns = list(PROJECT_SUMMARY_COLUMNS)
+        if not summary:
+            columns.append(Project.data)
+
+        query = (
+            select(*columns)
+            .where(Project.id.in_(union(owned, shared)), *conditions)
+            .order_by(Project.updated_at.desc(), Project.id.desc())
+        )
+        if cursor:
+            updated_at, last_id = decode_cursor(cursor)
+            query = query.where(tuple_(Project.updated_at, Project.id) < tuple_(updated_at, last_id))
+        if limit:
+            query = query.limit(limit + 1)
+
+        rows = (await db.execute(query)).all()
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].updated_at, rows[-1].id)
+        return rows, next_cursor
+
+    @staticmethod
+    async def get_project_with_access(
+        db: AsyncSession,
+        project_id: uuid.UUID,
+        user_id: uuid.UUID,
+        include_data: bool = True,
+        unless_versions: Optional[Set[int]] = None,
+        extra_columns: Sequence = (),
+    ):
+        """Fetch a project and the user's access flags (is_owner, has_access) in one query.
+
+        ``data`` is left out (NULL) when the current version is in
+        ``unless_versions``, i.e. the client already holds it.
+        ``extra_columns`` are labelled expressions over the project row
+        (e.g. JSONB path extractions) selected in the same statement.
+        """
+        columns = list(PROJECT_SUMMARY_COLUMNS) + [
+            (Project.owner_id == user_id).label("is_owner"),
+            _shared_with(user_id).label("has_access"),
+        ]
+        if include_data and unless_versions:
+            columns.append(
+                case((Project.version.in_(unless_versions), None), else_=Project.data).label("data")
+            )
+        elif include_data:
+            columns.append(Project.data)
+        columns.extend(extra_columns)
+        result = await db.execute(select(*columns).where(Project.id == project_id))
+        return result.first()
+
+    @staticmethod
+    async def get_project_by_id(db: AsyncSession, project_id: uuid.UUID) -> Optional[Project]:
         """Get project by ID"""
-        return db.query(Project).filter(Project.id == project_id).first()
-    
-    @staticmethod
-    def update_project(db: Session, project_id: uuid.UUID, name: str = None, data: dict = None) -> Optional[Project]:
-        """Update project"""
-        project = db.query(Project).filter(Project.id == project_id).first()
-        if project:
-            if name:
-                project.name = name
-            if data is not None:
-                project.data = data
-            db.commit()
-            db.refresh(project)
+        return await db.get(Project, project_id)
+
+    @staticmethod
+    async def update_project(
+        db: AsyncSession,
+        project_id: uuid.UUID,
+        name: str = None,
+        data: dict = None,
+        expected_versions: Optional[Set[int]] = None,
+    ) -> Optional[Project]:
+        """Update project with a single UPDATE ... RETURNING.
+
+        With ``expected_versions`` the write only applies if the stored
+        version is one of them; otherwise None is returned. The previous
+        data comes back from the same statement to record the history delta.
+        """
+        values = {}
+        if name:
+            values["name"] = name
+        if data is not None:
+            values["data"] = data
+
+        conditions = [Project.id == project_id]
+        if expected_versions is not None:
+            conditions.append(Project.version.in_(expected_versions))
+        if not values:
+            # Nothing to change, but still honour the precondition
+            result = await db.execute(select(Project).where(*conditions))
+            return result.scalars().first()
+
+        previous = (
+            select(Project.id, Project.data.label("previous_data"))
+            .where(*conditions)
+            .with_for_update()
+            .cte("previous")
+        )
+        result = await db.execute(
+            update(Project).where(Project.id == previous.c.id)
+            .values(**values, version=Project.version + 1)
+            .returning(Project, previous.c.previous_data)
+        )
+        row = result.first()
+        if row is None:
+            await db.rollback()
+            return None
+
+        project, previous_data = row
+        operations = make_patch(previous_data, data) if data is not None else []
+        await ProjectHistoryService.record_version(db, project_id, project.version, operations, document=data)
+        await db.commit()
         return project
-    
-    @staticmethod
-    def delete_project(db: Session, project_id: uuid.UUID) -> bool:
-        """Delete project"""
-        project = db.query(Project).filter(Project.id == project_id).first()
-        if project:
-            db.delete(project)
-            db.commit()
-            return True
-        return False
+
+    @staticmethod
+    async def patch_project(
+        db: AsyncSession,
+        project_id: uuid.UUID,
+        operations: list,
+        expected_versions: Optional[Set[int]] = None,
+    ):
+        """Apply parsed JSON Patch operations to project.data in a single statement.
+
+        Returns the project's metadata row, or None when a ``test`` failed, a
+        path did not exist or the version precondition did not hold (nothing
+        is written in that case).
+        """
+        statement, params = build_patch_statement(operations, expected_versions)
+        result = await db.execute(text(statement), {"project_id": project_id, **params})
+        row = result.first()
+        if row is not None:
+            # The request's own operations are the delta; tests carry no change
+            delta = []
+            for step in operations:
+                if step["op"] == "test":
+                    continue
+                entry = {"op": step["op"], "path": format_pointer(step["path"])}
+                if "value" in step:
+                    entry["value"] = step["value"]
+                if "from" in step:
+                    entry["from"] = format_pointer(step["from"])
+                delta.append(entry)
+            await ProjectHistoryService.record_version(db, project_id, row.version, delta)
+        await db.commit()
+        return row
+
+    @staticmethod
+    async def delete_project(db: AsyncSession, project_id: uuid.UUID) -> bool:
+        """Delete project (access grants go with it through ON DELETE CASCADE)"""
+        from services.project_access import invalidate_grants  # imports this module
+
+        result = await db.execute(delete(Project).where(Project.id == project_id))
+        await db.commit()
+        invalidate_grants(project_id)
+        return result.rowcount > 0
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Scratch space for generated projects; each request gets its own directory
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT") or os.path.join(tempfile.gettempdir(), "flutter-builder")
+# New workspaces are refused (503) while this worker's live workspaces use
+# more than WORKSPACE_QUOTA_BYTES or the disk has less than WORKSPACE_MIN_FREE_BYTES
+WORKSPACE_QUOTA_BYTES = int(os.getenv("WORKSPACE_QUOTA_BYTES", str(2 * 1024 ** 3)))
+WORKSPACE_MIN_FREE_BYTES = int(os.getenv("WORKSPACE_MIN_FREE_BYTES", str(512 * 1024 ** 2)))
+# A single generated project (sources plus archive) may not exceed this
+WORKSPACE_MAX_BYTES = int(os.getenv("WORKSPACE_MAX_BYTES", str(256 * 1024 ** 2)))
+# The janitor removes workspaces older than this that no request owns
+# (left behind by crashed workers or lost cleanups)
+WORKSPACE_MAX_AGE = float(os.getenv("WORKSPACE_MAX_AGE", "3600"))
+WORKSPACE_JANITOR_INTERVAL = float(os.getenv("WORKSPACE_JANITOR_INTERVAL", "300"))
+
+_PREFIX = "ws-"
+# {"pid": ..., "host": ...} of the worker using a workspace; its mtime is a
+# heartbeat, refreshed on every janitor pass and measure()
+_OWNER_FILE = ".owner"
+_HOST = socket.gethostname()
+
+
+class WorkspaceQuotaExceeded(Exception):
+    """No disk space may be used for a new or growing workspace right now"""
+
+
+def safe_name(name: str) -> str:
+    """``name`` usable as a single path component"""
+    return re.sub(r"[^\w.-]", "_", name).strip(".") or "project"
+
+
+def _process_alive(pid: int) -> bool:
+    if os.name != "posix":
+        return False  # no signal 0 there: the heartbeat decides
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_alive(path: str, cutoff: float) -> bool:
+    """Whether a live worker may still use the workspace at ``path``: its
+    owner process runs on this host, or it sent a heartbeat after ``cutoff``"""
+    marker = os.path.join(path, _OWNER_FILE)
+    try:
+        with open(marker) as f:
+            owner = json.load(f)
+        heartbeat = os.stat(marker).st_mtime
+    except (OSError, ValueError):
+        return False  # Created before markers existed, or half-created: the directory mtime decides
+    if heartbeat > cutoff:
+        return True
+    return owner.get("host") == _HOST and isinstance(owner.get("pid"), int) and _process_alive(owner["pid"])
+
+
+def _disk_usage(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Workspace:
+    """A request's private scratch directory, removed by ``release``"""
+
+    def __init__(self, manager: "WorkspaceManager", path: str):
+        self.manager = manager
+        self.path = path
+        self.created_at = time.monotonic()
+        self.size = 0
+
+    def join(self, *parts: str) -> str:
+        return os.path.join(self.path, *parts)
+
+    def heartbeat(self):
+        try:
+            os.utime(self.join(_OWNER_FILE))
+        except OSError:
+            pass
+
+    def measure(self) -> int:
+        """Record the space used so far; raises WorkspaceQuotaExceeded over WORKSPACE_MAX_BYTES"""
+        self.heartbeat()
+        self.size = _disk_usage(self.path)
+        self.manager._update_usage()
+        if self.size > WORKSPACE_MAX_BYTES:
+            metrics.inc("workspace_quota_rejections")
+            raise WorkspaceQuotaExceeded(f"Generated project uses {self.size} bytes (limit {WORKSPACE_MAX_BYTES})")
+        return self.size
+
+    def release(self):
+        self.manager.release(self)
+
+    def __enter__(self) -> "Workspace":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Kept on success: the caller releases it once the archive is sent
+        if exc_type is not None:
+            self.release()
+        return False
+
+
+class WorkspaceManager:
+    """Creates, tracks and cleans up per-request workspaces under ``root``"""
+
+    def __init__(self, root: str = WORKSPACE_ROOT):
+        self.root = root
+        self._active: Dict[str, Workspace] = {}
+        self._lock = threading.Lock()  # the janitor runs in a thread
+        metrics.register_collector(self._collect_metrics)
+
+    def create(self) -> Workspace:
+        os.makedirs(self.root, exist_ok=True)
+        if self.usage() >= WORKSPACE_QUOTA_BYTES or shutil.disk_usage(self.root).free < WORKSPACE_MIN_FREE_BYTES:
+            # Orphans may be what is taking the space
+            self.collect_garbage()
+            if self.usage() >= WORKSPACE_QUOTA_BYTES or shutil.disk_usage(self.root).free < WORKSPACE_MIN_FREE_BYTES:
+                metrics.inc("workspace_quota_rejections")
+                raise WorkspaceQuotaExceeded("Not enough scratch space to generate a project, retry later")
+        path = os.path.join(self.root, f"{_PREFIX}{uuid.uuid4().hex}")
+        os.mkdir(path)
+        with open(os.path.join(path, _OWNER_FILE), "w") as f:
+            json.dump({"pid": os.getpid(), "host": _HOST}, f)
+        workspace = Workspace(self, path)
+        with self._lock:
+            self._active[path] = workspace
+        metrics.inc("workspace_created")
+        return workspace
+
+    def release(self, workspace: Workspace):
+        with self._lock:
+            if self._active.pop(workspace.path, None) is None:
+                return
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        metrics.inc("workspace_released")
+        metrics.observe("workspace_size_bytes", workspace.size)
+        metrics.observe("workspace_lifetime_seconds", time.monotonic() - workspace.created_at)
+        self._update_usage()
+
+    def release_path(self, path: str):
+        """Release the workspace holding ``path`` (e.g. an archive that was sent)"""
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        top = relative.split(os.sep, 1)[0]
+        if relative.startswith(os.pardir) or not top.startswith(_PREFIX):
+            logger.warning("workspace release ignored path=%s reason=outside_root", path)
+            return
+        with self._lock:
+            workspace = self._active.get(os.path.join(self.root, top))
+        if workspace is not None:
+            workspace.release()
+
+    def usage(self) -> int:
+        with self._lock:
+            return sum(workspace.size for workspace in self._active.values())
+
+    def _update_usage(self):
+        metrics.set_gauge("workspace_bytes", self.usage())
+
+    def collect_garbage(self, max_age: float = WORKSPACE_MAX_AGE) -> int:
+        """Remove workspaces older than ``max_age`` seconds whose owner is gone.
+
+        The top-level mtime does not change while files are written into
+        subdirectories, so workspaces whose owner process is alive (same
+        host) or recently sent a heartbeat are kept however old they are.
+        """
+        removed = 0
+        cutoff = time.time() - max_age
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if not entry.name.startswith(_PREFIX):
+                continue
+            with self._lock:
+                if entry.path in self._active:
+                    continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                    continue  # Just created, maybe before its owner marker
+            except FileNotFoundError:
+                continue
+            if _owner_alive(entry.path, cutoff):
+                continue  # Another worker's request in progress
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+        if removed:
+            metrics.inc("workspace_janitor_removed", removed)
+            logger.info("workspace janitor removed=%d root=%s", removed, self.root)
+        return removed
+
+    async def run_janitor(self):
+        """Background task: collect orphaned workspaces every WORKSPACE_JANITOR_INTERVAL"""
+        while True:
+            with self._lock:
+                active = list(self._active.values())
+            for workspace in active:
+                workspace.heartbeat()
+            try:
+                await asyncio.to_thread(self.collect_garbage)
+            except Exception as e:
+                logger.warning("workspace janitor failed error=%s", e)
+            await asyncio.sleep(WORKSPACE_JANITOR_INTERVAL)
+
+    def _collect_metrics(self):
+        with self._lock:
+            active = len(self._active)
+        metrics.set_gauge("workspace_active", active)
+        self._update_usage()
+        try:
+            disk = shutil.disk_usage(self.root)
+        except FileNotFoundError:
+            return
+        metrics.set_gauge("workspace_disk_free_bytes", disk.free)
+        metrics.set_gauge("workspace_disk_used_ratio", disk.used / disk.total if disk.total else 0)
+
+
+workspaces = WorkspaceManager()
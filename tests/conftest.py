@@ -0,0 +1,7 @@
+"""Unit tests for the pure modules: they need no database or network"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# models.database builds its engine at import; it never connects in these tests
+os.environ.setdefault("DATABASE_URL", "postgresql://postgres@localhost/postgres")
@@ -0,0 +1,121 @@
+import io
+import os
+import tarfile
+import time
+import zipfile
+import pytest
+from services import archives
+from services.archives import SOURCE_DATE_EPOCH, TAR_ZST, ZIP, list_files, negotiate, write_zip
+
+
+@pytest.fixture
+def project(tmp_path):
+    source = tmp_path / "project"
+    (source / "lib" / "pages").mkdir(parents=True)
+    (source / "assets").mkdir()
+    (source / "lib" / "main.dart").write_text("void main() => runApp(const App());\n" * 50)
+    (source / "lib" / "pages" / "home_page.dart").write_text("class HomePage {}\n" * 20)
+    (source / "assets" / "photo.png").write_bytes(os.urandom(4096))
+    (source / "assets" / "blank.png").write_bytes(b"\x89PNG" + bytes(4096))  # badly optimized: worth deflating
+    (source / "pubspec.yaml").write_text("name: app\n")
+    (source / "empty.txt").write_bytes(b"")
+    gradlew = source / "gradlew"
+    gradlew.write_text("#!/bin/sh\n")
+    gradlew.chmod(0o775)
+    return str(source)
+
+
+def touch(source_dir: str, mtime: float):
+    for path, _ in list_files(source_dir):
+        os.utime(path, (mtime, mtime))
+
+
+def test_list_files(project):
+    names = [name for _, name in list_files(project)]
+    assert names == sorted(names)
+    assert "lib/pages/home_page.dart" in names
+    assert [name for _, name in list_files(project, only={"pubspec.yaml", "gradlew", "missing"})] == ["gradlew", "pubspec.yaml"]
+
+
+def test_zip_is_reproducible(project, tmp_path, monkeypatch):
+    first, second = str(tmp_path / "a.zip"), str(tmp_path / "b.zip")
+    # Same bytes whether entries are deflated in threads or not
+    monkeypatch.setattr(archives, "ARCHIVE_PARALLEL_MIN_BYTES", 0)
+    monkeypatch.setattr(archives, "ARCHIVE_WORKERS", 2)
+    write_zip(project, first)
+    touch(project, time.time() - 86400)
+    monkeypatch.setattr(archives, "ARCHIVE_WORKERS", 1)
+    write_zip(project, second)
+    with open(first, "rb") as a, open(second, "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_zip_entries(project, tmp_path):
+    path = str(tmp_path / "project.zip")
+    write_zip(project, path)
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.testzip() is None
+        infos = {info.filename: info for info in zipf.infolist()}
+        assert list(infos) == [name for _, name in list_files(project)]
+        for name, info in infos.items():
+            assert info.date_time == time.gmtime(SOURCE_DATE_EPOCH)[:6]
+            with open(os.path.join(project, name), "rb") as f:
+                assert zipf.read(name) == f.read()
+        assert infos["gradlew"].external_attr >> 16 & 0o777 == 0o755
+        assert infos["pubspec.yaml"].external_attr >> 16 & 0o777 == 0o644
+        assert infos["assets/photo.png"].compress_type == zipfile.ZIP_STORED
+        assert infos["assets/blank.png"].compress_type == zipfile.ZIP_DEFLATED
+        assert infos["lib/main.dart"].compress_type == zipfile.ZIP_DEFLATED
+        assert infos["empty.txt"].compress_type == zipfile.ZIP_STORED
+
+
+def test_zip_only(project, tmp_path):
+    path = str(tmp_path / "delta.zip")
+    ZIP.write(project, path, only={"lib/main.dart"})
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.namelist() == ["lib/main.dart"]
+
+
+@pytest.mark.skipif(not TAR_ZST.available, reason="zstandard is not installed")
+def test_tar_zst(project, tmp_path):
+    import zstandard
+
+    first, second = str(tmp_path / "a.tar.zst"), str(tmp_path / "b.tar.zst")
+    TAR_ZST.write(project, first)
+    touch(project, time.time() - 86400)
+    TAR_ZST.write(project, second)
+    with open(first, "rb") as a, open(second, "rb") as b:
+        data = a.read()
+        assert data == b.read()
+
+    with tarfile.open(fileobj=io.BytesIO(zstandard.ZstdDecompressor().decompressobj().decompress(data))) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == [name for _, name in list_files(project)]
+        for member in members:
+            assert (member.mtime, member.uid, member.uname) == (SOURCE_DATE_EPOCH, 0, "")
+            with open(os.path.join(project, member.name), "rb") as f:
+                assert tar.extractfile(member).read() == f.read()
+        assert tar.getmember("gradlew").mode == 0o755
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, ZIP),
+    ("", ZIP),
+    ("*/*", ZIP),
+    ("application/zip", ZIP),
+    ("text/html, application/json", ZIP),
+    ("application/zstd", TAR_ZST),
+    ("application/x-zstd-compressed-tar", TAR_ZST),
+    ("application/zip, application/zstd", TAR_ZST),
+    ("application/zip;q=1, application/zstd;q=0.5", ZIP),
+    ("application/zstd;q=0, */*", ZIP),
+    ("application/zstd;q=bogus", ZIP),
+])
+def test_negotiate(accept, expected, monkeypatch):
+    monkeypatch.setattr(TAR_ZST, "available", True)
+    assert negotiate(accept) is expected
+
+
+def test_negotiate_without_zstandard(monkeypatch):
+    monkeypatch.setattr(TAR_ZST, "available", False)
+    assert negotiate("application/zstd") is ZIP
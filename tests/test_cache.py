@@ -0,0 +1,70 @@
+import pytest
+from services import cache
+from services.cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_lru_eviction():
+    entries = TTLCache("test", max_size=2)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    assert entries.get("a") == 1  # "b" is now the least recently used
+    entries.set("c", 3)
+    assert len(entries) == 2
+    assert entries.get("b") is None
+    assert entries.get("a") == 1 and entries.get("c") == 3
+
+    entries.set("a", 4)  # overwriting refreshes too
+    entries.set("d", 5)
+    assert entries.get("c") is None and entries.get("a") == 4
+
+
+def test_ttl_expiry(clock):
+    entries = TTLCache("test", ttl=10)
+    entries.set("a", 1)
+    entries.set("b", 2, ttl=2)
+    entries.set("c", 3, ttl=60)  # capped at the cache's TTL
+    entries.set("d", 4)
+    clock[0] += 5
+    assert entries.get("a") == 1
+    assert entries.get("b", "missing") == "missing"
+    clock[0] += 5
+    assert entries.get("a") is None and entries.get("c") is None
+    assert len(entries) == 1  # expired entries are only dropped when read ("d")
+
+
+def test_nothing_cached_without_ttl_or_size():
+    entries = TTLCache("test", ttl=10)
+    entries.set("a", 1, ttl=0)
+    assert entries.get("a") is None
+    empty = TTLCache("test", max_size=0)
+    empty.set("a", 1)
+    assert len(empty) == 0
+
+
+def test_remove_where():
+    entries = TTLCache("test")
+    for user in ("u1", "u2"):
+        for project in ("p1", "p2"):
+            entries.set((user, project), project == "p1")
+    entries.remove_where(lambda key, _: key[1] == "p1")
+    assert sorted(entries._entries) == [("u1", "p2"), ("u2", "p2")]
+    entries.remove_where(lambda _, value: value is False)
+    assert len(entries) == 0
+
+
+def test_pop_and_clear():
+    entries = TTLCache("test")
+    entries.set("a", 1)
+    entries.set("b", 2)
+    entries.pop("a")
+    entries.pop("missing")
+    assert entries.get("a") is None and entries.get("b") == 2
+    entries.clear()
+    assert len(entries) == 0
@@ -0,0 +1,116 @@
+import json
+import pytest
+from services import collab_codecs
+from services.collab_codecs import CODECS, DELTA_SUBPROTOCOL, WireFormat, negotiate
+from services.json_patch import apply_patch
+
+BINARY = sorted(CODECS)
+
+
+def message(**data) -> str:
+    return json.dumps(data, separators=(",", ":"))
+
+
+def drag(widget_id: str = "w1", x: int = 0, **extra) -> str:
+    return message(type="drag", widgetId=widget_id, position={"x": x, "y": 2}, props={"label": "A widget label"}, **extra)
+
+
+def test_negotiate_text():
+    wire = negotiate([])
+    assert wire.codec is None and not wire.delta and wire.options == []
+    assert wire.encode(drag()) == drag()
+    assert negotiate(["collab.unknown"]).options == []
+
+
+@pytest.mark.parametrize("name", BINARY)
+def test_negotiate_binary(name):
+    wire = negotiate(["collab.batch", name, DELTA_SUBPROTOCOL])
+    assert wire.codec is CODECS[name]
+    assert wire.options == [name, DELTA_SUBPROTOCOL]
+
+
+def test_negotiate_first_codec_wins():
+    if len(BINARY) < 2:
+        pytest.skip("needs msgpack and cbor2")
+    assert negotiate(list(reversed(BINARY))).codec is CODECS[BINARY[-1]]
+
+
+@pytest.mark.parametrize("name", BINARY)
+def test_binary_round_trip(name):
+    wire = negotiate([name])
+    text = message(type="chat", text="héllo", n=1, f=1.5, ok=True, none=None, items=[1, {"a": []}])
+    frame = wire.encode(text)
+    assert isinstance(frame, bytes)
+    assert wire.decode(frame) == text
+
+
+@pytest.mark.parametrize("name", BINARY)
+def test_decode_invalid_frame(name):
+    with pytest.raises(ValueError):
+        negotiate([name]).decode(b"\xc1\xff\x00")
+
+
+def test_decode_without_codec():
+    with pytest.raises(ValueError):
+        negotiate([]).decode(b"{}")
+
+
+def test_plain_text_is_relayed_as_is():
+    wire = negotiate([DELTA_SUBPROTOCOL])
+    assert wire.encode("not json") == "not json"
+    assert wire.encode("not json") == "not json"
+
+
+def test_delta_against_previous_update():
+    wire = negotiate([DELTA_SUBPROTOCOL])
+    assert wire.encode(drag(x=1)) == drag(x=1)  # nothing to diff against yet
+    encoded = json.loads(wire.encode(drag(x=2)))
+    assert encoded == {"type": "drag", "widgetId": "w1", "delta": [{"op": "replace", "path": "/position/x", "value": 2}]}
+    assert apply_patch(json.loads(drag(x=1)), encoded["delta"]) == json.loads(drag(x=2))
+    # Other widgets and types have their own previous update
+    assert wire.encode(drag("w2", x=2)) == drag("w2", x=2)
+    resize = message(type="resize", widgetId="w1", size={"w": 10, "h": 20})
+    assert wire.encode(resize) == resize
+
+
+def test_delta_only_when_smaller():
+    wire = negotiate([DELTA_SUBPROTOCOL])
+    small = message(type="drag", widgetId="w1", x=1)
+    other = message(type="drag", widgetId="w1", y=2)
+    wire.encode(small)
+    assert wire.encode(other) == other
+
+
+def test_delta_unchanged_update():
+    wire = negotiate([DELTA_SUBPROTOCOL])
+    wire.encode(drag(x=1))
+    assert json.loads(wire.encode(drag(x=1)))["delta"] == []
+
+
+def test_delta_in_batch():
+    wire = negotiate([DELTA_SUBPROTOCOL])
+    wire.encode(drag(x=1))
+    chat = {"type": "chat", "text": "hi"}
+    batch = message(type="batch", messages=[json.loads(drag(x=3)), chat])
+    encoded = json.loads(wire.encode(batch))
+    assert encoded["messages"][0]["delta"] == [{"op": "replace", "path": "/position/x", "value": 3}]
+    assert encoded["messages"][1] == chat
+    # Nothing to diff: the batch goes out unchanged
+    assert negotiate([DELTA_SUBPROTOCOL]).encode(batch) == batch
+
+
+@pytest.mark.parametrize("name", BINARY)
+def test_binary_delta(name):
+    wire = negotiate([name, DELTA_SUBPROTOCOL])
+    wire.encode(drag(x=1))
+    encoded = json.loads(wire.decode(wire.encode(drag(x=2))))
+    assert encoded["delta"] == [{"op": "replace", "path": "/position/x", "value": 2}]
+
+
+def test_delta_widgets_are_bounded(monkeypatch):
+    monkeypatch.setattr(collab_codecs, "COLLAB_DELTA_WIDGETS", 2)
+    wire = WireFormat(delta=True)
+    for widget_id in ("w1", "w2", "w3"):
+        wire.encode(drag(widget_id, x=1))
+    assert wire.encode(drag("w1", x=2)) == drag("w1", x=2)  # forgotten: sent whole
+    assert "delta" in json.loads(wire.encode(drag("w3", x=2)))
@@ -0,0 +1,195 @@
+import asyncio
+import copy
+import json
+import uuid
+from types import SimpleNamespace
+import pytest
+from services import collab_documents
+from services.collab_documents import DocumentManager, RoomDocument, parse_base
+from services.json_patch import JsonPatchError
+
+PAGES = {"pages": [{"id": "a", "name": "A"}, {"id": "b", "name": "B"}, {"id": "c", "name": "C"}]}
+
+
+def room_document(data=PAGES, version=1):
+    document = RoomDocument(uuid.uuid4(), copy.deepcopy(data), version, epoch=1)
+    document.saved_json = document.data_json()
+    return document
+
+
+def names(document):
+    return [page["name"] for page in document.data["pages"]]
+
+
+def test_concurrent_array_edits():
+    document = room_document()
+    # Both made against seq 0: x removes the first page, y renames the third
+    document.apply([{"op": "remove", "path": "/pages/0"}], (1, 0), "x")
+    message, operations = document.apply([{"op": "replace", "path": "/pages/2/name", "value": "C!"}], (1, 0), "y")
+    assert names(document) == ["B", "C!"]
+    # Everyone is sent the operations as applied
+    assert operations == [{"op": "replace", "path": "/pages/1/name", "value": "C!"}]
+    assert json.loads(message)["ops"] == operations
+    assert document.seq == 2
+
+
+def test_concurrent_inserts():
+    document = room_document()
+    document.apply([{"op": "add", "path": "/pages/1", "value": {"id": "x", "name": "X"}}], (1, 0), "x")
+    document.apply([{"op": "add", "path": "/pages/1", "value": {"id": "y", "name": "Y"}}], (1, 0), "y")
+    document.apply([{"op": "replace", "path": "/pages/1/name", "value": "B!"}], (1, 0), "z")
+    assert names(document) == ["A", "X", "Y", "B!", "C"]
+
+
+def test_edit_of_a_removed_element_is_rejected():
+    document = room_document()
+    document.apply([{"op": "remove", "path": "/pages/1"}], (1, 0), "x")
+    with pytest.raises(JsonPatchError):
+        document.apply([{"op": "replace", "path": "/pages/1/name", "value": "B!"}], (1, 0), "y")
+    assert names(document) == ["A", "C"] and document.seq == 1
+
+
+def test_own_patches_are_not_rebased_over():
+    document = room_document()
+    document.apply([{"op": "remove", "path": "/pages/0"}], (1, 0), "x")
+    # Sent by x before the ack: relative to its own removal
+    document.apply([{"op": "replace", "path": "/pages/0/name", "value": "B!"}], (1, 0), "x")
+    assert names(document) == ["B!", "C"]
+
+
+def test_stale_base(monkeypatch):
+    monkeypatch.setattr(collab_documents, "COLLAB_REPLAY_BUFFER", 2)
+    document = room_document()
+    for index in range(3):
+        document.apply([{"op": "add", "path": f"/k{index}", "value": index}], (1, index), "x")
+    with pytest.raises(JsonPatchError, match="sync"):
+        document.apply([{"op": "replace", "path": "/pages/0/name", "value": "A!"}], (1, 0), "y")
+    with pytest.raises(JsonPatchError, match="sync"):
+        document.apply([{"op": "replace", "path": "/pages/0/name", "value": "A!"}], (7, 3), "y")
+    # Without array positions there is nothing to rebase
+    document.apply([{"op": "add", "path": "/title", "value": "T"}, {"op": "add", "path": "/pages/-", "value": {}}], (1, 0), "y")
+    assert document.data["title"] == "T" and document.seq == 4
+
+
+def test_missed_since():
+    document = room_document()
+    messages = [document.apply([{"op": "add", "path": f"/k{index}", "value": index}])[0] for index in range(3)]
+    assert document.missed_since(1, 0) == messages
+    assert document.missed_since(1, 2) == messages[2:]
+    assert document.missed_since(1, 3) == []
+    assert document.missed_since(1, 4) is None  # Ahead of the room
+    assert document.missed_since(2, 0) is None  # Another epoch
+
+
+def test_replay_is_trimmed(monkeypatch):
+    monkeypatch.setattr(collab_documents, "COLLAB_REPLAY_BUFFER", 3)
+    document = room_document()
+    messages = [document.apply([{"op": "add", "path": f"/k{index}", "value": index}])[0] for index in range(5)]
+    assert document.replay_base == 2
+    assert document.missed_since(1, 1) is None
+    assert document.missed_since(1, 2) == messages[2:]
+
+    monkeypatch.setattr(collab_documents, "COLLAB_REPLAY_MAX_BYTES", 2 * len(messages[-1]))
+    document.apply([{"op": "add", "path": "/k5", "value": 5}])
+    assert document.replay_base == 4 and len(document.replay) == 2
+
+
+def test_reset_and_load_replay():
+    document = room_document()
+    messages = [document.apply([{"op": "add", "path": f"/k{index}", "value": index}])[0] for index in range(3)]
+    replica = RoomDocument(document.project_id, document.data, 1, epoch=1, seq=3)
+    replica.load_replay(messages[1:])
+    assert replica.missed_since(1, 1) == messages[1:]
+    assert replica.missed_since(1, 0) is None
+    document.reset({}, 2, 1, 4, 3)
+    assert document.missed_since(1, 3) is None and document.missed_since(1, 4) == []
+
+
+def test_rebase_onto():
+    document = room_document()
+    saving = [[{"op": "replace", "path": "/pages/1/name", "value": "B!"}]]
+    for operations in saving:
+        document.apply(operations)
+    # Arrived while saving
+    document.apply([{"op": "remove", "path": "/pages/2"}])
+    document.unsaved = [[{"op": "remove", "path": "/pages/2"}]]
+    # Meanwhile a REST write put a new page first and dropped c
+    rest = {"pages": [{"id": "n", "name": "N"}, {"id": "a", "name": "A"}, {"id": "b", "name": "B"}], "theme": "dark"}
+
+    saving = document.rebase_onto(copy.deepcopy(rest), 5, saving)
+    assert saving == [[{"op": "replace", "path": "/pages/2/name", "value": "B!"}]]
+    assert document.unsaved == []  # c was already removed
+    assert document.data == {**rest, "pages": [{"id": "n", "name": "N"}, {"id": "a", "name": "A"}, {"id": "b", "name": "B!"}]}
+    assert (document.version, document.seq) == (5, 3)
+    assert json.loads(document.saved_json) == rest
+    assert document.missed_since(1, 2) is None  # Joiners get the merged snapshot
+
+
+class FakeHub:
+    def __init__(self):
+        self.rooms = {}
+        self.backplane = SimpleNamespace(distributed=False)
+        self.sent = []
+
+    def send_local(self, room, message, exclude=None):
+        self.sent.append(json.loads(message))
+
+
+class FakeSession:
+    def __init__(self, store):
+        self.store = store
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement):
+        row = SimpleNamespace(data=copy.deepcopy(self.store["data"]), version=self.store["version"])
+        return SimpleNamespace(first=lambda: row)
+
+
+def test_persist_merges_concurrent_rest_writes(monkeypatch):
+    store = {"data": copy.deepcopy(PAGES), "version": 1}
+    document = room_document()
+    manager = DocumentManager(FakeHub())
+    writes = []
+
+    async def update_project(db, project_id, data, expected_versions):
+        writes.append(copy.deepcopy(data))
+        if len(writes) <= 2:
+            # A REST write lands before each of the first two attempts; a
+            # room patch arrives during the second one
+            store["data"]["pages"].insert(0, {"id": f"rest{len(writes)}", "name": "R"})
+            store["version"] += 1
+            if len(writes) == 2:
+                operations = [{"op": "replace", "path": "/pages/1/name", "value": "A!"}]
+                document.apply(operations, (1, document.seq), "y")
+                document.unsaved.append(operations)
+        if store["version"] not in expected_versions:
+            return None
+        store["data"], store["version"] = data, store["version"] + 1
+        return SimpleNamespace(version=store["version"])
+
+    monkeypatch.setattr(collab_documents, "SessionLocal", lambda: FakeSession(store))
+    monkeypatch.setattr(collab_documents.ProjectService, "update_project", update_project)
+
+    for operations in ([{"op": "replace", "path": "/pages/2/name", "value": "C!"}],
+                       [{"op": "remove", "path": "/pages/1"}]):
+        document.apply(operations, (1, document.seq), "x")
+        document.unsaved.append(operations)
+    asyncio.run(manager._persist("room", document))
+
+    assert len(writes) == 3
+    assert [page["id"] for page in store["data"]["pages"]] == ["rest2", "rest1", "a", "c"]
+    assert [page["name"] for page in store["data"]["pages"]] == ["R", "R", "A!", "C!"]
+    assert document.version == store["version"] and document.unsaved == []
+    assert [message["type"] for message in manager.hub.sent] == ["snapshot", "snapshot", "saved"]
+
+
+@pytest.mark.parametrize("data", [{}, {"epoch": 1}, {"epoch": "1", "base": 0}, {"epoch": 1, "base": True}])
+def test_patch_needs_a_base(data):
+    with pytest.raises(JsonPatchError):
+        parse_base(data)
+    assert parse_base({"epoch": 2, "base": 5}) == (2, 5)
@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from fastapi import status
+from services.collab_peers import Peer
+from services.metrics import metrics
+
+
+class FakeWebSocket:
+    """Records frames; writes block while ``gate`` is closed"""
+
+    def __init__(self, fail: bool = False):
+        self.sent = []
+        self.closed_with = None
+        self.fail = fail
+        self.gate = asyncio.Event()
+
+    async def send_text(self, frame):
+        await self.gate.wait()
+        if self.fail:
+            raise RuntimeError("connection reset")
+        self.sent.append(frame)
+
+    async def send_bytes(self, frame):
+        await self.send_text(frame)
+
+    async def close(self, code):
+        self.closed_with = code
+
+
+async def stalled_peer(policy, max_queue=2, **kwargs):
+    """A peer with "a" being written and a full queue behind it"""
+    ws = FakeWebSocket()
+    peer = Peer(ws, max_queue=max_queue, policy=policy, **kwargs)
+    assert peer.send("a")
+    await asyncio.sleep(0)  # the writer takes "a" and waits on the socket
+    assert peer.send("b") and peer.send("c")
+    assert peer.queued == 2 and peer.free_slots() == 0
+    return ws, peer
+
+
+async def flush(ws, peer):
+    ws.gate.set()
+    while peer.queued:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    await peer.close()
+
+
+def test_drop_oldest():
+    async def scenario():
+        ws, peer = await stalled_peer("drop_oldest")
+        dropped = metrics.get_counter("collab_send_dropped")
+        assert peer.send("d")
+        assert metrics.get_counter("collab_send_dropped") == dropped + 1
+        await flush(ws, peer)
+        return ws.sent
+
+    assert asyncio.run(scenario()) == ["a", "c", "d"]
+
+
+def test_drop_newest():
+    async def scenario():
+        ws, peer = await stalled_peer("drop_newest")
+        assert not peer.send("d")
+        assert not peer.closed
+        await flush(ws, peer)
+        return ws.sent
+
+    assert asyncio.run(scenario()) == ["a", "b", "c"]
+
+
+def test_disconnect():
+    async def scenario():
+        ws, peer = await stalled_peer("disconnect")
+        assert not peer.send("d")
+        assert peer.closed
+        assert not peer.send("e")
+        await asyncio.sleep(0)
+        ws.gate.set()
+        await asyncio.sleep(0)
+        return ws
+
+    ws = asyncio.run(scenario())
+    assert ws.closed_with == status.WS_1013_TRY_AGAIN_LATER
+    assert ws.sent == []  # the write in progress was cancelled
+
+
+def test_stalled_write_disconnects():
+    async def scenario():
+        ws = FakeWebSocket()
+        peer = Peer(ws, policy="drop_oldest", send_timeout=0.01)
+        peer.send("a")
+        await asyncio.sleep(0.05)
+        return ws, peer
+
+    ws, peer = asyncio.run(scenario())
+    assert peer.closed and ws.closed_with == status.WS_1013_TRY_AGAIN_LATER
+
+
+def test_failed_write_closes_peer():
+    async def scenario():
+        ws = FakeWebSocket(fail=True)
+        ws.gate.set()
+        peer = Peer(ws)
+        peer.send("a")
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return ws, peer
+
+    ws, peer = asyncio.run(scenario())
+    assert peer.closed and ws.closed_with is None
+    assert not peer.send("b")
+
+
+@pytest.mark.parametrize("policy", ["drop_oldest", "drop_newest", "disconnect"])
+def test_no_drops_below_the_limit(policy):
+    async def scenario():
+        ws = FakeWebSocket()
+        peer = Peer(ws, max_queue=3, policy=policy)
+        for message in "abcd":
+            assert peer.send(message)
+            await asyncio.sleep(0)
+        await flush(ws, peer)
+        return ws.sent
+
+    assert asyncio.run(scenario()) == ["a", "b", "c", "d"]
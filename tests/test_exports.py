@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+import json
+import zipfile
+import pytest
+from services import exports
+from services.archives import ZIP
+from services.exports import DELTA_FILE, build_manifest, load_base, manifest_id, write_export
+
+
+@pytest.fixture
+def project(tmp_path):
+    source = tmp_path / "project"
+    (source / "lib" / "pages").mkdir(parents=True)
+    (source / "lib" / "main.dart").write_text("void main() {}\n")
+    (source / "lib" / "pages" / "home_page.dart").write_text("class HomePage {}\n")
+    (source / "lib" / "pages" / "old_page.dart").write_text("class OldPage {}\n")
+    (source / "pubspec.yaml").write_text("name: app\n")
+    return source
+
+
+def test_build_manifest(project):
+    files = build_manifest(str(project))
+    assert list(files) == ["lib/main.dart", "lib/pages/home_page.dart", "lib/pages/old_page.dart", "pubspec.yaml"]
+    assert files["pubspec.yaml"] == hashlib.sha256(b"name: app\n").hexdigest()
+
+
+def test_manifest_id():
+    files = {"b": "2", "a": "1"}
+    assert manifest_id(files) == manifest_id({"a": "1", "b": "2"})
+    assert manifest_id(files) != manifest_id({"a": "1", "b": "3"})
+    assert len(manifest_id({})) == 64
+
+
+def test_full_export(project, tmp_path):
+    path = str(tmp_path / "full.zip")
+    export = write_export(str(project), path, ZIP)
+    assert not export.is_delta
+    assert export.manifest_id == manifest_id(build_manifest(str(project)))
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.namelist() == list(export.files)
+
+
+def test_delta_export(project, tmp_path):
+    base = write_export(str(project), str(tmp_path / "full.zip"), ZIP)
+
+    (project / "lib" / "main.dart").write_text("void main() => runApp();\n")
+    (project / "lib" / "pages" / "old_page.dart").unlink()
+    (project / "lib" / "pages" / "new_page.dart").write_text("class NewPage {}\n")
+    path = str(tmp_path / "delta.zip")
+    export = write_export(str(project), path, ZIP, base=(base.manifest_id, base.files))
+
+    assert export.is_delta and export.base_id == base.manifest_id
+    assert sorted(export.changed) == ["lib/main.dart", "lib/pages/new_page.dart"]
+    assert export.deleted == ["lib/pages/old_page.dart"]
+    # The manifest describes the project, not the archive
+    assert DELTA_FILE not in export.files
+    assert export.manifest_id == manifest_id(export.files)
+    with zipfile.ZipFile(path) as zipf:
+        assert sorted(zipf.namelist()) == sorted([DELTA_FILE, "lib/main.dart", "lib/pages/new_page.dart"])
+        assert json.loads(zipf.read(DELTA_FILE)) == {
+            "base": base.manifest_id, "manifest": export.manifest_id, "deleted": ["lib/pages/old_page.dart"],
+        }
+
+
+def test_delta_without_changes(project, tmp_path):
+    base = write_export(str(project), str(tmp_path / "full.zip"), ZIP)
+    export = write_export(str(project), str(tmp_path / "delta.zip"), ZIP, base=(base.manifest_id, base.files))
+    assert export.manifest_id == base.manifest_id
+    assert export.changed == [] and export.deleted == []
+    with zipfile.ZipFile(str(tmp_path / "delta.zip")) as zipf:
+        assert zipf.namelist() == [DELTA_FILE]
+
+
+@pytest.mark.parametrize("export_id", [None, "", "not-a-manifest", "A" * 64])
+def test_load_base_invalid_id(export_id):
+    # Rejected before any database access
+    assert asyncio.run(load_base(export_id)) is None
+
+
+def test_load_base_cached(monkeypatch):
+    files = {"lib/main.dart": "0" * 64}
+    export_id = manifest_id(files)
+    monkeypatch.setattr(exports, "SessionLocal", None)  # must not be used
+    exports._manifests.set(export_id, files)
+    assert asyncio.run(load_base(export_id)) == (export_id, files)
@@ -0,0 +1,375 @@
+import asyncio
+import copy
+import json
+import os
+import uuid
+import pytest
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from services.json_patch import (
+    JsonPatchError, apply_patch, array_effects, build_patch_statement, format_pointer, has_positions, make_patch,
+    parse_pointer, rebase_patch, validate_patch,
+)
+
+DOCUMENT = {
+    "title": "Home",
+    "pages": [
+        {"id": "p1", "widgets": [{"id": "w1", "position": {"x": 1, "y": 2}}, {"id": "w2"}]},
+        {"id": "p2", "widgets": []},
+    ],
+    "meta": {"a/b": 1, "c~d": 2},
+}
+
+
+@pytest.mark.parametrize("new", [
+    {**DOCUMENT, "title": "Start"},
+    {"title": "Home", "pages": [], "meta": {}},
+    {**DOCUMENT, "pages": DOCUMENT["pages"] + [{"id": "p3", "widgets": [{"id": "w3"}]}]},
+    {**DOCUMENT, "pages": DOCUMENT["pages"][:1]},
+    {**DOCUMENT, "meta": {"a/b": 3, "e~f/g": None}},
+    {**DOCUMENT, "pages": [{"id": "p1", "widgets": [{"id": "w2"}, {"id": "w1", "position": {"x": 9}}]}]},
+    {**DOCUMENT, "title": 1},
+    [1, 2, 3],
+    None,
+])
+def test_make_patch_round_trip(new):
+    operations = make_patch(DOCUMENT, new)
+    assert apply_patch(DOCUMENT, operations) == new
+
+
+def test_make_patch_equal_documents():
+    assert make_patch(DOCUMENT, copy.deepcopy(DOCUMENT)) == []
+
+
+@pytest.mark.parametrize("old, new", [
+    ({"x": 1}, {"x": True}),
+    ([{"x": 0}], [{"x": False}]),
+    ({"x": {"y": 1}}, {"x": {"y": 1.0}}),
+])
+def test_make_patch_keeps_json_types(old, new):
+    # Equal in Python, different JSON
+    operations = make_patch(old, new)
+    assert operations
+    assert repr(apply_patch(old, operations)) == repr(new)
+
+
+def test_apply_patch_does_not_modify_input():
+    original = copy.deepcopy(DOCUMENT)
+    result = apply_patch(DOCUMENT, [{"op": "add", "path": "/pages/0/widgets/-", "value": {"id": "w3"}}])
+    assert DOCUMENT == original
+    assert result["pages"][0]["widgets"][-1] == {"id": "w3"}
+
+
+def test_apply_patch_operations():
+    result = apply_patch(DOCUMENT, [
+        {"op": "test", "path": "/title", "value": "Home"},
+        {"op": "move", "from": "/pages/0/widgets/1", "path": "/pages/1/widgets/0"},
+        {"op": "copy", "from": "/pages/0/widgets/0/position", "path": "/meta/position"},
+        {"op": "replace", "path": "/meta/a~1b", "value": 5},
+        {"op": "remove", "path": "/meta/c~0d"},
+    ])
+    assert result["pages"][0]["widgets"] == [{"id": "w1", "position": {"x": 1, "y": 2}}]
+    assert result["pages"][1]["widgets"] == [{"id": "w2"}]
+    assert result["meta"] == {"a/b": 5, "position": {"x": 1, "y": 2}}
+
+
+@pytest.mark.parametrize("operations", [
+    [{"op": "test", "path": "/title", "value": "Other"}],
+    [{"op": "remove", "path": "/missing"}],
+    [{"op": "add", "path": "/pages/5", "value": {}}],
+    [{"op": "replace", "path": "/pages/0/widgets/2", "value": {}}],
+])
+def test_apply_patch_failures(operations):
+    with pytest.raises(JsonPatchError):
+        apply_patch(DOCUMENT, operations)
+
+
+def test_apply_patch_in_place_rolls_back():
+    document = copy.deepcopy(DOCUMENT)
+    operations = [
+        {"op": "replace", "path": "/title", "value": "Start"},
+        {"op": "add", "path": "/pages/0/widgets/0", "value": {"id": "w0"}},
+        {"op": "remove", "path": "/pages/1"},
+        {"op": "move", "from": "/meta/a~1b", "path": "/moved"},
+        {"op": "add", "path": "/meta/new", "value": 1},
+        {"op": "test", "path": "/title", "value": "Home"},  # fails: everything above is undone
+    ]
+    with pytest.raises(JsonPatchError):
+        apply_patch(document, operations, in_place=True)
+    assert document == DOCUMENT
+
+
+def test_apply_patch_in_place():
+    document = copy.deepcopy(DOCUMENT)
+    result = apply_patch(document, [{"op": "remove", "path": "/pages/1"}], in_place=True)
+    assert result is document
+    assert len(document["pages"]) == 1
+
+
+def test_apply_patch_root():
+    assert apply_patch(DOCUMENT, [{"op": "replace", "path": "", "value": {"x": 1}}]) == {"x": 1}
+    with pytest.raises(JsonPatchError):
+        apply_patch(DOCUMENT, [{"op": "remove", "path": ""}])
+
+
+def test_pointers():
+    assert parse_pointer("") == []
+    assert parse_pointer("/a~1b/c~0d/0") == ["a/b", "c~d", "0"]
+    assert format_pointer(["a/b", "c~d", "0"]) == "/a~1b/c~0d/0"
+    with pytest.raises(JsonPatchError):
+        parse_pointer("pages")
+
+
+@pytest.mark.parametrize("operation, message", [
+    ({"op": "bogus", "path": "/a"}, "unknown op"),
+    ({"op": "add", "path": "/a"}, "missing 'value'"),
+    ({"op": "copy", "path": "/a"}, "missing 'from'"),
+    ({"op": "replace", "value": 1}, "missing 'path'"),
+    ({"op": "move", "from": "/pages", "path": "/pages/0"}, "into one of its children"),
+    ({"op": "remove", "path": "/pages/-1"}, "invalid array index"),
+    ({"op": "remove", "path": "/pages/01"}, "invalid array index"),
+    ({"op": "copy", "from": "/pages/-0", "path": "/x"}, "invalid array index"),
+])
+def test_validate_patch_errors(operation, message):
+    with pytest.raises(JsonPatchError, match=message):
+        validate_patch([operation])
+
+
+def test_validate_patch_limit():
+    operations = [{"op": "test", "path": "/title", "value": "Home"}] * 3
+    with pytest.raises(JsonPatchError):
+        validate_patch(operations, limit=2)
+    assert len(validate_patch(operations, limit=None)) == 3
+
+
+def pages(*ids):
+    return {"pages": [{"id": page_id, "widgets": []} for page_id in ids]}
+
+
+def concurrently(document, first, second):
+    """Apply ``first``, then ``second`` made against the same ``document``"""
+    effects = []
+    document = apply_patch(document, first, effects=effects)
+    return rebase_patch(document, second, effects)
+
+
+def ids(document):
+    return [page["id"] for page in document["pages"]]
+
+
+def test_rebase_over_removal():
+    document, rebased = concurrently(pages("a", "b", "c", "d"), [{"op": "remove", "path": "/pages/0"}],
+                                     [{"op": "add", "path": "/pages/3/name", "value": "D"}])
+    assert rebased == [{"op": "add", "path": "/pages/2/name", "value": "D"}]
+    assert document["pages"][2] == {"id": "d", "widgets": [], "name": "D"}
+
+
+def test_rebase_over_insertion():
+    document, _ = concurrently(pages("a", "b"), [{"op": "add", "path": "/pages/0", "value": {"id": "x"}}],
+                               [{"op": "add", "path": "/pages/1/widgets/-", "value": {"id": "w"}}])
+    assert ids(document) == ["x", "a", "b"]
+    assert document["pages"][2]["widgets"] == [{"id": "w"}]
+
+
+def test_rebase_concurrent_inserts_at_the_same_position():
+    document, rebased = concurrently(pages("a", "b"), [{"op": "add", "path": "/pages/1", "value": {"id": "x"}}],
+                                     [{"op": "add", "path": "/pages/1", "value": {"id": "y"}}])
+    assert ids(document) == ["a", "x", "y", "b"]
+    assert rebased[0]["path"] == "/pages/2"
+
+
+def test_rebase_follows_moved_element():
+    document, rebased = concurrently(pages("a", "b", "c"), [{"op": "move", "from": "/pages/0", "path": "/pages/2"}],
+                                     [{"op": "add", "path": "/pages/0/name", "value": "A"}])
+    assert ids(document) == ["b", "c", "a"]
+    assert rebased[0]["path"] == "/pages/2/name"
+
+
+def test_rebase_within_the_patch():
+    # The second operation is relative to the first: a is gone, d is /pages/2
+    document, _ = concurrently(pages("a", "b", "c", "d"), [{"op": "move", "from": "/pages/3", "path": "/pages/0"}], [
+        {"op": "remove", "path": "/pages/0"},
+        {"op": "add", "path": "/pages/2/name", "value": "D"},
+    ])
+    assert ids(document) == ["d", "b", "c"]
+    assert document["pages"][0]["name"] == "D"
+
+
+def test_rebase_conflict():
+    document = pages("a", "b")
+    effects = []
+    document = apply_patch(document, [{"op": "remove", "path": "/pages/1"}], effects=effects)
+    before = copy.deepcopy(document)
+    with pytest.raises(JsonPatchError, match="removed by a concurrent change"):
+        rebase_patch(document, [{"op": "add", "path": "/pages/1/name", "value": "B"}], effects, in_place=True)
+    assert document == before
+    # Inserting where the removed element was is fine
+    _, rebased = rebase_patch(document, [{"op": "add", "path": "/pages/1", "value": {"id": "c"}}], effects)
+    assert rebased[0]["path"] == "/pages/1"
+
+
+def test_rebase_updates_concurrent_effects():
+    effects = []
+    document = apply_patch(pages("a", "b", "c"), [{"op": "remove", "path": "/pages/0"}], effects=effects)
+    document, _ = rebase_patch(document, [{"op": "add", "path": "/pages/0", "value": {"id": "x"}}], effects)
+    # The next patch of the same writer (made after its insert) is rebased too
+    document, rebased = rebase_patch(document, [{"op": "add", "path": "/pages/2/name", "value": "B"}], effects)
+    assert ids(document) == ["x", "b", "c"]
+    assert rebased[0]["path"] == "/pages/1/name"
+
+
+def test_array_effects():
+    old = {"pages": [{"id": "a", "widgets": [{"id": 1}, {"id": 2}]}, {"id": "b"}, {"id": "c"}], "tags": ["x", "y"]}
+    new = {"pages": [{"id": "b"}, {"id": "a", "widgets": [{"id": 2}]}, {"id": "n"}, {"id": "c"}], "tags": ["x", "z"]}
+    effects = array_effects(old, new)
+
+    def rebased(pointer):
+        """Where an edit of ``pointer`` in old lands in new"""
+        return rebase_patch(new, [{"op": "replace", "path": pointer, "value": 0}], list(effects))[1][0]["path"]
+
+    assert rebased("/pages/0/widgets/1") == "/pages/1/widgets/0"
+    assert rebased("/pages/2") == "/pages/3"
+    assert rebased("/tags/1") == "/tags/1"  # plain values are edited in place
+    with pytest.raises(JsonPatchError):
+        rebased("/pages/0/widgets/0")  # removed
+
+
+def test_has_positions():
+    assert has_positions([{"op": "remove", "path": "/pages/0"}])
+    assert has_positions([{"op": "move", "from": "/pages/0", "path": "/trash"}])
+    assert not has_positions([{"op": "add", "path": "/pages/-", "value": {}}, {"op": "replace", "path": "/title", "value": ""}])
+
+
+def compile_patch(operations, expected_versions=None):
+    statement, params = build_patch_statement(validate_patch(operations), expected_versions)
+    compiled = text(statement).compile(dialect=postgresql.dialect())
+    assert set(compiled.params) <= {"project_id", *params}  # every placeholder is bound
+    return str(compiled), params
+
+
+def test_build_patch_statement_chains_steps():
+    sql, params = compile_patch([
+        {"op": "test", "path": "/title", "value": "Home"},
+        {"op": "replace", "path": "/title", "value": "Start"},
+        {"op": "remove", "path": "/meta/a~1b"},
+    ])
+    assert sql.startswith("WITH s0 AS (SELECT COALESCE(NULLIF(data, 'null'::jsonb), '{}'::jsonb) AS d, true AS ok ")
+    assert "s1 AS (SELECT d AS d, ok AND COALESCE((d #> CAST(%(op0_target)s AS text[])) = CAST(%(op0_value)s AS jsonb), false) AS ok FROM s0)" in sql
+    assert "s2 AS (SELECT jsonb_set(d, CAST(%(op1_target)s AS text[]), CAST(%(op1_value)s AS jsonb), false) AS d" in sql
+    assert "s3 AS (SELECT d #- CAST(%(op2_target)s AS text[]) AS d" in sql
+    assert "UPDATE project SET data = s3.d, updated_at = now(), version = project.version + 1 FROM s3 " in sql
+    assert "WHERE project.id = %(project_id)s AND s3.ok RETURNING project.id" in sql
+    assert params == {
+        "op0_target": ["title"], "op0_value": '"Home"',
+        "op1_target": ["title"], "op1_value": '"Start"',
+        "op2_target": ["meta", "a/b"],
+    }
+
+
+def test_build_patch_statement_add():
+    sql, params = compile_patch([
+        {"op": "add", "path": "/pages/-", "value": {"id": "p3"}},
+        {"op": "add", "path": "/pages/0", "value": {"id": "p0"}},
+        {"op": "add", "path": "/meta/new", "value": 1},
+    ])
+    # "-" appends after the last element
+    assert "jsonb_insert(d, CAST(%(op0_path)s AS text[]), CAST(%(op0_value)s AS jsonb), true)" in sql
+    assert params["op0_path"] == ["pages", "-1"] and params["op0_parent"] == ["pages"]
+    assert "jsonb_typeof(d #> CAST(%(op0_parent)s AS text[])) = 'array'" in sql
+    # A numeric token inserts into arrays and sets object keys
+    assert ("CASE WHEN jsonb_typeof(d #> CAST(%(op1_parent)s AS text[])) = 'array' "
+            "THEN jsonb_insert(d, CAST(%(op1_path)s AS text[]), CAST(%(op1_value)s AS jsonb)) "
+            "ELSE jsonb_set(d, CAST(%(op1_path)s AS text[]), CAST(%(op1_value)s AS jsonb), true) END") in sql
+    assert "0 <= jsonb_array_length(d #> CAST(%(op1_parent)s AS text[]))" in sql
+    assert "jsonb_set(d, CAST(%(op2_path)s AS text[]), CAST(%(op2_value)s AS jsonb), true)" in sql
+    assert "jsonb_typeof(d #> CAST(%(op2_parent)s AS text[])) = 'object'" in sql
+
+
+def test_build_patch_statement_move_and_copy():
+    sql, params = compile_patch([
+        {"op": "move", "from": "/pages/1", "path": "/pages/0"},
+        {"op": "copy", "from": "/title", "path": "/meta/title"},
+    ])
+    # move removes the source before inserting it, copy reads it unchanged
+    assert "jsonb_insert((d #- CAST(%(op0_from)s AS text[])), CAST(%(op0_path)s AS text[]), (d #> CAST(%(op0_from)s AS text[])))" in sql
+    assert "ok AND COALESCE((d #> CAST(%(op0_from)s AS text[])) IS NOT NULL AND (" in sql
+    assert "jsonb_set(d, CAST(%(op1_path)s AS text[]), (d #> CAST(%(op1_from)s AS text[])), true)" in sql
+    assert params["op0_from"] == ["pages", "1"] and params["op1_from"] == ["title"]
+
+
+def test_build_patch_statement_root_and_versions():
+    sql, params = compile_patch([{"op": "replace", "path": "", "value": {}}], expected_versions={3, 2})
+    assert "s1 AS (SELECT CAST(%(op0_value)s AS jsonb) AS d" in sql
+    assert "AND s1.ok AND project.version = ANY(CAST(%(expected_versions)s AS integer[])) RETURNING" in sql
+    assert params["expected_versions"] == [2, 3]
+
+
+# Runs the statements on a temporary table; needs a Postgres server
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+async def run_patch(document, operations, version=1, expected_versions=None):
+    """(returned row, stored data) after patching a project holding ``document``"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.pool import NullPool
+    from models.database import to_async_url
+
+    engine = create_async_engine(to_async_url(TEST_DATABASE_URL), poolclass=NullPool)
+    project_id = uuid.uuid4()
+    statement, params = build_patch_statement(validate_patch(operations), expected_versions)
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text(
+                "CREATE TEMPORARY TABLE project (id uuid PRIMARY KEY, name text, owner_id uuid, "
+                "created_at timestamptz DEFAULT now(), updated_at timestamptz, version integer, data jsonb)"
+            ))
+            await connection.execute(
+                text("INSERT INTO project (id, name, version, data) VALUES (:id, 'App', :version, CAST(:data AS jsonb))"),
+                {"id": project_id, "version": version, "data": json.dumps(document)},
+            )
+            row = (await connection.execute(text(statement), {"project_id": project_id, **params})).first()
+            data = (await connection.execute(text("SELECT data FROM project"))).scalar_one()
+            await connection.rollback()
+    finally:
+        await engine.dispose()
+    return row, data
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+@pytest.mark.parametrize("operations", [
+    [{"op": "test", "path": "/title", "value": "Home"}, {"op": "replace", "path": "/title", "value": "Start"}],
+    [{"op": "add", "path": "/pages/-", "value": {"id": "p3", "widgets": []}}],
+    [{"op": "add", "path": "/pages/0/widgets/1", "value": {"id": "w9"}}, {"op": "add", "path": "/meta/0", "value": 0}],
+    [{"op": "remove", "path": "/pages/0/widgets/0"}, {"op": "remove", "path": "/meta/c~0d"}],
+    [{"op": "move", "from": "/pages/1", "path": "/pages/0"}, {"op": "move", "from": "/title", "path": "/name"}],
+    [{"op": "copy", "from": "/pages/0/widgets/0/position", "path": "/pages/1/position"}],
+    [{"op": "replace", "path": "", "value": {"title": "New"}}],
+])
+def test_patch_statement_matches_apply_patch(operations):
+    row, data = asyncio.run(run_patch(DOCUMENT, operations))
+    assert row is not None and row.version == 2
+    assert data == apply_patch(DOCUMENT, operations)
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+@pytest.mark.parametrize("operations", [
+    [{"op": "replace", "path": "/title", "value": "Start"}, {"op": "test", "path": "/title", "value": "Home"}],
+    [{"op": "test", "path": "/pages/0/id", "value": "p2"}],
+    [{"op": "remove", "path": "/missing"}],
+    [{"op": "add", "path": "/pages/5", "value": {}}],
+    [{"op": "add", "path": "/title/-", "value": 1}],
+    [{"op": "move", "from": "/missing", "path": "/title"}],
+])
+def test_failed_patch_statement_returns_no_row(operations):
+    row, data = asyncio.run(run_patch(DOCUMENT, operations))
+    assert row is None
+    assert data == DOCUMENT
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+def test_patch_statement_expected_versions():
+    operations = [{"op": "replace", "path": "/title", "value": "Start"}]
+    row, data = asyncio.run(run_patch(DOCUMENT, operations, version=4, expected_versions={3}))
+    assert row is None and data == DOCUMENT
+    row, data = asyncio.run(run_patch(DOCUMENT, operations, version=4, expected_versions={3, 4}))
+    assert row.version == 5 and data["title"] == "Start"
@@ -0,0 +1,68 @@
+import asyncio
+import uuid
+import pytest
+from services import project_access
+from services.project_access import ensure_access, invalidate_grants
+from services.user_service import ProjectService
+
+
+class FakeSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def grants(monkeypatch):
+    calls = []
+
+    async def grant_access(db, project_id, user_id):
+        calls.append((user_id, project_id))
+        return True
+
+    monkeypatch.setattr(project_access, "SessionLocal", FakeSession)
+    monkeypatch.setattr(ProjectService, "grant_access", grant_access)
+    project_access._grants.clear()
+    yield calls
+    project_access._grants.clear()
+
+
+def test_grants_are_cached(grants):
+    project_id, user_id = uuid.uuid4(), uuid.uuid4()
+    assert asyncio.run(ensure_access(project_id, user_id)) is True
+    assert asyncio.run(ensure_access(project_id, user_id)) is False
+    assert len(grants) == 1
+
+
+def test_invalidate_grants(grants):
+    project_id, other = uuid.uuid4(), uuid.uuid4()
+    users = [uuid.uuid4(), uuid.uuid4()]
+    for user_id in users:
+        asyncio.run(ensure_access(project_id, user_id))
+    asyncio.run(ensure_access(other, users[0]))
+
+    invalidate_grants(project_id)
+    for user_id in users:
+        asyncio.run(ensure_access(project_id, user_id))
+    asyncio.run(ensure_access(other, users[0]))
+    # Checked again in the database (which rejects deleted projects); the other project stays cached
+    assert grants.count((users[0], project_id)) == 2 and grants.count((users[1], project_id)) == 2
+    assert grants.count((users[0], other)) == 1
+
+
+def test_delete_project_invalidates_grants(grants):
+    project_id, user_id = uuid.uuid4(), uuid.uuid4()
+    asyncio.run(ensure_access(project_id, user_id))
+
+    class Session:
+        async def execute(self, statement):
+            return type("Result", (), {"rowcount": 1})()
+
+        async def commit(self):
+            pass
+
+    assert asyncio.run(ProjectService.delete_project(Session(), project_id)) is True
+    asyncio.run(ensure_access(project_id, user_id))
+    assert len(grants) == 2
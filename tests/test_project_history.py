@@ -0,0 +1,61 @@
+import json
+from collections import namedtuple
+import pytest
+from services.json_patch import make_patch
+from services.project_history import DELTA, SNAPSHOT, rebuild_version
+
+Row = namedtuple("Row", "version kind payload")
+
+VERSIONS = [
+    {"title": "Home", "pages": [{"id": "p1", "widgets": []}]},
+    {"title": "Home", "pages": [{"id": "p1", "widgets": [{"id": "w1", "visible": 1}]}]},
+    {"title": "Start", "pages": [{"id": "p1", "widgets": [{"id": "w1", "visible": True}]}]},
+    {"title": "Start", "pages": [{"id": "p1", "widgets": [{"id": "w1", "visible": True}]}, {"id": "p2", "widgets": []}]},
+    {"title": "Start", "pages": [{"id": "p2", "widgets": [{"id": "w2", "text": "a/b~c"}]}]},
+]
+
+
+def history(first: int = 1):
+    """A snapshot of VERSIONS[0] as version ``first`` and deltas for the rest"""
+    rows = [Row(first, SNAPSHOT, VERSIONS[0])]
+    for offset, (old, new) in enumerate(zip(VERSIONS, VERSIONS[1:]), start=1):
+        rows.append(Row(first + offset, DELTA, make_patch(old, new)))
+    return rows
+
+
+@pytest.mark.parametrize("index", range(len(VERSIONS)))
+def test_rebuild_every_version(index):
+    rows = history(first=7)
+    data = rebuild_version(rows[:index + 1], 7 + index)
+    # JSON equality: key order is free, 1 and true differ
+    assert json.dumps(data, sort_keys=True) == json.dumps(VERSIONS[index], sort_keys=True)
+
+
+def test_rebuild_does_not_modify_rows():
+    rows = history()
+    rebuild_version(rows, len(rows))
+    assert rows[0].payload == VERSIONS[0]
+
+
+def test_rebuild_from_empty_snapshot():
+    rows = [Row(1, SNAPSHOT, None), Row(2, DELTA, [{"op": "add", "path": "/title", "value": "Home"}])]
+    assert rebuild_version(rows, 2) == {"title": "Home"}
+    assert rebuild_version(rows[:1], 1) is None
+
+
+@pytest.mark.parametrize("rows, version", [
+    ([], 1),
+    (history()[:3], 4),  # not stored (yet)
+    (history()[1:], 5),  # no snapshot to start from (compacted)
+    ([history()[0]] + history()[2:], 5),  # gap
+    (history()[:2] + [Row(3, SNAPSHOT, VERSIONS[2]), Row(4, DELTA, [])], 4),  # rows not from one snapshot
+])
+def test_rebuild_unavailable(rows, version):
+    with pytest.raises(LookupError, match="not available"):
+        rebuild_version(rows, version)
+
+
+def test_rebuild_failing_delta():
+    rows = history()[:2] + [Row(3, DELTA, [{"op": "remove", "path": "/missing"}])]
+    with pytest.raises(LookupError, match="could not be rebuilt"):
+        rebuild_version(rows, 3)
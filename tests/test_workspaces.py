@@ -0,0 +1,118 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import pytest
+from services import workspaces as workspaces_module
+from services.workspaces import WorkspaceManager, WorkspaceQuotaExceeded
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return WorkspaceManager(str(tmp_path / "root"))
+
+
+def orphan(manager, name, pid, age=7200):
+    """A workspace left behind by ``pid``, last touched ``age`` seconds ago"""
+    path = os.path.join(manager.root, name)
+    os.makedirs(path)
+    marker = os.path.join(path, ".owner")
+    with open(marker, "w") as f:
+        json.dump({"pid": pid, "host": workspaces_module._HOST}, f)
+    then = time.time() - age
+    os.utime(marker, (then, then))
+    os.utime(path, (then, then))
+    return path
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_create_over_quota_raises(manager, monkeypatch):
+    monkeypatch.setattr(workspaces_module, "WORKSPACE_QUOTA_BYTES", 10)
+    workspace = manager.create()
+    with open(workspace.join("big.bin"), "wb") as f:
+        f.write(b"x" * 20)
+    workspace.measure()
+    with pytest.raises(WorkspaceQuotaExceeded):
+        manager.create()
+
+    workspace.release()
+    manager.create().release()
+
+
+def test_measure_over_max_bytes_raises(manager, monkeypatch):
+    monkeypatch.setattr(workspaces_module, "WORKSPACE_MAX_BYTES", 10)
+    with pytest.raises(WorkspaceQuotaExceeded):
+        with manager.create() as workspace:
+            with open(workspace.join("big.bin"), "wb") as f:
+                f.write(b"x" * 20)
+            workspace.measure()
+    assert not os.path.exists(workspace.path)
+    assert manager.usage() == 0
+
+
+def test_release_path(manager):
+    workspace = manager.create()
+    os.makedirs(workspace.join("out"))
+    archive = workspace.join("out", "app.zip")
+    with open(archive, "wb") as f:
+        f.write(b"zip")
+
+    manager.release_path(archive)
+    assert not os.path.exists(workspace.path)
+    manager.release_path(archive)  # already released
+
+
+def test_release_path_outside_root(manager, tmp_path):
+    workspace = manager.create()
+    outside = tmp_path / "elsewhere.zip"
+    outside.write_bytes(b"zip")
+
+    manager.release_path(str(outside))
+    manager.release_path(os.path.join(manager.root, "not-a-workspace", "app.zip"))
+    assert os.path.exists(workspace.path) and outside.exists()
+
+
+def test_collect_garbage(manager):
+    live = manager.create()
+    gone = orphan(manager, "ws-gone", dead_pid())
+    running = orphan(manager, "ws-running", os.getpid())
+    beating = orphan(manager, "ws-beating", dead_pid())
+    os.utime(os.path.join(beating, ".owner"))
+    recent = orphan(manager, "ws-recent", dead_pid(), age=0)
+    unmarked = os.path.join(manager.root, "ws-unmarked")
+    os.makedirs(unmarked)
+    then = time.time() - 7200
+    os.utime(unmarked, (then, then))
+    other = orphan(manager, "other", dead_pid())
+
+    assert manager.collect_garbage(max_age=3600) == 2
+    assert not os.path.exists(gone) and not os.path.exists(unmarked)
+    for path in (live.path, running, beating, recent, other):
+        assert os.path.exists(path)
+
+
+def test_quota_exceeded_is_503(monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    class Generator:
+        def generate_flutter_project(self, *args):
+            raise WorkspaceQuotaExceeded("Not enough scratch space to generate a project, retry later")
+
+    monkeypatch.setattr(main, "get_project_generator", Generator)
+    project = {
+        "name": "App",
+        "pages": [{"id": "home", "name": "Home", "widgets": [], "route": "/"}],
+        "currentPageId": "home",
+        "theme": {"primaryColor": "#000000", "accentColor": "#111111", "backgroundColor": "#FFFFFF"},
+    }
+    response = TestClient(main.app).post("/generate-flutter-app", json=project)
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "30"
+    assert "retry later" in response.json()["detail"]
@@ -54,6 +54,28 @@ def convert_position_to_flutter(position: Position, size: Size, screen_width: fl
         'height': height
     }
 
+def convert_position_to_fractions(position: Position, size: Size, screen_width: float, screen_height: float) -> dict:
+    """Numeric counterpart of convert_position_to_flutter: the same box as fractions of the screen"""
+    left = position.x / screen_width if position.x is not None and screen_width > 0 else 0.0
+    top = position.y / screen_height if position.y is not None and screen_height > 0 else 0.0
+
+    if isinstance(size.width, str) and size.width.endswith('%'):
+        width = float(size.width.replace('%', '')) / 100
+    else:
+        width = float(size.width) / screen_width if screen_width > 0 else 0.2
+
+    if isinstance(size.height, str) and size.height.endswith('%'):
+        height = float(size.height.replace('%', '')) / 100
+    else:
+        height = float(size.height) / screen_height if screen_height > 0 else 0.1
+
+    return {
+        'left': left,
+        'top': top,
+        'width': width,
+        'height': height
+    }
+
 def get_icon_mapping() -> dict:
     """Get mapping of icon names to Material Icons"""
     return {